@@ -0,0 +1,150 @@
+import json
+import asyncio
+import subprocess
+from contextlib import asynccontextmanager
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+from router import rendezvous_score
+
+# Headers describing a single connection, which are not forwarded
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "upgrade", "host", "content-length", "te", "trailer", "proxy-authorization", "proxy-authenticate"}
+
+def worker_for(session_id, workers):
+    """
+    Chooses the worker process of a session by rendezvous hashing.
+
+    Args:
+        session_id (str): The session ID.
+        workers (int): The number of workers.
+
+    Returns:
+        int: The index of the worker.
+    """
+    return max(range(workers), key=lambda worker: rendezvous_score(session_id, f"worker-{worker}"))
+
+def forwarded_headers(headers):
+    return {key: value for key, value in headers.items() if key.lower() not in HOP_HEADERS}
+
+class AffinityProxy:
+    """
+    Forwards the requests of each session to the same worker process, which holds the session in memory.
+
+    The session ID is read from the `session_id` query parameter (WebSocket connections) or from the JSON body
+    of the request, and requests without one go to the worker of the "default" session, as in the handlers.
+    The proxy only moves bytes, the history updates, prompts and postprocessing run in the workers.
+
+    Args:
+        ports (list): The ports of the workers, listening on 127.0.0.1.
+        read_timeout (float, optional): Timeout in seconds for reading a response from a worker. Defaults to 300.0.
+    """
+    def __init__(self, ports, read_timeout=300.0):
+        self.ports = ports
+        self.read_timeout = read_timeout
+        self.client = None
+
+    def target(self, session_id):
+        return f"127.0.0.1:{self.ports[worker_for(session_id or 'default', len(self.ports))]}"
+
+    async def forward(self, request: Request):
+        body = await request.body()
+        session_id = request.query_params.get("session_id")
+        if session_id is None and body:
+            try:
+                session_id = json.loads(body).get("session_id")
+            except (ValueError, AttributeError):
+                pass
+        url = f"http://{self.target(session_id)}{request.url.path}"
+        try:
+            response = await self.client.send(
+                self.client.build_request(request.method, url, params=request.query_params, headers=forwarded_headers(request.headers), content=body),
+                stream=True,
+            )
+        except httpx.HTTPError as e:
+            print(e)
+            return Response(status_code=502)
+        return StreamingResponse(
+            response.aiter_raw(),
+            status_code=response.status_code,
+            headers=forwarded_headers(response.headers),
+            background=BackgroundTask(response.aclose),
+        )
+
+    async def forward_socket(self, websocket: WebSocket):
+        # Installed with uvicorn[standard], only needed to proxy WebSocket connections
+        import websockets
+
+        url = f"ws://{self.target(websocket.query_params.get('session_id'))}{websocket.url.path}"
+        if websocket.url.query:
+            url += f"?{websocket.url.query}"
+        await websocket.accept()
+        try:
+            async with websockets.connect(url, max_size=None) as worker:
+                async def to_worker():
+                    while True:
+                        message = await websocket.receive()
+                        if message["type"] == "websocket.disconnect":
+                            return
+                        await worker.send(message["text"] if message.get("text") is not None else message["bytes"])
+
+                async def to_client():
+                    async for message in worker:
+                        if isinstance(message, str):
+                            await websocket.send_text(message)
+                        else:
+                            await websocket.send_bytes(message)
+
+                # Either side closing ends the other direction
+                tasks = [asyncio.ensure_future(to_worker()), asyncio.ensure_future(to_client())]
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except (OSError, websockets.WebSocketException) as e:
+            print(e)
+        try:
+            await websocket.close()
+        except (RuntimeError, WebSocketDisconnect):
+            # Already closed by the client
+            pass
+
+    def create_app(self):
+        @asynccontextmanager
+        async def lifespan(app):
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(10.0, read=self.read_timeout),
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+            )
+            yield
+            await self.client.aclose()
+
+        app = FastAPI(lifespan=lifespan)
+        app.add_api_route("/{path:path}", self.forward, methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH"])
+        app.add_api_websocket_route("/{path:path}", self.forward_socket)
+        return app
+
+def run_workers(command, workers, host, port, read_timeout=300.0):
+    """
+    Serves the backend with several worker processes behind an `AffinityProxy`, to spread the CPU work of the
+    requests (history updates, diffs, postprocessing) over several cores.
+
+    Worker `i` listens on 127.0.0.1, port `port + 1 + i`, where its metrics can be scraped.
+
+    Args:
+        command (list): The command starting one worker, to which `--host` and `--port` are appended.
+        workers (int): The number of workers.
+        host (str): The host the proxy listens on.
+        port (int): The port the proxy listens on.
+        read_timeout (float, optional): Timeout in seconds for reading a response from a worker. Defaults to 300.0.
+    """
+    ports = [port + 1 + worker for worker in range(workers)]
+    processes = [subprocess.Popen([*command, "--host", "127.0.0.1", "--port", str(worker_port)]) for worker_port in ports]
+    try:
+        uvicorn.run(AffinityProxy(ports, read_timeout=read_timeout).create_app(), host=host, port=port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
@@ -0,0 +1,87 @@
+"""
+Benchmark of the edit-continuity check run on every tab/inline request.
+
+Compares `blockwise_if_continuous_modify`, which diffs the whole files on every keystroke,
+with the incremental `ContinuityTracker`, and checks that both record the same history.
+Typing sessions only change one line at a time. The tracker approximates the diff blocks of files of 200 lines or more
+(see `count_trimmed_diff_blocks`), so sessions of multi-line edits (pastes, deletions, duplicated and rewritten
+blocks) are replayed too, and every session reports the fraction of continuity checks on which both agree and the
+fraction of diff block counts between states two edits apart that are the same.
+
+Usage (from the backend directory):
+    python benchmarks/bench_continuity.py --sizes 500 1000 2000 5000
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import blockwise_if_continuous_modify, ContinuityTracker, generate_diff_blocks, count_trimmed_diff_blocks
+from benchmarks.synthetic import generate_code, typing_session, line_edit_session
+
+def replay(states, check):
+    """
+    Record a stream of code states into an edit history, the same way `main.update_history` does.
+
+    Args:
+        states (list): The code after every keystroke.
+        check (callable): The continuity check, called as `check(code1, code2, code3)`.
+
+    Returns:
+        tuple: The recorded history and the mean time per check in milliseconds.
+    """
+    history = [states[0]]
+    elapsed = 0.0
+    for code in states[1:]:
+        code1 = history[-2] if len(history) > 1 else ""
+        start = time.perf_counter()
+        continuous = check(code1, history[-1], code)
+        elapsed += time.perf_counter() - start
+        if continuous:
+            history[-1] = code
+        else:
+            history.append(code)
+    return history, elapsed / (len(states) - 1) * 1000
+
+def agreement(states):
+    """
+    Runs both checks on every triple of consecutive states.
+
+    Returns:
+        tuple: The fraction of triples on which the checks agree, and the fraction of the first and last states
+        of the triples with the same number of diff blocks whole and trimmed.
+    """
+    triples = list(zip(states, states[1:], states[2:]))
+    same_checks = sum(ContinuityTracker().check(*triple) == blockwise_if_continuous_modify(*triple) for triple in triples)
+    same_blocks = sum(count_trimmed_diff_blocks(code1, code3) == len(generate_diff_blocks(code1, code3)) for code1, _, code3 in triples)
+    return same_checks / len(triples), same_blocks / len(triples)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 500, 1000, 2000, 5000], help="File sizes in lines")
+    parser.add_argument("--bursts", type=int, default=4, help="Number of typing bursts per session")
+    parser.add_argument("--burst_length", type=int, default=10, help="Keystrokes per burst")
+    parser.add_argument("--line_edits", type=int, default=100, help="Number of edits per multi-line session")
+    args = parser.parse_args()
+
+    print(f"{'session':>10} {'lines':>8} {'edits':>6} {'baseline ms':>12} {'incremental ms':>15} {'speedup':>8} {'same history':>13} {'same checks':>12} {'same blocks':>12}")
+    for size in args.sizes:
+        sessions = {
+            "typing": typing_session(generate_code(size), num_bursts=args.bursts, burst_length=args.burst_length),
+            "lines": line_edit_session(generate_code(size), num_edits=args.line_edits),
+        }
+        for name, states in sessions.items():
+            baseline_history, baseline_ms = replay(states, blockwise_if_continuous_modify)
+            tracker = ContinuityTracker()
+            incremental_history, incremental_ms = replay(states, tracker.check)
+            same_checks, same_blocks = agreement(states)
+            print(
+                f"{name:>10} {size:>8} {len(states):>6} {baseline_ms:>12.2f} {incremental_ms:>15.3f} {baseline_ms / incremental_ms:>7.0f}x "
+                f"{str(baseline_history == incremental_history):>13} {same_checks:>12.1%} {same_blocks:>12.1%}",
+                flush=True,
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark of the storage of the edit history: a plain list of snapshots against the delta-compressed `EditHistory`.
+
+Replays a long typing session on a large file, keeping the whole history (as with `--sliding_window 0` and no
+session cap), and builds the history part of the prompt of every keystroke with the sliding window and with
+the `HistoryCompactor`. For each storage, reports the memory retained by the history at the end of the session,
+the mean time per keystroke, and whether the prompts are identical to those built from the plain list.
+
+Usage (from the backend directory):
+    python benchmarks/bench_edit_history.py --lines 2000 --bursts 200
+"""
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import decorate_code
+from session_store import SessionState
+from history_compactor import HistoryCompactor
+from benchmarks.bench_history import record
+from benchmarks.synthetic import generate_code, typing_session
+
+class ListHistory(list):
+    """
+    The plain list of full snapshots used before `EditHistory`, with the same `key` interface, keyed by content.
+    """
+    @property
+    def size(self):
+        return sum(len(code) for code in self)
+
+    def key(self, index):
+        index = index % len(self)
+        return (self[index - 1] if index > 0 else None, self[index])
+
+    def keys(self):
+        return [self.key(index) for index in range(len(self))]
+
+def replay(states, storage, select, merge=None):
+    """
+    Record a session and build the history of every request.
+
+    Returns:
+        tuple: The digests of the prompts, the number of snapshots kept, the memory retained by the history in KiB
+        and the mean time per keystroke in milliseconds.
+    """
+    tracemalloc.start()
+    session = SessionState("bench")
+    if storage == "list":
+        session.history = ListHistory()
+    digests = []
+    start = time.perf_counter()
+    for code in states:
+        # Every request brings a new string, as decoded from its JSON body
+        code = (code + "\n")[:-1]
+        if record(session, code) and merge is not None:
+            merge(session)
+        digests.append(hashlib.sha256("\0".join(select(session)).encode("utf-8")).hexdigest())
+    elapsed = time.perf_counter() - start
+    session.history_renders = {}
+    session.continuity = None
+    # Only the history is left, the states and the prompts are owned by the caller
+    retained = tracemalloc.get_traced_memory()[0] - sys.getsizeof(digests) - sum(sys.getsizeof(digest) for digest in digests)
+    tracemalloc.stop()
+    return digests, len(session.history), retained / 1024, elapsed / len(states) * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=2000, help="File size in lines")
+    parser.add_argument("--bursts", type=int, default=200, help="Number of typing bursts, each committing a snapshot")
+    parser.add_argument("--burst_length", type=int, default=8, help="Keystrokes per burst")
+    parser.add_argument("--delete_length", type=int, default=4, help="Characters deleted before each burst")
+    parser.add_argument("--window", type=int, default=2, help="Sliding window size")
+    parser.add_argument("--budget", type=int, default=4096, help="Token budget of the compacted history")
+    args = parser.parse_args()
+
+    states = typing_session(generate_code(args.lines), num_bursts=args.bursts, burst_length=args.burst_length, delete_length=args.delete_length)
+    window = lambda session: [decorate_code(code) for code in session.history[-args.window - 1:-1]]
+    compactor = HistoryCompactor(args.budget)
+    policies = {f"window {args.window}": (window, None), f"budget {args.budget}": (compactor.select, compactor.merge)}
+
+    print(f"{len(states)} keystrokes on {args.lines} lines")
+    print(f"{'policy':>12} {'storage':>8} {'snapshots':>10} {'memory KiB':>11} {'ms/keystroke':>13} {'same prompts':>13}")
+    for policy, (select, merge) in policies.items():
+        baseline = None
+        for storage in ("list", "delta"):
+            digests, snapshots, memory, ms = replay(states, storage, select, merge)
+            baseline = baseline or digests
+            print(f"{policy:>12} {storage:>8} {snapshots:>10} {memory:>11.0f} {ms:>13.3f} {str(digests == baseline):>13}", flush=True)
+
+if __name__ == "__main__":
+    main()
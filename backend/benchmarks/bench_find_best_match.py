@@ -0,0 +1,114 @@
+"""
+Benchmark of `find_best_match`, the fuzzy search of SEARCH blocks in search-and-replace outputs.
+
+Compares the indexed, vectorized search with the original line-by-line search kept below as a reference,
+and checks that both return the same match for every query. The slowest query is reported too, since
+queries without an exact match in the file score every candidate span.
+
+Usage (from the backend directory):
+    python benchmarks/bench_find_best_match.py --sizes 200 1000 2000 10000
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_and_replace import Match, find_best_match, get_indent_type, get_max_indent, score_line, score_multiline
+from benchmarks.synthetic import generate_code, search_queries
+
+def reference_find_best_match(query, code_file):
+    """
+    The original `find_best_match`, scoring every line with `score_line` and sorting the candidates in Python.
+    """
+    best_match = Match(-1, -1, 0)
+
+    code_file_lines = code_file.split("\n")
+    query_lines = query.split("\n")
+    if len(query_lines) > 0 and query_lines[-1].strip() == "...":
+        query_lines = query_lines[:-1]
+    if len(query_lines) > 0 and query_lines[0].strip() == "...":
+        query_lines = query_lines[1:]
+    indent = get_indent_type(code_file)
+    max_indents = get_max_indent(code_file, indent)
+
+    top_matches = []
+
+    if len(query_lines) == 1:
+        for i, line in enumerate(code_file_lines):
+            score = score_line(line, query_lines[0])
+            if score > best_match.score:
+                best_match = Match(i, i + 1, score)
+        return best_match
+
+    truncate = min(40, len(code_file_lines) // 5)
+    if truncate < 1:
+        truncate = len(code_file_lines)
+
+    indent_array = [i for i in range(0, max(min(max_indents + 1, 20), 1))]
+    if max_indents > 3:
+        indent_array = [3, 2, 4, 0, 1] + list(range(5, max_indents + 1))
+    for num_indents in indent_array:
+        indented_query_lines = [indent * num_indents + line for line in query_lines]
+
+        start_pairs = [(i, score_line(line, indented_query_lines[0])) for i, line in enumerate(code_file_lines)]
+        start_pairs.sort(key=lambda x: x[1], reverse=True)
+        start_indices = [i for i, _ in start_pairs[:truncate]]
+
+        for i in start_indices:
+            end_pairs = [(j, score_line(line, indented_query_lines[-1])) for j, line in enumerate(code_file_lines[i:], start=i)]
+            end_pairs.sort(key=lambda x: x[1], reverse=True)
+            end_indices = [j for j, _ in end_pairs[:truncate]]
+
+            for j in end_indices:
+                raw_score = score_multiline(indented_query_lines, code_file_lines[i : j + 1])
+                score = raw_score * (1 - num_indents * 0.01)
+                current_match = Match(i, j + 1, score, indent * num_indents)
+                if raw_score >= 99.99:
+                    return current_match
+                top_matches.append(current_match)
+                if score > best_match.score:
+                    best_match = current_match
+
+    unique_top_matches = []
+    unique_spans = set()
+    for top_match in sorted(top_matches, reverse=True):
+        if (top_match.start, top_match.end) not in unique_spans:
+            unique_top_matches.append(top_match)
+            unique_spans.add((top_match.start, top_match.end))
+    return unique_top_matches[0] if unique_top_matches else Match(-1, -1, 0)
+
+def run(search, code, queries):
+    """
+    Run a search over all queries.
+
+    Returns:
+        tuple: The matches, and the mean and maximum time per query in milliseconds.
+    """
+    score_line.cache_clear()
+    matches = []
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        matches.append(search(query, code))
+        times.append((time.perf_counter() - start) * 1000)
+    return matches, sum(times) / len(times), max(times)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 500, 1000, 2000], help="File sizes in lines")
+    parser.add_argument("--queries", type=int, default=10, help="Number of queries per file")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    print(f"{'lines':>8} {'queries':>8} {'baseline ms':>12} {'indexed ms':>11} {'max ms':>8} {'speedup':>8} {'same matches':>13}")
+    for size in args.sizes:
+        code = generate_code(size, seed=args.seed)
+        queries = search_queries(code, num_queries=args.queries, seed=args.seed)
+        baseline, baseline_ms, _ = run(reference_find_best_match, code, queries)
+        indexed, indexed_ms, indexed_max_ms = run(find_best_match, code, queries)
+        print(f"{size:>8} {len(queries):>8} {baseline_ms:>12.1f} {indexed_ms:>11.1f} {indexed_max_ms:>8.1f} {baseline_ms / indexed_ms:>7.1f}x {str(baseline == indexed):>13}")
+
+if __name__ == "__main__":
+    main()
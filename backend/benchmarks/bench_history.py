@@ -0,0 +1,86 @@
+"""
+Benchmark of the history policies of tab requests.
+
+Replays a typing session and builds the history part of the prompt of every keystroke with the fixed sliding
+window and with the token-budgeted `HistoryCompactor`. For each policy, reports the mean history tokens per
+request, the mean number of edits (snapshots) they contain, and the share of history tokens that are a prefix of
+the previous request, i.e. that an inference service with prefix caching does not prefill again.
+
+Usage (from the backend directory):
+    python benchmarks/bench_history.py --lines 1000 --budget 2048
+"""
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import decorate_code, estimate_tokens
+from session_store import SessionState
+from history_compactor import HistoryCompactor
+from benchmarks.synthetic import generate_code, typing_session
+
+def record(session, code):
+    """
+    Record a code state in the history of a session, the same way `main.update_history` does.
+
+    Returns:
+        bool: True if a snapshot was committed.
+    """
+    history = session.history
+    if not history:
+        history.append(code)
+        return False
+    code1 = history[-2] if len(history) > 1 else ""
+    if session.continuity.check(code1, history[-1], code):
+        history[-1] = code
+        return False
+    history.append(code)
+    return True
+
+def replay(states, select, merge=None):
+    """
+    Build the history of every request of a session.
+
+    Returns:
+        tuple: The mean history tokens, the mean number of snapshots and the share of tokens cached from the previous request.
+    """
+    session = SessionState("bench")
+    tokens = snapshots = cached = 0
+    previous = []
+    for code in states:
+        if record(session, code) and merge is not None:
+            merge(session)
+        rendered = select(session)
+        tokens += sum(estimate_tokens(content) for content in rendered)
+        snapshots += len(rendered)
+        # Messages shared with the start of the previous request are cached
+        for old, new in zip(previous, rendered):
+            if old != new:
+                break
+            cached += estimate_tokens(new)
+        previous = rendered
+    return tokens / len(states), snapshots / len(states), cached / max(tokens, 1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=1000, help="File size in lines")
+    parser.add_argument("--bursts", type=int, default=40, help="Number of typing bursts")
+    parser.add_argument("--burst_length", type=int, default=8, help="Keystrokes per burst")
+    parser.add_argument("--delete_length", type=int, default=4, help="Characters deleted before each burst")
+    parser.add_argument("--budget", type=int, default=2048, help="Token budget of the compacted history")
+    parser.add_argument("--windows", type=int, nargs="+", default=[1, 2, 4], help="Sliding window sizes")
+    args = parser.parse_args()
+
+    states = typing_session(generate_code(args.lines), num_bursts=args.bursts, burst_length=args.burst_length, delete_length=args.delete_length)
+    print(f"{'policy':>16} {'tokens/request':>15} {'edits/request':>14} {'cached':>7}")
+    for window in args.windows:
+        select = lambda session: [decorate_code(code) for code in session.history[-window - 1:-1]]
+        tokens, snapshots, cached = replay(states, select)
+        print(f"{'window ' + str(window):>16} {tokens:>15.0f} {snapshots:>14.2f} {cached:>7.0%}")
+    compactor = HistoryCompactor(args.budget)
+    tokens, snapshots, cached = replay(states, compactor.select, compactor.merge)
+    print(f"{'budget ' + str(args.budget):>16} {tokens:>15.0f} {snapshots:>14.2f} {cached:>7.0%}")
+
+if __name__ == "__main__":
+    main()
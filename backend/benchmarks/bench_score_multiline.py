@@ -0,0 +1,174 @@
+"""
+Benchmark and randomized check of `score_multiline` on queries with `...` wildcards.
+
+Compares the memoized alignment with the original recursive version kept below as a reference:
+the scores must be exactly equal on random inputs, and the memoized version must stay fast as the
+number of ellipses grows.
+
+Usage (from the backend directory):
+    python benchmarks/bench_score_multiline.py --trials 2000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_and_replace import line_cost, match_without_whitespace, score_line, score_multiline, build_line_index
+
+def reference_score_multiline(query, target):
+    """
+    The original recursive `score_multiline`, which re-scores the same suffixes for every ellipsis.
+    """
+
+    q, t = 0, 0  # indices for query and target
+    scores: list[tuple[float, float]] = []
+    skipped_comments = 0
+
+    def get_weight(q: int) -> float:
+        # Prefers lines at beginning and end of query
+        # Sequence: 1, 2/3, 1/2, 2/5...
+        index = min(q, len(query) - q)
+        return 100 / (index / 2 + 1)
+
+    while q < len(query) and t < len(target):
+        q_line = query[q]
+        t_line = target[t]
+        weight = get_weight(q)
+
+        if match_without_whitespace(q_line, t_line):
+            # Case 1: lines match
+            scores.append((score_line(q_line, t_line), weight))
+            q += 1
+            t += 1
+        elif q_line.strip().startswith("...") or q_line.strip().endswith("..."):
+            # Case 3: ellipsis wildcard
+            t += 1
+            if q + 1 == len(query):
+                scores.append((100 - (len(target) - t), weight))
+                q += 1
+                t = len(target)
+                break
+            max_score = 0
+            # Radix optimization
+            indices = [
+                t + i
+                for i, line in enumerate(target[t:])
+                if match_without_whitespace(line, query[q + 1])
+            ]
+            if not indices:
+                indices = range(t, len(target))
+            for i in indices:
+                score, weight = reference_score_multiline(query[q + 1 :], target[i:]), (
+                    100 - (i - t) / len(target) * 10
+                )
+                new_scores = scores + [(score, weight)]
+                total_score = sum(
+                    [value * weight for value, weight in new_scores]
+                ) / sum([weight for _, weight in new_scores])
+                max_score = max(max_score, total_score)
+            return max_score
+        elif (
+            t_line.strip() == ""
+            or t_line.strip().startswith("#")
+            or t_line.strip().startswith("//")
+            or t_line.strip().startswith("print")
+            or t_line.strip().startswith("logger")
+            or t_line.strip().startswith("console.")
+        ):
+            # Case 2: skipped comment
+            skipped_comments += 1
+            t += 1
+            scores.append((90, weight))
+        else:
+            break
+
+    if q < len(query):
+        scores.extend(
+            (100 - line_cost(line), get_weight(index))
+            for index, line in enumerate(query[q:])
+        )
+    if t < len(target):
+        scores.extend(
+            (100 - line_cost(line), 100) for index, line in enumerate(target[t:])
+        )
+
+    final_score = (
+        sum([value * weight for value, weight in scores])
+        / sum([weight for _, weight in scores])
+        if scores
+        else 0
+    )
+    final_score *= 1 - 0.05 * skipped_comments
+
+    return final_score
+
+def random_case(rng, max_lines=12):
+    """
+    Generate a random target and a query made from it, with edited lines, comments and ellipses.
+
+    Returns:
+        tuple: The query lines and the target lines.
+    """
+    vocabulary = ["x = 1", "y = x + 1", "return y", "# note", "", "print(x)", "if x:", "    pass", "z = f(x)", "..."]
+    target = [rng.choice(vocabulary[:-1]) for _ in range(rng.randint(1, max_lines))]
+    query = []
+    for line in target:
+        kind = rng.random()
+        if kind < 0.2:
+            continue
+        if kind < 0.35:
+            query.append(rng.choice(["...", "    ...", "# ..."]))
+        elif kind < 0.45:
+            query.append("  " + line)
+        elif kind < 0.55:
+            query.append(line + " # edited")
+        else:
+            query.append(line)
+    return query or ["..."], target
+
+def check(trials, seed):
+    """
+    Compare the memoized and the reference scores on random inputs, with and without the precomputed tail values.
+
+    Returns:
+        int: The number of mismatches.
+    """
+    rng = random.Random(seed)
+    mismatches = 0
+    for _ in range(trials):
+        query, target = random_case(rng)
+        expected = reference_score_multiline(query, target)
+        values = build_line_index("\n".join(target)).tail_values
+        if score_multiline(query, target) != expected or score_multiline(query, target, values) != expected:
+            mismatches += 1
+    return mismatches
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=2000, help="Number of random inputs to compare")
+    parser.add_argument("--target_lines", type=int, default=40, help="Target length of the timing runs")
+    parser.add_argument("--max_ellipses", type=int, default=4, help="Largest number of ellipses of the timing runs")
+    parser.add_argument("--reference_ellipses", type=int, default=3, help="Largest number of ellipses timed with the reference")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    print(f"mismatches: {check(args.trials, args.seed)}/{args.trials}")
+
+    # A repeated line after every ellipsis makes every later occurrence a candidate, e.g. `}` or `return`
+    target = ["    return None"] * args.target_lines
+    print(f"{'ellipses':>8} {'reference ms':>13} {'memoized ms':>12}")
+    for ellipses in range(1, args.max_ellipses + 1):
+        query = [target[0]] + ["    ...", target[0]] * ellipses
+        reference_ms = timed(reference_score_multiline, query, target) if ellipses <= args.reference_ellipses else float("nan")
+        print(f"{ellipses:>8} {reference_ms:>13.1f} {timed(score_multiline, query, target):>12.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Microbenchmarks of the text-processing hot paths of the backend.
+
+Every function is run on synthetic files of several sizes, after each kind of edit of `EDIT_PATTERNS`.
+For each case, the median time of repeated runs and the peak memory of one run (measured with tracemalloc)
+are reported. Results can be saved as JSON and compared with an earlier run to catch regressions.
+
+Usage (from the backend directory):
+    python benchmarks/bench_suite.py --output before.json
+    python benchmarks/bench_suite.py --output after.json --compare before.json
+    python benchmarks/bench_suite.py --sizes 100 1000 --functions decorate_code find_best_match
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from special_tokens import NEXT_START, NEXT_END, SEARCH_AND_REPLACE
+from utils import blockwise_if_continuous_modify, generate_diff_blocks, decorate_code, postprocess_output_wf, postprocess_output_lc, postprocess_output_sr, generate_hunks
+from search_and_replace import find_best_match, score_line, build_line_index
+from benchmarks.synthetic import generate_code, edit_states, search_queries, EDIT_PATTERNS
+
+def wf_output(after):
+    """
+    Build a Whole-File model output.
+    """
+    return f"{NEXT_START}```python\n{after}\n```{NEXT_END}"
+
+def lc_output(before, after):
+    """
+    Build a Location-and-Change model output with one block per changed hunk.
+    """
+    blocks = [f"{hunk['start']},{hunk['end']}\n```python\n" + "\n".join(hunk['lines']) + "\n```" for hunk in generate_hunks(before, after)]
+    return NEXT_START + "\n".join(blocks) + NEXT_END
+
+def sr_output(before, after, max_blocks=3):
+    """
+    Build a Search-and-Replace model output with one block per changed hunk, each searching its lines and one line of context.
+    """
+    before_lines = before.split("\n")
+    blocks = []
+    for hunk in generate_hunks(before, after)[:max_blocks]:
+        start, end = max(hunk['start'] - 1, 0), hunk['end']
+        search = before_lines[start:end]
+        replace = before_lines[start:hunk['start']] + hunk['lines']
+        blocks.append("```python\n" + "\n".join(search) + "\n" + SEARCH_AND_REPLACE + "\n" + "\n".join(replace) + "\n```")
+    return NEXT_START + "\n".join(blocks) + NEXT_END
+
+def build_cases(size, pattern, seed):
+    """
+    Build the calls benchmarked for one file size and edit pattern.
+
+    Returns:
+        dict: Function name to a callable running it once.
+    """
+    code1, code2, code3 = edit_states(generate_code(size, seed=seed), pattern, seed=seed)
+    wf, lc, sr = wf_output(code3), lc_output(code2, code3), sr_output(code2, code3)
+    queries = search_queries(code2, num_queries=3, seed=seed)
+    return {
+        'blockwise_if_continuous_modify': lambda: blockwise_if_continuous_modify(code1, code2, code3),
+        'generate_diff_blocks': lambda: generate_diff_blocks(code2, code3),
+        'decorate_code': lambda: decorate_code(code3),
+        'decorate_code_lc': lambda: decorate_code(code3, use_line_num=True),
+        'postprocess_output_wf': lambda: postprocess_output_wf(code2, wf),
+        'postprocess_output_lc': lambda: postprocess_output_lc(code2, lc),
+        'postprocess_output_sr': lambda: postprocess_output_sr(code2, sr),
+        'find_best_match': lambda: [find_best_match(query, code2) for query in queries],
+    }
+
+def clear_caches():
+    # Every real call sees a new file, so the memoized line scores and file indexes must not carry over between runs
+    score_line.cache_clear()
+    build_line_index.cache_clear()
+
+def measure(function, min_time, max_runs):
+    """
+    Time a call and measure its peak memory.
+
+    Args:
+        function (callable): The call.
+        min_time (float): Calls are repeated for at least this many seconds.
+        max_runs (int): Maximum number of timed calls.
+
+    Returns:
+        dict: The median time in milliseconds, the number of timed calls and the peak memory in KiB.
+    """
+    clear_caches()
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    started = time.perf_counter()
+    while len(times) < max_runs and (not times or time.perf_counter() - started < min_time):
+        clear_caches()
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'ms': statistics.median(times), 'runs': len(times), 'peak_kib': peak / 1024}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path, threshold):
+    """
+    Print the time and memory ratios of the results to an earlier run.
+
+    Returns:
+        int: The number of cases slower than `threshold` times the baseline.
+    """
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    previous = {(r['function'], r['size'], r['pattern']): r for r in baseline['results']}
+    print(f"\nCompared with {baseline_path} (commit {baseline['meta'].get('commit')}):")
+    print(f"{'function':<32} {'lines':>6} {'pattern':<13} {'time':>7} {'memory':>7}")
+    regressions = 0
+    for result in results:
+        old = previous.get((result['function'], result['size'], result['pattern']))
+        if old is None:
+            continue
+        time_ratio = result['ms'] / max(old['ms'], 1e-6)
+        memory_ratio = result['peak_kib'] / max(old['peak_kib'], 1e-6)
+        flag = " REGRESSION" if time_ratio > threshold else ""
+        regressions += bool(flag)
+        print(f"{result['function']:<32} {result['size']:>6} {result['pattern']:<13} {time_ratio:>6.2f}x {memory_ratio:>6.2f}x{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000, 20000], help="File sizes in lines")
+    parser.add_argument("--patterns", type=str, nargs="+", default=EDIT_PATTERNS, choices=EDIT_PATTERNS, help="Edit patterns")
+    parser.add_argument("--functions", type=str, nargs="+", default=None, help="Only run these functions")
+    parser.add_argument("--min_time", type=float, default=0.2, help="Minimum seconds spent timing each case")
+    parser.add_argument("--max_runs", type=int, default=50, help="Maximum timed runs per case")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--output", type=str, default=None, help="Save the results to this JSON file")
+    parser.add_argument("--compare", type=str, default=None, help="Compare with the results saved in this JSON file")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Time ratio above which a case is reported as a regression")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'function':<32} {'lines':>6} {'pattern':<13} {'ms':>10} {'runs':>5} {'peak KiB':>10}")
+    for size in args.sizes:
+        for pattern in args.patterns:
+            for name, function in build_cases(size, pattern, args.seed).items():
+                if args.functions and name not in args.functions:
+                    continue
+                result = {'function': name, 'size': size, 'pattern': pattern, **measure(function, args.min_time, args.max_runs)}
+                results.append(result)
+                print(f"{name:<32} {size:>6} {pattern:<13} {result['ms']:>10.3f} {result['runs']:>5} {result['peak_kib']:>10.1f}", flush=True)
+
+    if args.output:
+        meta = {'commit': git_commit(), 'python': platform.python_version(), 'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'seed': args.seed}
+        with open(args.output, "w") as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
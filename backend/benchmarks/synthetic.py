@@ -0,0 +1,171 @@
+import re
+import random
+
+def generate_code(num_lines, seed=0):
+    """
+    Generate a synthetic Python file.
+
+    Args:
+        num_lines (int): The number of lines of the file.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        str: The code, made of classes and functions with nested blocks, comments and blank lines.
+    """
+    rng = random.Random(seed)
+    names = ["value", "result", "index", "items", "count", "total", "buffer", "config", "state", "node"]
+    lines = []
+    while len(lines) < num_lines:
+        cls = f"Component{len(lines)}"
+        lines.append(f"class {cls}:")
+        lines.append(f"    \"\"\"Synthetic component {cls}.\"\"\"")
+        for _ in range(rng.randint(2, 5)):
+            method = f"{rng.choice(names)}_{rng.randint(0, 999)}"
+            lines.append("")
+            lines.append(f"    def {method}(self, {rng.choice(names)}, {rng.choice(names)}=None):")
+            for _ in range(rng.randint(3, 10)):
+                name = rng.choice(names)
+                kind = rng.random()
+                if kind < 0.15:
+                    lines.append(f"        # update {name} before the next step")
+                elif kind < 0.35:
+                    lines.append(f"        if {name} is not None:")
+                    lines.append(f"            {name} = {name} + {rng.randint(0, 100)}")
+                elif kind < 0.5:
+                    lines.append(f"        for {name} in range({rng.randint(1, 50)}):")
+                    lines.append(f"            self.{rng.choice(names)}.append({name})")
+                else:
+                    lines.append(f"        {name} = self.{rng.choice(names)}({rng.choice(names)}, {rng.randint(0, 100)})")
+            lines.append(f"        return {rng.choice(names)}")
+        lines.append("")
+    return "\n".join(lines[:num_lines])
+
+def typing_session(code, num_bursts=5, burst_length=20, seed=0, delete_length=0):
+    """
+    Simulate an editing session: bursts of keystrokes, each burst typing at a random position of the file.
+
+    Args:
+        code (str): The initial code.
+        num_bursts (int, optional): The number of bursts. Defaults to 5.
+        burst_length (int, optional): The number of characters typed per burst. Defaults to 20.
+        seed (int, optional): The random seed. Defaults to 0.
+        delete_length (int, optional): The number of characters selected and deleted before each burst. Defaults to 0.
+
+    Returns:
+        list: The code after every keystroke.
+    """
+    rng = random.Random(seed)
+    states = []
+    for _ in range(num_bursts):
+        offset = rng.randint(0, len(code))
+        text = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz_ ()=") for _ in range(burst_length))
+        if delete_length > 0:
+            code = code[:offset] + code[offset + delete_length:]
+            states.append(code)
+        for i in range(1, burst_length + 1):
+            states.append(code[:offset] + text[:i] + code[offset:])
+        code = states[-1]
+    return states
+
+def line_edit_session(code, num_edits=20, seed=0, max_lines=8):
+    """
+    Simulate an editing session of multi-line edits: pasting, deleting, duplicating and rewriting blocks of lines.
+
+    Args:
+        code (str): The initial code.
+        num_edits (int, optional): The number of edits. Defaults to 20.
+        seed (int, optional): The random seed. Defaults to 0.
+        max_lines (int, optional): The maximum number of lines changed by one edit. Defaults to 8.
+
+    Returns:
+        list: The code after every edit, starting with the initial code.
+    """
+    rng = random.Random(seed)
+    lines = code.split("\n")
+    states = [code]
+    for _ in range(num_edits):
+        start = rng.randint(0, len(lines))
+        count = rng.randint(1, max_lines)
+        kind = rng.random()
+        if kind < 0.3:
+            lines[start:start] = [f"    pasted_{rng.randint(0, 999)} = {rng.randint(0, 99)}" if rng.random() < 0.7 else "" for _ in range(count)]
+        elif kind < 0.55:
+            del lines[start:start + count]
+        elif kind < 0.8:
+            block = lines[start:start + count]
+            lines[start + count:start + count] = block
+        else:
+            lines[start:start + count] = [line.replace("self", "this") + "  # rewritten" for line in lines[start:start + count]]
+        states.append("\n".join(lines))
+    return states
+
+def search_queries(code, num_queries=10, seed=0):
+    """
+    Simulate the SEARCH blocks of search-and-replace outputs: snippets of the file as a model would quote them,
+    with dropped indentation, slightly edited lines, elided middles and single lines.
+
+    Args:
+        code (str): The code searched.
+        num_queries (int, optional): The number of queries. Defaults to 10.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        list: The queries.
+    """
+    rng = random.Random(seed)
+    lines = code.split("\n")
+    queries = []
+    for _ in range(num_queries):
+        start = rng.randrange(len(lines))
+        snippet = lines[start:start + rng.randint(1, 8)]
+        kind = rng.random()
+        if kind < 0.25:
+            indent = min(len(line) - len(line.lstrip()) for line in snippet if line.strip()) if any(line.strip() for line in snippet) else 0
+            snippet = [line[indent:] for line in snippet]
+        elif kind < 0.5:
+            i = rng.randrange(len(snippet))
+            snippet[i] = snippet[i].replace("self.", "self._", 1) + "  # changed"
+        elif kind < 0.65 and len(snippet) > 3:
+            snippet = [snippet[0], "    ...", snippet[-1]]
+        queries.append("\n".join(snippet))
+    return queries
+
+EDIT_PATTERNS = ["typing", "paste", "block_delete", "rename"]
+
+def edit_states(code, pattern, seed=0):
+    """
+    Simulate one edit of a realistic kind, as three successive states of the file.
+
+    Args:
+        code (str): The initial code.
+        pattern (str): One of `EDIT_PATTERNS`: "typing" types a short line fragment, "paste" inserts a copied
+            block of 30 lines, "block_delete" deletes a block of 40 lines and "rename" renames an identifier everywhere.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        tuple: The code before the edit, halfway through it and after it.
+    """
+    rng = random.Random(seed)
+    lines = code.split("\n")
+    line = rng.randrange(len(lines))
+    if pattern == "typing":
+        text = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz_ ()=") for _ in range(20))
+        states = [lines[:line] + [lines[line] + text[:i]] + lines[line + 1:] for i in (0, 10, 20)]
+    elif pattern == "paste":
+        source = rng.randrange(max(len(lines) - 30, 1))
+        block = lines[source:source + 30]
+        states = [lines[:line] + block[:i] + lines[line:] for i in (0, len(block) // 2, len(block))]
+    elif pattern == "block_delete":
+        line = min(line, max(len(lines) - 40, 0))
+        states = [lines[:line] + lines[line + i:] for i in (0, 20, 40)]
+    elif pattern == "rename":
+        occurrences = [i for i, text in enumerate(lines) if re.search(r"\bvalue\b", text)]
+        def rename(count):
+            renamed = list(lines)
+            for i in occurrences[:count]:
+                renamed[i] = re.sub(r"\bvalue\b", "current_value", renamed[i])
+            return renamed
+        states = [rename(count) for count in (0, len(occurrences) // 2, len(occurrences))]
+    else:
+        raise ValueError(f"Unknown edit pattern {pattern}")
+    return tuple("\n".join(state) for state in states)
@@ -0,0 +1,84 @@
+import ast
+from utils import common_affix_lengths
+
+BRACKETS = {')': '(', ']': '[', '}': '{'}
+
+def bracket_errors(code):
+    """
+    Counts the unbalanced brackets of a code, a parse check that works for any language.
+
+    Brackets inside quotes are counted too, which is fine to compare two versions of one file.
+
+    Args:
+        code (str): The code.
+
+    Returns:
+        int: The number of closing brackets without an opening one, plus the number of unclosed brackets.
+    """
+    stack = []
+    errors = 0
+    for char in code:
+        if char in "([{":
+            stack.append(char)
+        elif char in BRACKETS:
+            if stack and stack[-1] == BRACKETS[char]:
+                stack.pop()
+            else:
+                errors += 1
+    return errors + len(stack)
+
+def parses(code):
+    try:
+        ast.parse(code)
+        return True
+    except (SyntaxError, ValueError):
+        return False
+
+def changed_lines(code, candidate):
+    """
+    Finds the lines of a code replaced by a candidate.
+
+    Returns:
+        tuple: The start and end lines of the changed region of `code`, and the number of changed characters.
+    """
+    lines, candidate_lines = code.split("\n"), candidate.split("\n")
+    prefix, suffix = common_affix_lengths(lines, candidate_lines)
+    changed = sum(len(line) + 1 for line in lines[prefix:len(lines) - suffix]) + sum(len(line) + 1 for line in candidate_lines[prefix:len(candidate_lines) - suffix])
+    return prefix, len(lines) - suffix, changed
+
+def rank_candidates(code, candidates, area):
+    """
+    Deduplicates the suggestions of a tab request and ranks them with cheap local heuristics, without another model call.
+
+    In order of importance, a candidate ranks lower when it:
+    - breaks the syntax of the file: it no longer parses as Python while the file did, or it has more unbalanced brackets,
+    - changes nothing,
+    - changes lines further from the cursor,
+    - changes more characters.
+    Candidates with the same rank keep the order of the model.
+
+    Args:
+        code (str): The code sent by the client.
+        candidates (list): The postprocessed whole files, in the order of the model.
+        area (list): The start and end offsets of the selection in the code.
+
+    Returns:
+        list: The distinct candidates, best first.
+    """
+    unique = list(dict.fromkeys(candidate.rstrip() for candidate in candidates))
+    if len(unique) < 2:
+        return unique
+    try:
+        cursor = code.count("\n", 0, int(area[0]))
+    except (IndexError, TypeError, ValueError):
+        cursor = 0
+    python = parses(code)
+    brackets = bracket_errors(code)
+
+    def rank(candidate):
+        start, end, changed = changed_lines(code, candidate)
+        breaks = (python and not parses(candidate)) or bracket_errors(candidate) > brackets
+        distance = 0 if start <= cursor <= end else min(abs(start - cursor), abs(end - 1 - cursor))
+        return breaks, candidate == code.rstrip(), distance, changed
+
+    return sorted(unique, key=rank)
@@ -0,0 +1,124 @@
+import asyncio
+from utils import estimate_tokens
+
+# Tokens added per message by the chat template
+MESSAGE_OVERHEAD = 4
+
+class ChatContext:
+    """
+    Keeps the chat prompt of a session under a token budget, instead of resending the whole conversation.
+
+    - The system prompt and the latest turns are sent verbatim.
+    - When the conversation outgrows the budget, the oldest turns are summarized in the background, until the
+      turns left use at most `1 - drop_fraction` of the budget. The summary is added to the system message,
+      and the summarized turns are removed from the session.
+    - Until the summary is ready, the turns are still sent verbatim, so the prompt changes once per compaction
+      and the prefix cache of the inference service is reused by every request in between.
+
+    Args:
+        budget (int): The token budget of the conversation, 0 for no limit.
+        summarize (callable, optional): An async function taking the session, the previous summary and the messages to
+            summarize, and returning the new summary or None if it failed. None to drop old turns without summaries. Defaults to None.
+        system_prompt (str, optional): The system prompt. Defaults to None.
+        drop_fraction (float, optional): Part of the budget freed by a compaction. Defaults to 0.5.
+    """
+    def __init__(self, budget, summarize=None, system_prompt=None, drop_fraction=0.5):
+        self.budget = budget
+        self.summarize = summarize
+        self.system_prompt = system_prompt
+        self.drop_fraction = drop_fraction
+        self.tasks = set()
+        self.compactions = 0
+
+    def system_message(self, session):
+        parts = []
+        if self.system_prompt:
+            parts.append(self.system_prompt)
+        if session.chat_summary:
+            parts.append(f"Summary of the earlier conversation:\n{session.chat_summary}")
+        if not parts:
+            return []
+        return [{'role': 'system', 'content': "\n\n".join(parts)}]
+
+    def choose_cut(self, session):
+        """
+        Chooses how many of the oldest messages of a session to summarize.
+
+        Returns:
+            int: The number of messages, 0 if the conversation fits the budget. The cut is always
+            before a user message and never reaches the latest one.
+        """
+        messages = session.chat
+        costs = [estimate_tokens(message['content']) + MESSAGE_OVERHEAD for message in messages]
+        total = sum(costs) + estimate_tokens(session.chat_summary or "") + estimate_tokens(self.system_prompt or "")
+        if self.budget <= 0 or total <= self.budget:
+            return 0
+        last_user = max((i for i, message in enumerate(messages) if message['role'] == 'user'), default=0)
+        target = self.budget * (1 - self.drop_fraction)
+        cut = 0
+        for i in range(1, last_user + 1):
+            total -= costs[i - 1]
+            if messages[i]['role'] == 'user':
+                cut = i
+                if total <= target:
+                    break
+        return cut
+
+    def build(self, session):
+        """
+        Builds the messages of the next chat request of a session, and starts a compaction if the conversation outgrew the budget.
+
+        Args:
+            session (SessionState): The session, whose last message is the new user message.
+
+        Returns:
+            list: The system message, if any, followed by the turns of the session.
+        """
+        if session.chat_task is None:
+            cut = self.choose_cut(session)
+            if cut > 0:
+                self.compact(session, session.chat[:cut])
+        return self.system_message(session) + list(session.chat)
+
+    def compact(self, session, messages):
+        """
+        Replaces the oldest messages of a session by a summary, in the background if a summarizer is set.
+
+        Args:
+            session (SessionState): The session.
+            messages (list): The oldest messages of the session.
+        """
+        self.compactions += 1
+        if self.summarize is None:
+            self.drop(session, messages)
+            return
+        task = asyncio.ensure_future(self.run(session, messages))
+        session.chat_task = task
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, session, messages):
+        try:
+            summary = await self.summarize(session, session.chat_summary, messages)
+        except Exception as e:
+            print(e)
+            summary = None
+        finally:
+            session.chat_task = None
+        # Without a summary, the turns are dropped anyway so the prompt stays within the budget
+        if summary:
+            session.chat_summary = summary.strip()
+        self.drop(session, messages)
+
+    def drop(self, session, messages):
+        # The session store may have dropped some of them meanwhile, so they are matched by identity
+        dropped = {id(message) for message in messages}
+        session.chat = [message for message in session.chat if id(message) not in dropped]
+
+    async def close(self):
+        """
+        Cancels the pending summaries.
+        """
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
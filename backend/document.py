@@ -0,0 +1,163 @@
+import itertools
+from bisect import bisect_right
+
+def utf16_length(text):
+    """
+    Counts the UTF-16 code units of a string, the unit of string lengths and offsets in JavaScript.
+
+    Args:
+        text (str): The string.
+
+    Returns:
+        int: The number of code units, one per character plus one per character outside the Basic Multilingual Plane.
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+def utf16_index(text, units):
+    """
+    Converts an offset in UTF-16 code units into an index of a string.
+
+    Args:
+        text (str): The string.
+        units (int): The offset in UTF-16 code units, at most `utf16_length(text)`.
+
+    Returns:
+        int: The index of the character at the offset.
+
+    Raises:
+        ValueError: If the offset splits a surrogate pair.
+    """
+    if utf16_length(text) == len(text):
+        return units
+    count = 0
+    for index, char in enumerate(text):
+        if count >= units:
+            break
+        count += 2 if ord(char) > 0xFFFF else 1
+    else:
+        index = len(text)
+    if count != units:
+        raise ValueError(f"Offset {units} splits a surrogate pair")
+    return index
+
+class TextDocument:
+    """
+    A mutable text document stored as a list of bounded chunks, updated with edit deltas.
+
+    An edit only rewrites the chunk(s) it touches instead of copying the whole text,
+    and the joined text is built lazily and cached until the next edit.
+    Offsets and lengths are counted in UTF-16 code units, as in the JavaScript editor sending the deltas,
+    so characters outside the Basic Multilingual Plane (e.g. emoji) count twice.
+
+    Args:
+        text (str, optional): The initial text. Defaults to "".
+        version (int, optional): The initial version. Defaults to 0.
+        chunk_size (int, optional): The target size of a chunk in characters. Defaults to 4096.
+    """
+    def __init__(self, text="", version=0, chunk_size=4096):
+        self.chunk_size = chunk_size
+        self.reset(text, version)
+
+    def reset(self, text, version):
+        """
+        Replaces the whole content of the document.
+
+        Args:
+            text (str): The new text.
+            version (int): The new version.
+        """
+        self.chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or [""]
+        self.sizes = [utf16_length(chunk) for chunk in self.chunks]
+        self.version = version
+        self._reindex()
+        self._text = text
+
+    def _reindex(self):
+        self.starts = [0, *itertools.accumulate(self.sizes)]
+        self.length = self.starts.pop()
+
+    def __len__(self):
+        """
+        int: The length of the document in UTF-16 code units.
+        """
+        return self.length
+
+    def index(self, offset):
+        """
+        Converts an offset in UTF-16 code units into an index of `text`.
+
+        Args:
+            offset (int): The offset, clamped to the document.
+
+        Returns:
+            int: The index in the text.
+        """
+        offset = min(max(offset, 0), self.length)
+        chunk = max(bisect_right(self.starts, offset) - 1, 0)
+        base = sum(len(previous) for previous in self.chunks[:chunk])
+        try:
+            return base + utf16_index(self.chunks[chunk], offset - self.starts[chunk])
+        except ValueError:
+            # Inside a surrogate pair, the index of the pair
+            return base + utf16_index(self.chunks[chunk], offset - self.starts[chunk] - 1)
+
+    @property
+    def text(self):
+        """
+        str: The full text of the document.
+        """
+        if self._text is None:
+            self._text = "".join(self.chunks)
+        return self._text
+
+    def apply(self, offset, delete, insert):
+        """
+        Applies one edit delta.
+
+        Args:
+            offset (int): The offset of the edit in the current text, in UTF-16 code units.
+            delete (int): The number of UTF-16 code units removed at the offset.
+            insert (str): The text inserted at the offset.
+
+        Raises:
+            ValueError: If the edit does not fit in the current text, or splits a surrogate pair.
+        """
+        if offset < 0 or delete < 0 or offset + delete > self.length:
+            raise ValueError(f"Edit ({offset}, {delete}) out of range for a document of length {self.length}")
+
+        first = max(bisect_right(self.starts, offset) - 1, 0)
+        last = max(bisect_right(self.starts, offset + delete) - 1, first)
+        # An edit ending exactly at a chunk boundary does not touch the next chunk
+        if last > first and self.starts[last] == offset + delete:
+            last -= 1
+        base = self.starts[first]
+        merged = "".join(self.chunks[first:last + 1])
+        start = utf16_index(merged, offset - base)
+        end = start + utf16_index(merged[start:], delete)
+        merged = merged[:start] + insert + merged[end:]
+        pieces = [merged[i:i + self.chunk_size] for i in range(0, len(merged), self.chunk_size)]
+        self.chunks[first:last + 1] = pieces
+        self.sizes[first:last + 1] = [utf16_length(piece) for piece in pieces]
+        if not self.chunks:
+            self.chunks = [""]
+            self.sizes = [0]
+        self._reindex()
+        self._text = None
+
+    def apply_deltas(self, deltas, version, length=None):
+        """
+        Applies a list of edit deltas in order and moves the document to a new version.
+
+        Args:
+            deltas (list): Dictionaries with `offset`, `delete` and `insert` keys.
+            version (int): The version of the document after the deltas.
+            length (int, optional): The length of the document after the deltas as seen by the client, in UTF-16 code units. Defaults to None.
+
+        Raises:
+            ValueError: If an edit does not apply, or the length of the document differs from `length`.
+        """
+        for delta in deltas:
+            self.apply(delta['offset'], delta.get('delete', 0), delta.get('insert', ""))
+        if length is not None and length != self.length:
+            raise ValueError(f"Document of length {self.length}, expected {length}")
+        self.version = version
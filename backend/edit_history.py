@@ -0,0 +1,299 @@
+import itertools
+from collections import OrderedDict
+from utils import common_affix_lengths
+
+class Snapshot:
+    """
+    One committed snapshot of an `EditHistory`, stored either whole (a keyframe) or as the change from the snapshot before it.
+
+    Attributes:
+        id (int): The ID of the snapshot, unique within its history.
+        lines (tuple): The lines of a keyframe, None for a delta.
+        start (int): The first line of the previous snapshot replaced by a delta.
+        end (int): The line after the last line of the previous snapshot replaced by a delta.
+        inserted (tuple): The lines replacing them.
+        depth (int): An upper bound of the number of deltas to apply to the last keyframe to rebuild the snapshot.
+    """
+    __slots__ = ("id", "lines", "start", "end", "inserted", "depth")
+
+    def __init__(self, id, lines=None, start=0, end=0, inserted=(), depth=0):
+        self.id = id
+        self.lines = lines
+        self.start = start
+        self.end = end
+        self.inserted = inserted
+        self.depth = depth
+
+    @property
+    def size(self):
+        stored = self.lines if self.lines is not None else self.inserted
+        return sum(len(line) for line in stored) + len(stored)
+
+class EditHistory:
+    """
+    The code snapshots of an edit history, stored as keyframes and line deltas instead of one full copy per snapshot.
+
+    Consecutive snapshots differ in a few lines around the edit, so each committed snapshot only stores the lines
+    between the common prefix and suffix lines of its predecessor, and every `keyframe_interval`-th snapshot is
+    stored whole. Keyframes are assembled from the lines of the previous snapshot, so unchanged lines are shared by
+    reference across snapshots. The last snapshot, which changes on every keystroke, is kept as a plain string.
+    Rebuilt snapshots are cached, so the snapshots of the prompt window are only rebuilt once after they are committed.
+
+    The history behaves like the list of snapshots it replaces: indexing, slicing, `len`, iteration, `append`,
+    assignment of the last snapshot, `pop` and `del` of single snapshots.
+
+    Args:
+        keyframe_interval (int, optional): Maximum number of deltas between two keyframes. Defaults to 32.
+        cache_size (int, optional): Number of rebuilt snapshots kept. Defaults to 4.
+
+    Attributes:
+        size (int): The number of characters stored, counting one per line break.
+    """
+    def __init__(self, keyframe_interval=32, cache_size=4):
+        self.keyframe_interval = keyframe_interval
+        self.cache_size = cache_size
+        self.snapshots = []
+        self.current = None
+        self.current_id = None
+        self.cache = OrderedDict()
+        self.ids = itertools.count()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.snapshots) + (self.current is not None)
+
+    def __getstate__(self):
+        # Keyframes are pickled as one string rather than one per line, rebuilt snapshots are left out,
+        # and the IDs continue where they stopped
+        state = dict(self.__dict__)
+        state['snapshots'] = [
+            (snapshot.id, "\n".join(snapshot.lines) if snapshot.lines is not None else None, snapshot.start, snapshot.end, snapshot.inserted, snapshot.depth)
+            for snapshot in self.snapshots
+        ]
+        state['cache'] = None
+        state['ids'] = next(self.ids)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.snapshots = [
+            Snapshot(id, tuple(code.split("\n")) if code is not None else None, start, end, inserted, depth)
+            for id, code, start, end, inserted, depth in state['snapshots']
+        ]
+        self.cache = OrderedDict()
+        self.ids = itertools.count(state['ids'])
+
+    def __iter__(self):
+        yield from self.rebuild_range(0, len(self.snapshots))
+        if self.current is not None:
+            yield self.current
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            codes = list(self.rebuild_range(start, min(stop, len(self.snapshots))))
+            if start <= len(self.snapshots) < stop:
+                codes.append(self.current)
+            return codes
+        index = self.normalize(index)
+        if index == len(self.snapshots):
+            return self.current
+        return self.rebuild(index)[0]
+
+    def __setitem__(self, index, code):
+        if self.normalize(index) != len(self.snapshots):
+            raise IndexError("only the last snapshot of an edit history can be replaced")
+        self.size += len(code) - len(self.current)
+        self.current = code
+        self.current_id = next(self.ids)
+
+    def __delitem__(self, index):
+        index = self.normalize(index)
+        if index == len(self.snapshots):
+            self.pop()
+            return
+        snapshot = self.snapshots[index]
+        following = self.snapshots[index + 1] if index + 1 < len(self.snapshots) else None
+        if following is not None and following.lines is None:
+            lines = self.rebuild(index + 1)[1]
+        del self.snapshots[index]
+        self.cache.pop(snapshot.id, None)
+        self.size -= snapshot.size
+        if following is not None and following.lines is None:
+            # The next snapshot now follows the one before the deleted snapshot.
+            # A deleted keyframe is replaced by the next snapshot, so no chain of deltas gets longer.
+            self.size -= following.size
+            if index == 0 or snapshot.lines is not None:
+                following.lines, following.inserted, following.depth = lines, (), 0
+            else:
+                self.encode(following, self.rebuild(index - 1)[1], lines)
+            self.size += following.size
+
+    def key(self, index):
+        """
+        Identifies a snapshot and the snapshot before it, e.g. to cache renderings relative to the previous snapshot.
+
+        Args:
+            index (int): The index of the snapshot.
+
+        Returns:
+            tuple: The IDs of the previous snapshot (None for the first one) and of the snapshot.
+            They change whenever one of both snapshots is replaced or deleted.
+        """
+        index = self.normalize(index)
+        previous = self.snapshots[index - 1].id if index > 0 else None
+        current = self.current_id if index == len(self.snapshots) else self.snapshots[index].id
+        return previous, current
+
+    def keys(self):
+        return [self.key(index) for index in range(len(self))]
+
+    def append(self, code):
+        """
+        Commits the last snapshot and starts a new one.
+
+        Args:
+            code (str): The code of the new snapshot.
+        """
+        if self.current is not None:
+            self.commit()
+        self.current = code
+        self.current_id = next(self.ids)
+        self.size += len(code)
+
+    def pop(self, index=-1):
+        """
+        Removes a snapshot.
+
+        Args:
+            index (int, optional): The index of the snapshot. Defaults to -1.
+
+        Returns:
+            str: The code of the removed snapshot.
+        """
+        index = self.normalize(index)
+        code = self[index]
+        if index < len(self.snapshots):
+            del self[index]
+            return code
+        self.size -= len(self.current)
+        self.current = None
+        self.current_id = None
+        if self.snapshots:
+            # The last committed snapshot becomes the plain last snapshot again
+            last = self.snapshots[-1]
+            self.current, self.current_id = self.rebuild(len(self.snapshots) - 1)[0], last.id
+            self.snapshots.pop()
+            self.cache.pop(last.id, None)
+            self.size += len(self.current) - last.size
+        return code
+
+    def normalize(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("edit history index out of range")
+        return index
+
+    def encode(self, snapshot, previous, lines):
+        """
+        Stores a snapshot as the change from the lines of the previous snapshot.
+
+        Args:
+            snapshot (Snapshot): The snapshot.
+            previous (tuple): The lines of the previous snapshot.
+            lines (tuple): The lines of the snapshot, a tuple like `previous` so that their slices compare.
+        """
+        prefix, suffix = common_affix_lengths(previous, lines)
+        snapshot.lines = None
+        snapshot.start, snapshot.end = prefix, len(previous) - suffix
+        snapshot.inserted = tuple(lines[prefix:len(lines) - suffix])
+
+    def commit(self):
+        code, snapshot_id = self.current, self.current_id
+        self.size -= len(code)
+        lines = tuple(code.split("\n"))
+        snapshot = Snapshot(snapshot_id)
+        if self.snapshots:
+            last = self.snapshots[-1]
+            previous = self.rebuild(len(self.snapshots) - 1)[1]
+            self.encode(snapshot, previous, lines)
+            snapshot.depth = last.depth + 1
+            if snapshot.depth >= self.keyframe_interval:
+                # Reuse the line objects of the previous snapshot for the unchanged lines
+                snapshot.lines = previous[:snapshot.start] + snapshot.inserted + previous[snapshot.end:]
+                snapshot.inserted, snapshot.depth = (), 0
+        else:
+            snapshot.lines = lines
+        self.snapshots.append(snapshot)
+        self.size += snapshot.size
+        self.remember(snapshot.id, code, snapshot.lines if snapshot.lines is not None else lines)
+
+    def remember(self, snapshot_id, code, lines):
+        self.cache[snapshot_id] = (code, lines)
+        self.cache.move_to_end(snapshot_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def rebuild(self, index):
+        """
+        Rebuilds a committed snapshot from the closest keyframe or cached snapshot before it.
+
+        Args:
+            index (int): The index of the snapshot among the committed ones.
+
+        Returns:
+            tuple: The code and the lines of the snapshot.
+        """
+        snapshot_id = self.snapshots[index].id
+        cached = self.cache.get(snapshot_id)
+        if cached is not None:
+            self.cache.move_to_end(snapshot_id)
+            return cached
+        base = index
+        while True:
+            snapshot = self.snapshots[base]
+            if base != index and snapshot.id in self.cache:
+                lines = list(self.cache[snapshot.id][1])
+                break
+            if snapshot.lines is not None:
+                lines = list(snapshot.lines)
+                break
+            base -= 1
+        for snapshot in self.snapshots[base + 1:index + 1]:
+            lines[snapshot.start:snapshot.end] = snapshot.inserted
+        lines = tuple(lines)
+        code = "\n".join(lines)
+        self.remember(snapshot_id, code, lines)
+        return code, lines
+
+    def rebuild_range(self, start, stop):
+        """
+        Rebuilds consecutive committed snapshots, applying each delta once.
+
+        Args:
+            start (int): The index of the first snapshot.
+            stop (int): The index after the last snapshot.
+
+        Yields:
+            str: The code of each snapshot.
+        """
+        if start >= stop:
+            return
+        code, lines = self.rebuild(start)
+        yield code
+        lines = list(lines)
+        for snapshot in self.snapshots[start + 1:stop]:
+            cached = self.cache.get(snapshot.id)
+            if cached is not None:
+                code, lines = cached[0], list(cached[1])
+            elif snapshot.lines is not None:
+                lines = list(snapshot.lines)
+                code = "\n".join(lines)
+            else:
+                lines[snapshot.start:snapshot.end] = snapshot.inserted
+                code = "\n".join(lines)
+            yield code
@@ -0,0 +1,261 @@
+import re
+import uuid
+import time
+import asyncio
+from special_tokens import NEXT_START, NEXT_END, TARGET, TARGET_START, TARGET_END
+
+class EngineError(RuntimeError):
+    """
+    Raised by an in-process engine when a generation fails, where the HTTP client raises `httpx.HTTPError`.
+    """
+
+class Engine:
+    """
+    The interface shared by everything that serves `chat/completions` requests to the handlers.
+
+    Requests and responses keep the OpenAI JSON shapes, so the handlers, the suggestion cache and the prefill
+    warmer work the same with every engine. The HTTP engine is the `Router` over `UpstreamClient`s, which talks
+    to separate inference services. `VLLMEngine` runs the model in the backend process and `FakeEngine` answers
+    deterministically without a model.
+
+    Attributes:
+        inflight (int): The number of requests currently generating.
+        backends (list): The `Backend`s of a router, empty for in-process engines.
+    """
+    backends = []
+
+    def __init__(self):
+        self.inflight = 0
+        self.requests = 0
+
+    @property
+    def name(self):
+        raise NotImplementedError
+
+    async def start(self):
+        """
+        Loads the engine. Must be called from the running event loop.
+        """
+
+    async def close(self):
+        """
+        Stops the engine.
+        """
+
+    async def generate(self, data, request_id):
+        """
+        Generates the completions of a request.
+
+        Args:
+            data (dict): The JSON body of the `chat/completions` request.
+            request_id (str): A unique ID of the request.
+
+        Yields:
+            tuple: The full text of every choice so far and the token usage, after each step.
+        """
+        raise NotImplementedError
+
+    async def chat_completions(self, data, session_id=None):
+        """
+        Runs a `chat/completions` request.
+
+        Args:
+            data (dict): The JSON body of the request.
+            session_id (str, optional): The session the request belongs to. Unused by in-process engines.
+
+        Returns:
+            dict: The response in the OpenAI JSON shape, or None if the generation failed.
+        """
+        request_id = f"chatcmpl-{uuid.uuid4().hex}"
+        texts, usage = [""] * data.get('n', 1), {}
+        self.requests += 1
+        self.inflight += 1
+        try:
+            async for texts, usage in self.generate(data, request_id):
+                pass
+        except EngineError as e:
+            print(e)
+            return None
+        finally:
+            self.inflight -= 1
+        return {
+            'id': request_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': data.get('model'),
+            'choices': [{'index': i, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'} for i, text in enumerate(texts)],
+            'usage': usage,
+        }
+
+    async def stream_chat_completions(self, data, session_id=None, usage=None):
+        """
+        Runs a `chat/completions` request and yields the generated text of the first choice as it is generated.
+
+        Args:
+            data (dict): The JSON body of the request.
+            session_id (str, optional): The session the request belongs to. Unused by in-process engines.
+            usage (dict, optional): If given, the token usage is stored in it once the generation is finished.
+
+        Yields:
+            str: The new text of each step.
+
+        Raises:
+            EngineError: If the generation fails.
+        """
+        sent = 0
+        self.requests += 1
+        self.inflight += 1
+        try:
+            async for texts, step_usage in self.generate(dict(data, n=1), f"chatcmpl-{uuid.uuid4().hex}"):
+                if len(texts[0]) > sent:
+                    yield texts[0][sent:]
+                    sent = len(texts[0])
+                if usage is not None:
+                    usage.update(step_usage)
+        finally:
+            self.inflight -= 1
+
+    async def check_health(self):
+        return True
+
+    def stats(self):
+        """
+        Returns the state of the engine, in the shape of `Router.stats`.
+
+        Returns:
+            list: The name, outstanding and total requests of the engine.
+        """
+        return [{'base': self.name, 'weight': 1.0, 'inflight': self.inflight, 'requests': self.requests, 'healthy': True, 'circuit_open': False, 'failures': 0}]
+
+class VLLMEngine(Engine):
+    """
+    Runs the model in the backend process with the vLLM `AsyncLLMEngine`, without an HTTP hop and a JSON encoding
+    of every prompt. The prompt is rendered with the chat template named by the request (`assistant-conversation`),
+    and the request options (`stop`, `skip_special_tokens`, sampling, `n`, `priority`) map to `SamplingParams`.
+    Requests go through the scheduler of the engine, so they share its prefix cache. A generation is aborted when its
+    consumer stops reading, e.g. when a tab request is superseded.
+
+    Args:
+        model (str): The model name or path.
+        engine_args (dict, optional): Keyword arguments of `vllm.AsyncEngineArgs`. Prefix caching is enabled unless set. Defaults to None.
+    """
+    def __init__(self, model, engine_args=None):
+        super().__init__()
+        self.model = model
+        self.engine_args = dict(engine_args or {})
+        self.engine_args.setdefault('enable_prefix_caching', True)
+        self.engine = None
+        self.tokenizer = None
+
+    @property
+    def name(self):
+        return f"vllm:{self.model}"
+
+    async def start(self):
+        if self.engine is not None:
+            return
+        # vLLM is only needed by this engine, and importing it is slow
+        from vllm import AsyncEngineArgs, AsyncLLMEngine
+        self.engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(model=self.model, **self.engine_args))
+        self.tokenizer = await self.engine.get_tokenizer()
+
+    async def close(self):
+        if self.engine is not None:
+            # `shutdown` in the V1 engine, `shutdown_background_loop` in the V0 one
+            shutdown = getattr(self.engine, "shutdown", None) or getattr(self.engine, "shutdown_background_loop", None)
+            if shutdown is not None:
+                shutdown()
+            self.engine = None
+
+    def sampling_params(self, data):
+        from vllm import SamplingParams
+        return SamplingParams(
+            n=data.get('n', 1),
+            temperature=data.get('temperature', 1.0),
+            top_p=data.get('top_p', 1.0),
+            max_tokens=data.get('max_tokens'),
+            frequency_penalty=data.get('frequency_penalty', 0.0),
+            presence_penalty=data.get('presence_penalty', 0.0),
+            stop=data.get('stop'),
+            skip_special_tokens=data.get('skip_special_tokens', True),
+        )
+
+    async def generate(self, data, request_id):
+        await self.start()
+        prompt = self.tokenizer.apply_chat_template(
+            data['messages'],
+            chat_template=data.get('chat_template'),
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        kwargs = {'priority': data['priority']} if data.get('priority') is not None else {}
+        try:
+            async for output in self.engine.generate(prompt, self.sampling_params(data), request_id, **kwargs):
+                usage = {
+                    'prompt_tokens': len(output.prompt_token_ids),
+                    'completion_tokens': sum(len(completion.token_ids) for completion in output.outputs),
+                }
+                yield [completion.text for completion in output.outputs], usage
+        except (ValueError, RuntimeError) as e:
+            raise EngineError(str(e)) from e
+
+class FakeEngine(Engine):
+    """
+    A deterministic engine for tests and local development, answering without a model.
+
+    Edit requests (with a `current` message) get a Whole-File output of their current code, without target markers,
+    line numbers and elision lines, passed through `edit`. Chat requests get `reply` applied to the last message.
+    Outputs are streamed in chunks of `chunk_size` characters, `delay` seconds apart. Every request body is kept in `received`.
+
+    Args:
+        edit (callable, optional): Maps the current code to the suggested code. Defaults to None, for no change.
+        reply (callable, optional): Maps the last chat message to the reply. Defaults to None, for an echo.
+        delay (float, optional): Seconds between two chunks. Defaults to 0.0.
+        chunk_size (int, optional): Characters per chunk. Defaults to 16.
+    """
+    def __init__(self, edit=None, reply=None, delay=0.0, chunk_size=16):
+        super().__init__()
+        self.edit = edit or (lambda code: code)
+        self.reply = reply or (lambda text: f"Echo: {text}")
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.received = []
+
+    @property
+    def name(self):
+        return "fake"
+
+    @staticmethod
+    def current_code(content):
+        """
+        Extracts the code of a decorated `current` message.
+        """
+        body = content.split("\n", 1)[1].rsplit("\n```", 1)[0] if "\n" in content else ""
+        for token in (TARGET, TARGET_START, TARGET_END):
+            body = body.replace(token, "")
+        lines = [line for line in body.split("\n") if line != "..."]
+        if lines and all(re.match(r"\d+( |$)", line) for line in lines):
+            lines = [line.split(" ", 1)[1] if " " in line else "" for line in lines]
+        return "\n".join(lines)
+
+    def respond(self, data):
+        messages = data['messages']
+        current = [message['content'] for message in messages if message['role'] == 'current']
+        if current:
+            return f"{NEXT_START}```\n{self.edit(self.current_code(current[-1]))}\n```{NEXT_END}"
+        return self.reply(messages[-1]['content'] if messages else "")
+
+    async def generate(self, data, request_id):
+        self.received.append(data)
+        output = self.respond(data)
+        # The stop sequence is not part of the output, as with the inference services
+        output = output.split(NEXT_END)[0] if NEXT_END in (data.get('stop') or []) else output
+        max_chars = data['max_tokens'] * 4 if data.get('max_tokens') else len(output)
+        output = output[:max_chars]
+        prompt_tokens = sum(len(message['content']) for message in data['messages']) // 4
+        n = data.get('n', 1)
+        for end in range(self.chunk_size, len(output) + self.chunk_size, self.chunk_size):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            text = output[:end]
+            yield [text] * n, {'prompt_tokens': prompt_tokens, 'completion_tokens': n * ((len(text) + 3) // 4)}
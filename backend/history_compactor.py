@@ -0,0 +1,114 @@
+from utils import decorate_code, estimate_tokens, changed_line_range, common_affix_lengths
+
+def changed_chars(code1, code2):
+    """
+    Measures how much of a file an edit touched.
+
+    Args:
+        code1 (str): The code before the edit.
+        code2 (str): The code after the edit.
+
+    Returns:
+        int: The length of the changed region between the common prefix and suffix of both codes.
+    """
+    prefix, suffix = common_affix_lengths(code1, code2)
+    return max(len(code1), len(code2)) - prefix - suffix
+
+class HistoryCompactor:
+    """
+    Chooses and renders the history snapshots of a prompt under a token budget, instead of a fixed number of snapshots.
+
+    - Each snapshot is rendered relative to the snapshot before it: a snapshot larger than `snapshot_tokens` only
+      shows the lines its edit changed, with `margin` lines around them and `...` for the rest. The rendering only
+      depends on committed snapshots, so it is cached and byte-identical in every request.
+    - When a snapshot is committed and its edit is small, it absorbs the previous small edit,
+      as long as the merged edit stays within `merge_chars`.
+    - The prompt starts at a sticky snapshot. Only when the history outgrows the budget, the start jumps forward
+      until the history uses at most `1 - drop_fraction` of the budget, so most requests share the prompt prefix.
+
+    Args:
+        budget (int): The token budget of the history.
+        snapshot_tokens (int, optional): Snapshots up to this many tokens are shown whole. Defaults to None, for an eighth of the budget.
+        merge_chars (int, optional): Maximum size in characters of a merged edit, 0 to never merge. Defaults to 64.
+        margin (int, optional): Unchanged lines shown around an edit. Defaults to 3.
+        drop_fraction (float, optional): Part of the budget freed when the start jumps forward. Defaults to 0.5.
+    """
+    def __init__(self, budget, snapshot_tokens=None, merge_chars=64, margin=3, drop_fraction=0.5):
+        self.budget = budget
+        self.snapshot_tokens = snapshot_tokens if snapshot_tokens is not None else budget // 8
+        self.merge_chars = merge_chars
+        self.margin = margin
+        self.drop_fraction = drop_fraction
+
+    def merge(self, session):
+        """
+        Merges the edit of the snapshot just committed with the previous edit if both are small.
+        Called right after a new snapshot was started.
+
+        Args:
+            session (SessionState): The session whose history was updated.
+        """
+        history = session.history
+        # history[-1] is the new snapshot, history[-2] was just committed and history[-3] is the candidate to drop.
+        # The first snapshot of the prompt is kept, dropping it would change the whole cached prefix.
+        index = len(history) - 3
+        if self.merge_chars <= 0 or index < 1 or index <= session.history_start:
+            return
+        if changed_chars(history[index - 1], history[index + 1]) <= self.merge_chars:
+            del history[index]
+
+    def render(self, session, index):
+        """
+        Renders one committed snapshot of a session.
+
+        Args:
+            session (SessionState): The session.
+            index (int): The index of the snapshot in the history.
+
+        Returns:
+            str: The decorated snapshot.
+        """
+        history = session.history
+        key = history.key(index)
+        rendered = session.history_renders.get(key)
+        if rendered is None:
+            code = history[index]
+            previous = history[index - 1] if index > 0 else None
+            if previous is None or estimate_tokens(code) <= self.snapshot_tokens:
+                rendered = decorate_code(code)
+            else:
+                start, end = changed_line_range(code, previous, self.margin, self.budget // 2)
+                rendered = decorate_code(code, start_line=start, end_line=end)
+            session.history_renders[key] = rendered
+        return rendered
+
+    def select(self, session):
+        """
+        Chooses the history snapshots of the next prompt of a session and renders them.
+
+        Args:
+            session (SessionState): The session, whose last snapshot is the current code.
+
+        Returns:
+            list: The decorated snapshots, oldest first.
+        """
+        committed = len(session.history) - 1
+        start = min(session.history_start, max(committed, 0))
+        rendered = [self.render(session, index) for index in range(start, committed)]
+        costs = [estimate_tokens(content) for content in rendered]
+        total = sum(costs)
+        if total > self.budget:
+            target = self.budget * (1 - self.drop_fraction)
+            drop = 0
+            while drop < len(costs) and total > target:
+                total -= costs[drop]
+                drop += 1
+            start += drop
+            rendered = rendered[drop:]
+        session.history_start = start
+
+        # Forget the renderings of snapshots that were merged or dropped
+        if len(session.history_renders) > 2 * len(session.history) + 8:
+            keep = set(session.history.keys())
+            session.history_renders = {key: value for key, value in session.history_renders.items() if key in keep}
+        return rendered
@@ -0,0 +1,137 @@
+"""
+A local stand-in for the OpenAI-compatible `chat/completions` service, for load tests without a GPU.
+
+Edit requests (with a `current` message) get a `NEXT_START`/`NEXT_END` output in the chosen modification format,
+which inserts a comment line after the first line of the current code. Chat requests get a fixed reply.
+Outputs are generated at `--token_rate` tokens per second after `--latency` seconds, streamed or not,
+with about four characters per token. With `--prediction accept`, requests with a predicted output report
+the accepted and rejected prediction tokens like OpenAI predicted outputs; with `--prediction reject`, they are
+answered with a 400 error, like a server without predicted outputs.
+
+Usage (from the backend directory):
+    python loadtest/mock_server.py --port 10086 --latency 0.05 --token_rate 200 --format wf
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse, JSONResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from special_tokens import NEXT_START, NEXT_END, TARGET, TARGET_START, TARGET_END, SEARCH_AND_REPLACE
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+parser.add_argument("--port", type=int, default=10086, help="Port to listen on")
+parser.add_argument("--latency", type=float, default=0.05, help="Seconds before the first token")
+parser.add_argument("--token_rate", type=float, default=200, help="Generated tokens per second of one request")
+parser.add_argument("--format", type=str, default="wf", choices=["wf", "lc", "sr"], help="Modification format of edit outputs")
+parser.add_argument("--chat_tokens", type=int, default=64, help="Length of chat replies in tokens")
+parser.add_argument("--prediction", type=str, default="accept", choices=["accept", "reject", "ignore"], help="How requests with a predicted output are answered")
+parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with a 500 error")
+args = parser.parse_args()
+
+app = FastAPI()
+served = 0
+
+def current_code(messages):
+    """
+    Extracts the current code of an edit request, without target markers, elision lines and line numbers.
+    """
+    content = [message['content'] for message in messages if message['role'] == 'current'][-1]
+    body = content.split("\n", 1)[1].rsplit("\n```", 1)[0] if "\n" in content else ""
+    for token in (TARGET, TARGET_START, TARGET_END):
+        body = body.replace(token, "")
+    lines = [line for line in body.split("\n") if line != "..."]
+    if lines and all(re.match(r"\d+ ", line) or re.fullmatch(r"\d+", line) for line in lines):
+        lines = [line.split(" ", 1)[1] if " " in line else "" for line in lines]
+    return lines
+
+def edit_output(messages):
+    """
+    Builds the model output of an edit request in the chosen format.
+    """
+    lines = current_code(messages) or [""]
+    comment = "# edited by the mock server"
+    if args.format == "lc":
+        return f"{NEXT_START}0,1\n```python\n{lines[0]}\n{comment}\n```{NEXT_END}"
+    if args.format == "sr":
+        return f"{NEXT_START}```python\n{lines[0]}\n{SEARCH_AND_REPLACE}\n{lines[0]}\n{comment}\n```{NEXT_END}"
+    body = "\n".join(lines[:1] + [comment] + lines[1:])
+    return f"{NEXT_START}```python\n{body}\n```{NEXT_END}"
+
+def prediction_details(prediction, output):
+    """
+    Counts the output tokens covered by the common prefix and suffix of the predicted output as accepted, the other predicted tokens as rejected.
+    """
+    prefix = len(os.path.commonprefix([prediction, output]))
+    suffix = len(os.path.commonprefix([prediction[prefix:][::-1], output[prefix:][::-1]]))
+    accepted = (prefix + suffix) // 4
+    return {'accepted_prediction_tokens': accepted, 'rejected_prediction_tokens': max(len(prediction) // 4 - accepted, 0)}
+
+def chat_output():
+    return " ".join(["word"] * args.chat_tokens)
+
+def tokens(text, max_tokens):
+    """
+    Splits an output into tokens of four characters, truncated to `max_tokens`.
+    """
+    pieces = [text[i:i + 4] for i in range(0, len(text), 4)]
+    return pieces[:max_tokens] if max_tokens else pieces
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    global served
+    data = await request.json()
+    served += 1
+    # Every 1 / error_rate-th request fails
+    if int(served * args.error_rate) != int((served - 1) * args.error_rate):
+        return JSONResponse({'error': {'message': "mock upstream error"}}, status_code=500)
+    prediction = data.get('prediction')
+    if prediction is not None and args.prediction == "reject":
+        return JSONResponse({'error': {'message': "Unrecognized request argument supplied: prediction"}}, status_code=400)
+
+    messages = data['messages']
+    is_edit = any(message['role'] == 'current' for message in messages)
+    output = edit_output(messages) if is_edit else chat_output()
+    pieces = tokens(output, data.get('max_tokens'))
+    usage = {'prompt_tokens': sum(len(message['content']) for message in messages) // 4, 'completion_tokens': len(pieces)}
+    if prediction is not None and args.prediction == "accept":
+        usage['completion_tokens_details'] = prediction_details(prediction['content'], "".join(pieces))
+    n = data.get('n', 1)
+
+    if data.get('stream'):
+        # Timers are not precise below a few milliseconds, so fast rates send several tokens per event
+        per_event = max(1, int(args.token_rate * 0.01))
+        async def generate():
+            await asyncio.sleep(args.latency)
+            for i in range(0, len(pieces), per_event):
+                chunk = {'choices': [{'index': 0, 'delta': {'content': "".join(pieces[i:i + per_event])}, 'finish_reason': None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(per_event / args.token_rate)
+            yield f"data: {json.dumps({'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    await asyncio.sleep(args.latency + len(pieces) / args.token_rate)
+    return {
+        'id': f"mock-{served}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': data.get('model'),
+        'choices': [{'index': i, 'message': {'role': 'assistant', 'content': "".join(pieces)}, 'finish_reason': 'stop'} for i in range(n)],
+        'usage': usage,
+    }
+
+@app.get("/v1/models")
+async def models():
+    return {'object': 'list', 'data': [{'id': 'mock', 'object': 'model'}]}
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,244 @@
+"""
+End-to-end load test of the backend: many simulated editors replay editing traces against `/api/tab`,
+`/api/inline` and `/api/chat` at once, for increasing numbers of editors.
+
+For every concurrency level and endpoint, reports the p50/p95/p99 latency, the throughput and the error rate.
+Errors are requests that failed at the HTTP level. The backend answers failed upstream calls with the unchanged
+code, so upstream errors (`--mock_args "--error_rate 0.1"`) show up as backend statistics rather than here.
+With `--spawn`, the mock `chat/completions` server (`mock_server.py`) and the backend are started locally,
+so no GPU or network access is needed.
+
+A trace is a JSONL file with one request per line, replayed in order per session:
+    {"session": "editor-0", "endpoint": "tab", "delay": 0.2, "body": {"code": "...", "area": [10, 10]}}
+`endpoint` is "tab", "inline" or "chat", `delay` is the think time in seconds before the request, and `body`
+is the JSON body of the request without `session_id`. Without `--trace`, synthetic typing sessions are used.
+
+Usage (from the backend directory):
+    python loadtest/run.py --spawn --concurrency 1 8 32 --backend_args "--format wf"
+    python loadtest/run.py --url http://127.0.0.1:8000 --trace trace.jsonl --concurrency 4 16 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import shlex
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate_code, typing_session
+
+ENDPOINTS = ["tab", "inline", "chat"]
+
+def generate_trace(num_sessions, num_events, lines, seed=0):
+    """
+    Generate synthetic editing traces: typing bursts with a tab request every few keystrokes,
+    and occasional inline and chat requests.
+
+    Args:
+        num_sessions (int): The number of sessions.
+        num_events (int): The number of requests per session.
+        lines (int): The size of the edited file in lines.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        list: The requests, as dictionaries in the trace format.
+    """
+    trace = []
+    for session in range(num_sessions):
+        rng = random.Random(seed + session)
+        states = typing_session(generate_code(lines, seed=seed + session), num_bursts=max(num_events // 4, 1), burst_length=12, seed=seed + session, delete_length=3)
+        for i, code in enumerate(states[::3][:num_events]):
+            offset = rng.randint(0, len(code))
+            kind = rng.random()
+            if kind < 0.05:
+                event = {'endpoint': "chat", 'body': {'text': "What does this function do?"}}
+            elif kind < 0.15:
+                event = {'endpoint': "inline", 'body': {'code': code, 'area': [offset, offset], 'instruction': "Add error handling"}}
+            else:
+                event = {'endpoint': "tab", 'body': {'code': code, 'area': [offset, offset]}}
+            trace.append({'session': f"editor-{session}", 'delay': round(rng.uniform(0.05, 0.3), 3), **event})
+    return trace
+
+def load_trace(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def group_sessions(trace):
+    sessions = {}
+    for event in trace:
+        sessions.setdefault(event['session'], []).append(event)
+    return list(sessions.values())
+
+async def send(client, url, event, session_id, stream):
+    """
+    Send one request of a trace.
+
+    Returns:
+        dict: The endpoint, whether it succeeded, the latency and the time to the first byte in seconds.
+    """
+    body = dict(event['body'], session_id=session_id, stream=stream)
+    start = time.perf_counter()
+    first = None
+    try:
+        async with client.stream("POST", f"{url}/api/{event['endpoint']}", json=body) as response:
+            async for _ in response.aiter_bytes():
+                if first is None:
+                    first = time.perf_counter() - start
+            ok = response.status_code == 200
+    except httpx.HTTPError:
+        ok = False
+    latency = time.perf_counter() - start
+    return {'endpoint': event['endpoint'], 'ok': ok, 'latency': latency, 'ttfb': first if first is not None else latency}
+
+async def editor(client, url, events, session_id, stream, time_scale, samples):
+    for event in events:
+        await asyncio.sleep(event.get('delay', 0) * time_scale)
+        samples.append(await send(client, url, event, session_id, stream))
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def summarize(samples, elapsed):
+    """
+    Aggregate the samples of one concurrency level per endpoint and overall.
+
+    Returns:
+        dict: Per endpoint, the number of requests, the error rate, the latency percentiles in milliseconds and the throughput.
+    """
+    summary = {}
+    for endpoint in ENDPOINTS + ["all"]:
+        selected = [sample for sample in samples if endpoint == "all" or sample['endpoint'] == endpoint]
+        if not selected:
+            continue
+        latencies = [sample['latency'] * 1000 for sample in selected if sample['ok']]
+        summary[endpoint] = {
+            'requests': len(selected),
+            'error_rate': sum(not sample['ok'] for sample in selected) / len(selected),
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'ttfb_p50_ms': percentile([sample['ttfb'] * 1000 for sample in selected if sample['ok']], 0.50),
+            'throughput_rps': len(latencies) / elapsed,
+        }
+    return summary
+
+async def run_level(url, sessions, concurrency, stream, time_scale, timeout):
+    """
+    Replay the traces with `concurrency` simulated editors, each with its own session.
+
+    Returns:
+        tuple: The samples and the elapsed wall time in seconds.
+    """
+    samples = []
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            editor(client, url, sessions[i % len(sessions)], f"load-{concurrency}-{i}", stream, time_scale, samples)
+            for i in range(concurrency)
+        ))
+        elapsed = time.perf_counter() - start
+    return samples, elapsed
+
+def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start within {timeout} seconds")
+
+def spawn(args):
+    """
+    Start the mock server and the backend.
+
+    Returns:
+        list: The started processes.
+    """
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(backend_dir, "loadtest", "mock_server.py"), "--port", str(args.mock_port)] + shlex.split(args.mock_args),
+    )
+    model_map = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump({"mock": {"base": f"http://127.0.0.1:{args.mock_port}/v1", "api": "sk-mock"}}, model_map)
+    model_map.close()
+    backend = subprocess.Popen(
+        [sys.executable, "main.py", "--model_map", model_map.name, "--port", str(args.port)] + shlex.split(args.backend_args),
+        cwd=backend_dir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    processes = [mock, backend]
+    try:
+        wait_ready(f"http://127.0.0.1:{args.mock_port}/v1/models")
+        wait_ready(f"http://127.0.0.1:{args.port}/api/stats")
+    except RuntimeError:
+        for process in processes:
+            process.terminate()
+        raise
+    return processes
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default=None, help="Base URL of a running backend, defaults to the spawned one")
+    parser.add_argument("--spawn", action="store_true", help="Start the mock server and the backend locally")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the spawned backend")
+    parser.add_argument("--mock_port", type=int, default=18765, help="Port of the spawned mock server")
+    parser.add_argument("--mock_args", type=str, default="", help="Extra arguments of the mock server, e.g. \"--latency 0.1 --token_rate 100\"")
+    parser.add_argument("--backend_args", type=str, default="", help="Extra arguments of the backend")
+    parser.add_argument("--trace", type=str, default=None, help="JSONL trace to replay, defaults to synthetic sessions")
+    parser.add_argument("--save_trace", type=str, default=None, help="Save the synthetic trace to this JSONL file")
+    parser.add_argument("--sessions", type=int, default=8, help="Number of synthetic sessions")
+    parser.add_argument("--events", type=int, default=20, help="Requests per synthetic session")
+    parser.add_argument("--lines", type=int, default=300, help="File size of the synthetic sessions in lines")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64], help="Numbers of simultaneous editors")
+    parser.add_argument("--stream", action="store_true", help="Send streaming requests")
+    parser.add_argument("--time_scale", type=float, default=1.0, help="Multiplier of the think times of the trace, 0 to send requests back to back")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Request timeout in seconds")
+    parser.add_argument("--output", type=str, default=None, help="Save the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = generate_trace(args.sessions, args.events, args.lines)
+        if args.save_trace:
+            with open(args.save_trace, "w") as f:
+                for event in trace:
+                    f.write(json.dumps(event) + "\n")
+    sessions = group_sessions(trace)
+
+    processes = spawn(args) if args.spawn else []
+    url = args.url or f"http://127.0.0.1:{args.port}"
+    results = []
+    try:
+        print(f"{'editors':>7} {'endpoint':>8} {'requests':>8} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ttfb p50':>9} {'req/s':>7}")
+        for concurrency in args.concurrency:
+            samples, elapsed = asyncio.run(run_level(url, sessions, concurrency, args.stream, args.time_scale, args.timeout))
+            summary = summarize(samples, elapsed)
+            results.append({'concurrency': concurrency, 'elapsed': elapsed, 'endpoints': summary})
+            for endpoint, stats in summary.items():
+                print(f"{concurrency:>7} {endpoint:>8} {stats['requests']:>8} {stats['error_rate']:>7.1%} {stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f} {stats['ttfb_p50_ms']:>9.1f} {stats['throughput_rps']:>7.1f}", flush=True)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'url': url, 'stream': args.stream, 'results': results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,87 +1,889 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+import asyncio
+from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from special_tokens import *
-from utils import decorate_code, postprocess_output_wf, blockwise_if_continuous_modify
+from utils import decorate_code, postprocess_output, postprocess_stream_wf, blockwise_if_continuous_modify, generate_hunks, apply_hunks, estimate_tokens, window_around, changed_line_range, splice_stream_prefix, common_affix_lengths
+from upstream import UpstreamClient
+from router import Backend, Router
+from engine import EngineError, VLLMEngine, FakeEngine
+from session_store import SessionStore, SQLiteSessionStore
+from suggestion_cache import SuggestionCache
+from prefill_warmer import PrefillWarmer
+from history_compactor import HistoryCompactor
+from chat_context import ChatContext
+from candidates import rank_candidates
+from scheduler import AdmissionScheduler, Shed
+from document import TextDocument
+from metrics import Registry, Counter, Gauge, Histogram
+from affinity import run_workers
+import os
+import sys
 import json
+import time
+import shlex
+import httpx
 import uvicorn
 import argparse
-import requests
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--model_map", type=str, help="Model name, base and port")
+parser.add_argument("--model_map", type=str, help="Model name, base and port, or a list of backends with weights")
+parser.add_argument("--engine", type=str, default="http", choices=["http", "vllm", "fake"], help="Serve requests through the inference services of --model_map over HTTP, with vLLM in this process (the model of --model_map), or with a deterministic fake model")
+parser.add_argument("--engine_args", type=str, default="{}", help="With --engine vllm, JSON keyword arguments of vllm.AsyncEngineArgs, e.g. '{\"gpu_memory_utilization\": 0.8}'")
+parser.add_argument("--host", type=str, default="0.0.0.0", help="Host the server listens on")
+parser.add_argument("--port", type=int, default=8000, help="Port the server listens on")
 parser.add_argument("--use_target_area", action="store_true", help="Whether to use target area")
 parser.add_argument("--sliding_window", type=int, default=2, help="Sliding window size")
+parser.add_argument("--format", type=str, default="wf", choices=["wf", "lc", "auto"], help="Modification format the prompt asks for: Whole-File, Location-and-Change (numbered lines), or chosen by file length. Search-and-Replace outputs are detected and applied in every format")
+parser.add_argument("--format_auto_lines", type=int, default=200, help="With --format auto, files longer than this use Location-and-Change instead of Whole-File")
+parser.add_argument("--history_tokens", type=int, default=0, help="Token budget of the edit history in the prompt, replacing --sliding_window, 0 to use the sliding window")
+parser.add_argument("--history_merge_chars", type=int, default=64, help="With --history_tokens, consecutive edits are merged while they change at most this many characters, 0 to never merge")
+parser.add_argument("--history_drop_fraction", type=float, default=0.5, help="With --history_tokens, part of the budget freed when old history is dropped")
+parser.add_argument("--context_budget", type=int, default=0, help="Token budget of the current code shown to the model, centered on the cursor, 0 to always send whole files")
+parser.add_argument("--history_budget", type=int, default=0, help="With --context_budget, token budget of a history snapshot clipped to the region it changed, 0 for a quarter of --context_budget")
+parser.add_argument("--context_margin", type=int, default=8, help="Unchanged lines kept around the changed region of a clipped history snapshot")
+parser.add_argument("--chat_tokens", type=int, default=0, help="Token budget of the chat conversation, older turns are summarized in the background, 0 to send the whole conversation")
+parser.add_argument("--chat_summary_tokens", type=int, default=256, help="With --chat_tokens, max tokens of the summary of older turns, 0 to drop them without a summary")
+parser.add_argument("--chat_drop_fraction", type=float, default=0.5, help="With --chat_tokens, part of the budget freed when older turns are summarized")
+parser.add_argument("--chat_system_prompt", type=str, default=None, help="System prompt of chat requests")
+parser.add_argument("--predicted_output", action="store_true", help="Send the current code as a predicted output with Whole-File requests, so that servers with speculative decoding copy unchanged lines instead of decoding them")
 parser.add_argument("--max_tokens", type=int, default=3072, help="Max tokens")
 parser.add_argument("--temperature", type=float, default=0.0, help="Temperature")
 parser.add_argument("--top_p", type=float, default=1.0, help="Top-p sampling")
 parser.add_argument("--frequency_penalty", type=float, default=0, help="Frequency penalty")
 parser.add_argument("--presence_penalty", type=float, default=0, help="Presence penalty")
-args = parser.parse_args()
+parser.add_argument("--pool_size", type=int, default=100, help="Max concurrent connections to the model service")
+parser.add_argument("--pool_keepalive", type=int, default=20, help="Max idle keep-alive connections to the model service")
+parser.add_argument("--keepalive_expiry", type=float, default=30.0, help="Seconds an idle keep-alive connection is kept open")
+parser.add_argument("--connect_timeout", type=float, default=5.0, help="Timeout in seconds for connecting to the model service")
+parser.add_argument("--read_timeout", type=float, default=300.0, help="Timeout in seconds for reading a response from the model service")
+parser.add_argument("--sticky_slack", type=float, default=4, help="Outstanding requests (per unit of weight) the sticky backend of a session may have above the least loaded one")
+parser.add_argument("--route_retries", type=int, default=1, help="Number of other backends a failed request is retried on")
+parser.add_argument("--health_interval", type=float, default=10.0, help="Seconds between two health checks of the backends, 0 to disable them")
+parser.add_argument("--failure_threshold", type=int, default=3, help="Consecutive failures after which a backend gets no traffic for --circuit_cooldown seconds")
+parser.add_argument("--circuit_cooldown", type=float, default=10.0, help="Seconds a failing backend gets no traffic")
+parser.add_argument("--max_inflight", type=int, default=0, help="Maximum upstream requests at once, the others wait by priority (inline > chat > tab > warmup), 0 to send every request at once")
+parser.add_argument("--session_inflight", type=int, default=2, help="With --max_inflight, maximum upstream requests of one session at once, 0 for no limit")
+parser.add_argument("--tab_queue_deadline", type=float, default=0.3, help="With --max_inflight, seconds a tab request may wait before it is answered with no suggestion")
+parser.add_argument("--workers", type=int, default=1, help="Worker processes handling requests, behind a proxy sending the requests of each session to the same worker")
+parser.add_argument("--session_backend", type=str, default="memory", choices=["memory", "sqlite"], help="Keep sessions in the memory of each worker, or share them between workers through the SQLite database --session_db")
+parser.add_argument("--session_db", type=str, default="sessions.db", help="With --session_backend sqlite, path of the session database")
+parser.add_argument("--session_max_chars", type=int, default=4_000_000, help="Per-session memory cap in characters, 0 for no cap")
+parser.add_argument("--total_max_chars", type=int, default=512_000_000, help="Memory cap in characters over all sessions, 0 for no cap")
+parser.add_argument("--session_ttl", type=float, default=3600, help="Seconds after which an idle session is evicted, 0 to keep sessions forever")
+parser.add_argument("--tab_candidates", type=int, default=1, help="Suggestions requested per non-streaming tab request in one upstream call, ranked locally and cycled through /api/tab/cycle (use with --temperature > 0)")
+parser.add_argument("--tab_cache_size", type=int, default=1024, help="Number of cached tab suggestions, 0 to disable the cache (only used with temperature 0)")
+parser.add_argument("--tab_cache_ttl", type=float, default=300, help="Seconds a cached tab suggestion stays valid")
+parser.add_argument("--prefill_warmup", action="store_true", help="Whether to pre-prefill the history of the next sliding window in the background")
+parser.add_argument("--warmup_interval", type=float, default=2.0, help="Minimum seconds between two warmup requests of one session")
+parser.add_argument("--warmup_max_load", type=int, default=4, help="Skip warmups while this many upstream requests are in flight")
+parser.add_argument("--warmup_priority", type=int, default=None, help="Priority sent with warmup requests, for inference services with priority scheduling")
 
-with open(args.model_map, "r") as f:
-    model_map = json.load(f)
+# The options and the state of the process, set by `configure`
+args = None
+model_map = None
+model = None
+backend_configs = None
+upstream = None
+scheduler = None
+sessions = None
+suggestion_cache = None
+compactor = None
+warmer = None
+chat_context = None
 
-model = list(model_map.keys())[0]
-api_key = model_map[model]['api']
-base_url = model_map[model]['base']
-if not base_url.endswith('/'):
-    base_url += '/'
-url = f"{base_url}chat/completions"
+def create_upstream():
+    """
+    Creates the engine serving the `chat/completions` requests of all handlers, see `Engine`.
+
+    Returns:
+        Router, VLLMEngine or FakeEngine: The engine chosen by `args.engine`.
+    """
+    if args.engine == "vllm":
+        return VLLMEngine(model, json.loads(args.engine_args))
+    if args.engine == "fake":
+        return FakeEngine()
+    # One pooled, keep-alive client per backend, shared by all handlers through the router
+    return Router(
+        [
+            Backend(
+                UpstreamClient(
+                    config['base'],
+                    config.get('api', model_map[model].get('api')),
+                    pool_size=args.pool_size,
+                    keepalive=args.pool_keepalive,
+                    keepalive_expiry=args.keepalive_expiry,
+                    connect_timeout=args.connect_timeout,
+                    read_timeout=args.read_timeout,
+                ),
+                weight=config.get('weight', 1.0),
+                failure_threshold=args.failure_threshold,
+                cooldown=args.circuit_cooldown,
+            )
+            for config in backend_configs
+        ],
+        sticky_slack=args.sticky_slack,
+        retries=args.route_retries,
+        health_interval=args.health_interval,
+    )
+
+def configure(options):
+    """
+    Creates the engine and the state of the process from the options.
+
+    Args:
+        options (argparse.Namespace): The parsed command line options.
+    """
+    global args, model_map, model, backend_configs, upstream, scheduler, sessions, suggestion_cache, compactor, warmer, chat_context
+    args = options
+
+    if args.model_map:
+        with open(args.model_map, "r") as f:
+            model_map = json.load(f)
+    elif args.engine == "fake":
+        model_map = {"fake": {}}
+    else:
+        parser.error(f"--model_map is required with --engine {args.engine}")
+
+    model = list(model_map.keys())[0]
+    # Either a single service ("base", "api") or several ones ("backends": [{"base", "api", "weight"}, ...])
+    backend_configs = model_map[model].get('backends', [model_map[model]])
+
+    upstream = create_upstream()
+
+    # Admission control in front of the model, so that tab and background requests cannot starve explicit user actions
+    if args.max_inflight > 0:
+        scheduler = AdmissionScheduler(
+            args.max_inflight,
+            session_limit=args.session_inflight,
+            deadlines={'tab': args.tab_queue_deadline, 'warmup': 0.0},
+        )
+    else:
+        scheduler = None
+
+    # Edit history and chat history of every client, keyed by the session ID sent by the frontend
+    caps = {'session_max_chars': args.session_max_chars, 'total_max_chars': args.total_max_chars, 'ttl': args.session_ttl}
+    if args.session_backend == "sqlite":
+        sessions = SQLiteSessionStore(args.session_db, **caps)
+    else:
+        sessions = SessionStore(**caps)
+
+    # Tab suggestions are deterministic at temperature 0, so identical prompts can reuse earlier results
+    if args.tab_cache_size > 0 and args.temperature == 0:
+        suggestion_cache = SuggestionCache(max_entries=args.tab_cache_size, ttl=args.tab_cache_ttl)
+    else:
+        suggestion_cache = None
+
+    # Packs as much edit history as fits a token budget, with a prompt prefix that stays stable between requests
+    if args.history_tokens > 0:
+        compactor = HistoryCompactor(args.history_tokens, merge_chars=args.history_merge_chars, drop_fraction=args.history_drop_fraction)
+    else:
+        compactor = None
+
+    if args.prefill_warmup:
+        warmer = PrefillWarmer(upstream, min_interval=args.warmup_interval, max_load=args.warmup_max_load, priority=args.warmup_priority, scheduler=scheduler)
+    else:
+        warmer = None
 
-headers = {
-    'Content-Type': 'application/json',
-    'Authorization': f'Bearer {api_key}',
-}
+    # Keeps chat prompts within a token budget, replacing older turns by summaries generated in the background
+    chat_context = ChatContext(
+        args.chat_tokens,
+        summarize=summarize_chat if args.chat_summary_tokens > 0 else None,
+        system_prompt=args.chat_system_prompt,
+        drop_fraction=args.chat_drop_fraction,
+    )
 
-history_current = []
-chat_conversation = []
+# Metrics exposed on /metrics, labelled by endpoint ("tab", "inline" or "chat")
+registry = Registry()
+stage_seconds = registry.register(Histogram(
+    "cursorweb_stage_seconds",
+    "Time spent in each stage of a request: history (update and continuity check), prompt (construction), "
+    "upstream_first_token (queue and prefill, streaming only), upstream (whole call) and postprocess",
+    ("endpoint", "stage"),
+))
+requests_total = registry.register(Counter("cursorweb_requests_total", "Requests received", ("endpoint",)))
+prompt_tokens = registry.register(Counter("cursorweb_prompt_tokens_total", "Prompt tokens reported by the model service", ("endpoint",)))
+completion_tokens = registry.register(Counter("cursorweb_completion_tokens_total", "Completion tokens reported by the model service", ("endpoint",)))
+upstream_errors = registry.register(Counter("cursorweb_upstream_errors_total", "Failed calls to the model service", ("endpoint",)))
+fallbacks = registry.register(Counter("cursorweb_fallbacks_total", "Edit requests answered with the unchanged code because the call or the postprocessing failed", ("endpoint",)))
+queue_hits = registry.register(Counter("cursorweb_tab_queue_hits_total", "Tab requests answered from the queued hunks of the previous suggestion"))
+shed_total = registry.register(Counter("cursorweb_shed_total", "Requests answered without a model call because they would wait past their queue deadline", ("endpoint",)))
+registry.register(Gauge("cursorweb_admission_queued", "Requests waiting for admission per class", lambda: {(kind,): count for kind, count in scheduler.queued().items()} if scheduler is not None else {}, ("class",)))
+registry.register(Gauge("cursorweb_admission_inflight", "Admitted upstream requests", lambda: scheduler.inflight if scheduler is not None else 0))
+predictions_sent = registry.register(Counter("cursorweb_predictions_sent_total", "Requests sent with a predicted output", ("endpoint",)))
+prediction_tokens = registry.register(Counter("cursorweb_prediction_tokens_total", "Predicted output tokens accepted or rejected, as reported by the model service", ("endpoint", "result")))
+prediction_match = registry.register(Histogram(
+    "cursorweb_prediction_match_ratio",
+    "Fraction of the output characters covered by the common prefix and suffix of the predicted output",
+    ("endpoint",),
+    buckets=(0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1.0),
+))
+registry.register(Gauge("cursorweb_prediction_rejections_total", "Requests a model service rejected because of their predicted output", lambda: {(backend.name,): backend.client.prediction_rejections for backend in upstream.backends}, ("base",), kind="counter"))
+registry.register(Gauge("cursorweb_sessions", "Live sessions", lambda: len(sessions)))
+registry.register(Gauge("cursorweb_session_conflicts_total", "Session writes rejected because another worker had written the session", lambda: getattr(sessions, "conflicts", 0), kind="counter"))
+registry.register(Gauge("cursorweb_upstream_inflight", "Requests waiting for each model service", lambda: {(stats['base'],): stats['inflight'] for stats in upstream.stats()}, ("base",)))
+for field in ("hits", "misses", "shared"):
+    registry.register(Gauge(
+        f"cursorweb_tab_cache_{field}_total",
+        f"Tab suggestion cache {field}",
+        lambda field=field: suggestion_cache.stats()[field] if suggestion_cache is not None else 0,
+        kind="counter",
+    ))
 
-app = FastAPI()
+def count_usage(endpoint, usage):
+    """
+    Adds the token usage of an upstream response to the token counters.
+
+    Args:
+        endpoint (str): The endpoint label.
+        usage (dict): The `usage` field of the response, if any.
+    """
+    if usage:
+        prompt_tokens.inc(usage.get('prompt_tokens') or 0, endpoint=endpoint)
+        completion_tokens.inc(usage.get('completion_tokens') or 0, endpoint=endpoint)
+        details = usage.get('completion_tokens_details') or {}
+        for result in ("accepted", "rejected"):
+            if details.get(f"{result}_prediction_tokens") is not None:
+                prediction_tokens.inc(details[f"{result}_prediction_tokens"], endpoint=endpoint, result=result)
+
+def observe_prediction(endpoint, data, output):
+    """
+    Records how much of a model output its predicted output covered.
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:8080"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    Servers that speculate from the prompt instead (e.g. vLLM with n-gram prompt lookup) do not report accepted tokens,
+    so the ratio of the output matching the prediction gives the attainable speedup whatever the server.
+
+    Args:
+        endpoint (str): The endpoint label.
+        data (dict): The JSON body of the upstream request.
+        output (str): The output of the model.
+    """
+    prediction = data.get('prediction')
+    if prediction is None or not output:
+        return
+    prefix, suffix = common_affix_lengths(prediction['content'], output)
+    prediction_match.observe((prefix + suffix) / len(output), endpoint=endpoint)
+
+@asynccontextmanager
+async def lifespan(app):
+    await upstream.start()
+    yield
+    if warmer is not None:
+        await warmer.close()
+    await chat_context.close()
+    await upstream.close()
+    sessions.close()
+
+# The endpoints, mounted on the application by `create_app`
+routes = APIRouter()
 
 # Model for normal chat requests
 class ChatMessage(BaseModel):
     text: str
+    stream: bool = False
+    session_id: str = "default"
 
 # Model for tab-autoedit requests
 class CodeRequest(BaseModel):
     code: str
     area: list
+    stream: bool = False
+    session_id: str = "default"
 
 # Model for inline-chat requests
 class InlineRequest(BaseModel):
     code: str
     area: list
     instruction: str
+    stream: bool = False
+    session_id: str = "default"
+
+# Model for requests cycling through the candidates of the last tab suggestion
+class CycleRequest(BaseModel):
+    code: str
+    direction: int = 1
+    session_id: str = "default"
+
+# Model for reset requests
+class ResetRequest(BaseModel):
+    session_id: str = "default"
+
+def update_history(history, code, tracker=None):
+    """
+    Records a new code state in the edit history of a session.
+
+    Args:
+        history (EditHistory): The edit history of the session, updated in place.
+        code (str): The code sent by the client.
+        tracker (ContinuityTracker, optional): The incremental continuity check of the session.
+            Defaults to `blockwise_if_continuous_modify`.
+
+    Returns:
+        bool: True if a new snapshot was started, i.e. the previous one has been committed.
+    """
+    # The model does not enforce a specific granularity for historical snippets during training.
+    # It can record changes ranging from single characters to large code blocks.
+    # For deployment, we use a heuristic to decide how to record historical snippets.
+    # This decision is based on whether the change blocks are continuous and if the edit distance is continuous.
+    # Other heuristic is also ok, such as just using edit distance
+    is_continuous = tracker.check if tracker is not None else blockwise_if_continuous_modify
+    if not history:
+        history.append(code)
+        return False
+    else:
+        if len(history) == 1:
+            if is_continuous("", history[-1], code):
+                history[-1] = code
+                return False
+            else:
+                history.append(code)
+                return True
+        elif is_continuous(history[-2], history[-1], code):
+            history[-1] = code
+            return False
+        else:
+            history.append(code)
+            return True
+
+def build_edit_data(messages, prediction=None):
+    """
+    Builds the upstream request body of a tab or inline request.
+
+    Args:
+        messages (list): The history, current and instruction messages.
+        prediction (str, optional): The expected output, sent as a predicted output. Defaults to None.
+
+    Returns:
+        dict: The JSON body of the `chat/completions` request.
+    """
+    data = {
+        'model': model,
+        'messages': messages,
+        'temperature': args.temperature,
+        'max_tokens': args.max_tokens,
+        'top_p': args.top_p,
+        'frequency_penalty': args.frequency_penalty,
+        'presence_penalty': args.presence_penalty,
+        'chat_template': 'assistant-conversation',
+        'stop': [NEXT_END],
+        "skip_special_tokens": False,
+    }
+    if prediction is not None:
+        data['prediction'] = {'type': 'content', 'content': prediction}
+    return data
+
+def build_prediction(code, output_format, window=None):
+    """
+    Builds the predicted output of an edit request if `args.predicted_output` is True.
+
+    Most of a Whole-File output is a copy of the current code, so the current code itself (without target area markers)
+    in the shape of a Whole-File output is a good guess. The other formats only describe changes and get no prediction.
+
+    Args:
+        code (str): The current code, without target area markers.
+        output_format (str): The modification format, see `resolve_format`.
+        window (tuple, optional): The start and end lines of the code shown to the model. Defaults to None.
+
+    Returns:
+        str: The predicted output, or None.
+    """
+    if not args.predicted_output or output_format != "wf":
+        return None
+    if window is not None:
+        code = "\n".join(code.split("\n")[window[0]:window[1]])
+    return f"{NEXT_START}```\n{code}\n```{NEXT_END}"
+
+def warmup_next_window(session, history):
+    """
+    Pre-prefills the history snapshots that will open the next sliding window, right after a snapshot is committed.
+
+    Currently, to handle conversation retrieval/compression, we implement a simple sliding window strategy that discards previous edit history.
+    When making a request, the model needs to recalculate the input because the initial history has been modified.
+    In the sliding window strategy, part of the historical segment in the request is determined before the sliding window moves to that position.
+    We send a low-priority request to have this part prefilled in advance, so that only part of it needs to be prefilled later.
+
+    Args:
+        session (SessionState): The session of the request.
+        history (list): The edit history of the session, whose last snapshot was just started.
+    """
+    # Without a sliding window the prompt prefix never changes, so the regular requests keep the cache warm.
+    # The same goes for the compacted history, whose start only moves when the budget is exceeded.
+    if warmer is None or args.sliding_window <= 0 or compactor is not None:
+        return
+    # After the next commit, the window will start with the committed snapshots except the oldest one of the current window
+    start = max(len(history) - args.sliding_window, 0)
+    prefix = history[start:-1]
+    if not prefix:
+        return
+    messages = [{'role': 'history', 'content': content} for content in render_history(prefix, history[start - 1] if start > 0 else None)]
+    warmer.schedule(session, build_edit_data(messages))
+
+def resolve_format(code):
+    """
+    Chooses the modification format the model is prompted for.
+
+    Args:
+        code (str): The current code.
+
+    Returns:
+        str: "wf" or "lc". With `--format auto`, short files use Whole-File and long files use Location-and-Change,
+        so that the output length scales with the size of the edit instead of the size of the file.
+    """
+    if args.format != "auto":
+        return args.format
+    if code.count("\n") + 1 <= args.format_auto_lines:
+        return "wf"
+    return "lc"
+
+def context_window(code, area):
+    """
+    Chooses the lines of the current code shown to the model when `args.context_budget` is set.
+
+    Args:
+        code (str): The current code.
+        area (list): The start and end offsets of the selection in the code.
+
+    Returns:
+        tuple: The start and end lines of a window centered on the selection, or None if the whole file is shown.
+    """
+    if args.context_budget <= 0:
+        return None
+    try:
+        offset = int(area[0])
+    except (IndexError, TypeError, ValueError):
+        offset = 0
+    start, end = window_around(code, offset, args.context_budget)
+    if start == 0 and end == code.count("\n") + 1:
+        return None
+    return start, end
+
+def render_history(history, previous=None):
+    """
+    Decorates the history snapshots of a prompt.
+
+    With `args.context_budget`, a snapshot larger than the history budget is clipped to the lines it changed from the
+    snapshot before it, as in `HistoryCompactor.render`. The first snapshot of the history is clipped to the lines
+    changed by the next one, or shown whole if the next one is the current code. Only committed snapshots are compared,
+    so the rendering of a snapshot does not change as the user keeps typing and the prompt prefix stays cacheable.
+
+    Args:
+        history (list): The committed history snapshots in the prompt window.
+        previous (str, optional): The snapshot before the window. Defaults to None, if the window starts the history.
+
+    Returns:
+        list: The decorated snapshots.
+    """
+    if args.context_budget <= 0:
+        return [decorate_code(code) for code in history]
+    budget = args.history_budget or args.context_budget // 4
+    rendered = []
+    for index, code in enumerate(history):
+        if index > 0:
+            other = history[index - 1]
+        elif previous is not None:
+            other = previous
+        else:
+            other = history[1] if len(history) > 1 else None
+        if other is None or estimate_tokens(code) <= budget:
+            rendered.append(decorate_code(code))
+        else:
+            start, end = changed_line_range(code, other, args.context_margin, budget)
+            rendered.append(decorate_code(code, start_line=start, end_line=end))
+    return rendered
+
+def record_code(session_id, session, code):
+    """
+    Records the code of a tab or inline request in the edit history of its session.
+
+    Args:
+        session_id (str): The session ID of the request.
+        session (SessionState): The session of the request.
+        code (str): The code sent by the client.
+    """
+    if update_history(session.history, code, session.continuity):
+        if compactor is not None:
+            compactor.merge(session)
+        warmup_next_window(session, session.history)
+    sessions.update(session_id)
+
+def select_history(session):
+    """
+    Chooses and decorates the history snapshots of a tab or inline request.
+
+    Args:
+        session (SessionState): The session of the request, whose last snapshot is the current code.
+
+    Returns:
+        list: The decorated snapshots, from the history compactor if `args.history_tokens` is set, otherwise from the sliding window.
+    """
+    if compactor is not None:
+        return compactor.select(session)
+    history_current = session.history
+    start = max(len(history_current) - 1 - args.sliding_window, 0) if args.sliding_window > 0 else 0
+    return render_history(history_current[start:-1], history_current[start - 1] if start > 0 else None)
+
+def build_edit_messages(history, current, output_format, window=None):
+    """
+    Builds the history and current messages of a tab or inline request.
+
+    Args:
+        history (list): The decorated history snapshots, see `select_history`.
+        current (str): The current code with the target area marked.
+        output_format (str): The modification format, see `resolve_format`.
+        window (tuple, optional): The start and end lines of the current code shown to the model, see `context_window`. Defaults to None.
+
+    Returns:
+        list: The messages. Location-and-Change refers to line numbers, so the current code is numbered in that format.
+        History snapshots are decorated the same way in every format, which keeps the prompt prefix cacheable.
+    """
+    start_line, end_line = window if window is not None else (None, None)
+    return [{'role': 'history', 'content': content} for content in history] + [{'role': 'current', 'content': decorate_code(current, use_line_num=output_format == "lc", start_line=start_line, end_line=end_line)}]
+
+def mark_target_area(code, area):
+    """
+    Marks the target area of the user in the code if `args.use_target_area` is True.
+
+    Args:
+        code (str): The code to mark.
+        area (list): The start and end offsets of the selection in the code.
+
+    Returns:
+        str: The code with `TARGET` or `TARGET_START`/`TARGET_END` inserted.
+    """
+    if not args.use_target_area:
+        return code
+    try:
+        if area[0] == area[1]:
+            return code[:area[0]] + TARGET + code[area[1]:]
+        else:
+            return code[:area[0]] + TARGET_START + code[area[0]:area[1]] + TARGET_END + code[area[1]:]
+    except:
+        return code
+
+class Superseded(Exception):
+    """
+    Raised when a tab request is replaced by a newer tab request of the same session.
+    """
+
+def supersede_tab(session):
+    """
+    Marks a new tab request as the latest one of its session.
+    The upstream generation of the previous tab request is aborted, since its suggestion can no longer be shown.
+
+    Args:
+        session (SessionState): The session of the request.
+
+    Returns:
+        int: The sequence number of the new request.
+    """
+    session.tab_seq += 1
+    if session.tab_task is not None and not session.tab_task.done():
+        session.tab_task.cancel()
+    session.tab_task = None
+    return session.tab_seq
+
+async def run_tab(session, seq, coroutine):
+    """
+    Runs the upstream part of a tab request so that a newer tab request of the same session can cancel it.
+
+    Args:
+        session (SessionState): The session of the request.
+        seq (int): The sequence number returned by `supersede_tab`.
+        coroutine (coroutine): The upstream call.
+
+    Returns:
+        The result of the coroutine.
+
+    Raises:
+        Superseded: If a newer tab request of the session arrived before the call finished.
+    """
+    if session.tab_seq != seq:
+        coroutine.close()
+        raise Superseded()
+    task = asyncio.ensure_future(coroutine)
+    session.tab_task = task
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if session.tab_seq != seq:
+            raise Superseded()
+        raise
+    finally:
+        if session.tab_task is task:
+            session.tab_task = None
+
+def sse_event(payload):
+    """
+    Formats a payload as a server-sent event.
+
+    Args:
+        payload (dict): The payload to send.
+
+    Returns:
+        str: The JSON-encoded payload framed as an SSE `data` line.
+    """
+    return f"data: {json.dumps(payload)}\n\n"
+
+async def stream_cached(assistant):
+    """
+    Streams a cached suggestion as a single final server-sent event.
+
+    Args:
+        assistant (str): The cached suggestion.
+
+    Yields:
+        str: The `{"assistant": ..., "done": true}` event.
+    """
+    yield sse_event({"assistant": assistant.rstrip(), "done": True})
+
+def apply_output(endpoint, code, output, window=None):
+    """
+    Postprocesses a model output into the whole predicted file and records the postprocessing metrics.
+
+    Args:
+        endpoint (str): The endpoint label of the metrics.
+        code (str): The code sent by the client.
+        output (str): The output of the model.
+        window (tuple, optional): The start and end lines of the code shown to the model. Defaults to None.
+
+    Returns:
+        str: The whole predicted file, or `code` if the output cannot be applied.
+    """
+    with stage_seconds.time(endpoint=endpoint, stage="postprocess"):
+        assistant = postprocess_output(code, output, window)
+    # The postprocessors give back the very same string when they fail
+    if assistant is code:
+        fallbacks.inc(endpoint=endpoint)
+    return assistant
+
+def apply_candidates(endpoint, code, outputs, window=None):
+    """
+    Postprocesses the model outputs of a multi-candidate request into whole predicted files.
+
+    Args:
+        endpoint (str): The endpoint label of the metrics.
+        code (str): The code sent by the client.
+        outputs (list): The outputs of the model, one per choice.
+        window (tuple, optional): The start and end lines of the code shown to the model. Defaults to None.
+
+    Returns:
+        list: The whole predicted files of the outputs that could be applied. A fallback is only counted if none could.
+    """
+    with stage_seconds.time(endpoint=endpoint, stage="postprocess"):
+        assistants = [postprocess_output(code, output, window) for output in outputs]
+    applied = [assistant for assistant in assistants if assistant is not code]
+    if not applied:
+        fallbacks.inc(endpoint=endpoint)
+    return applied
+
+@asynccontextmanager
+async def admitted(endpoint, session_id):
+    """
+    Holds an admission slot of the scheduler for an upstream call, and records the time spent waiting for it.
 
-@app.post("/api/chat")
+    Args:
+        endpoint (str): The endpoint label, which is also the priority class.
+        session_id (str): The session of the request.
+
+    Raises:
+        Shed: If the request would wait past the deadline of its class.
+    """
+    if scheduler is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        await scheduler.acquire(endpoint, session_id)
+    except Shed:
+        shed_total.inc(endpoint=endpoint)
+        raise
+    stage_seconds.observe(time.perf_counter() - start, endpoint=endpoint, stage="queue")
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        scheduler.release(session_id, time.perf_counter() - start)
+
+async def timed_completion(endpoint, data, session_id):
+    """
+    Sends a non-streaming upstream request and records its latency, token usage and failure.
+
+    Args:
+        endpoint (str): The endpoint label of the metrics.
+        data (dict): The JSON body of the upstream request.
+        session_id (str): The session of the request.
+
+    Returns:
+        dict: The decoded JSON response, or None if the request failed.
+
+    Raises:
+        Shed: If the request was shed by the scheduler.
+    """
+    async with admitted(endpoint, session_id):
+        if 'prediction' in data:
+            predictions_sent.inc(endpoint=endpoint)
+        start = time.perf_counter()
+        result = await upstream.chat_completions(data, session_id)
+        stage_seconds.observe(time.perf_counter() - start, endpoint=endpoint, stage="upstream")
+    if result is None:
+        upstream_errors.inc(endpoint=endpoint)
+    else:
+        count_usage(endpoint, result.get('usage'))
+        observe_prediction(endpoint, data, result['choices'][0]['message']['content'])
+    return result
+
+async def summarize_chat(session, summary, messages):
+    """
+    Summarizes the oldest turns of a chat conversation, for `ChatContext`.
+
+    Args:
+        session (SessionState): The session of the conversation.
+        summary (str): The summary of the turns before them, if any.
+        messages (list): The turns to summarize.
+
+    Returns:
+        str: The summary of all turns so far, or None if the request failed.
+    """
+    transcript = "\n\n".join(f"{message['role'].capitalize()}: {message['content']}" for message in messages)
+    previous = f"Summary of the earlier conversation:\n{summary}\n\n" if summary else ""
+    instruction = (
+        "Summarize the conversation above for an assistant that will continue it. Keep the facts, decisions, "
+        f"names of code elements and open questions. Use at most {args.chat_summary_tokens * 3 // 4} words."
+    )
+    data = {
+        'model': model,
+        'messages': [{'role': 'user', 'content': f"{previous}Conversation:\n{transcript}\n\n{instruction}"}],
+        'temperature': 0.0,
+        'max_tokens': args.chat_summary_tokens,
+    }
+    result = await timed_completion("chat_summary", data, session.session_id)
+    if result is None:
+        return None
+    return result['choices'][0]['message']['content']
+
+registry.register(Gauge("cursorweb_chat_compactions_total", "Times the oldest chat turns of a session were summarized or dropped", lambda: chat_context.compactions, kind="counter"))
+
+async def stream_chat(session_id, data):
+    """
+    Streams a chat reply as server-sent events and appends it to the chat history once finished.
+
+    Args:
+        session_id (str): The session the reply belongs to.
+        data (dict): The JSON body of the upstream request.
+
+    Yields:
+        str: `{"delta": ..., "done": false}` events with the generated text, followed by a final
+        `{"assistant": ..., "done": true}` event containing the whole reply.
+    """
+    assistant = ""
+    usage = {}
+    try:
+        async with admitted("chat", session_id):
+            start = time.perf_counter()
+            async for delta in upstream.stream_chat_completions(data, session_id, usage):
+                if not assistant:
+                    stage_seconds.observe(time.perf_counter() - start, endpoint="chat", stage="upstream_first_token")
+                assistant += delta
+                yield sse_event({"delta": delta, "done": False})
+            stage_seconds.observe(time.perf_counter() - start, endpoint="chat", stage="upstream")
+        count_usage("chat", usage)
+    except (httpx.HTTPError, EngineError) as e:
+        print(e)
+        upstream_errors.inc(endpoint="chat")
+        assistant = "Sorry, there was an error processing your request."
+
+    sessions.get(session_id).chat.append({'role': 'assistant', 'content': assistant.rstrip()})
+    sessions.update(session_id)
+    yield sse_event({"assistant": assistant.rstrip(), "done": True})
+
+async def stream_whole_file(code, data, output_format="wf", superseded=None, cache_key=None, session_id=None, window=None, endpoint="tab"):
+    """
+    Streams a whole-file edit prediction as server-sent events.
+
+    In the Whole-File format, the first event is sent as soon as the code fence after `NEXT_START` opens.
+    After that, every newly completed line of the predicted file is sent as a delta, so the concatenated
+    deltas are always a prefix of the file that can no longer change. The other formats only describe
+    changes, so only the final event is sent.
+
+    Args:
+        code (str): The code sent by the client, to which the model output is applied. Returned if the upstream request fails.
+        data (dict): The JSON body of the upstream request.
+        output_format (str, optional): The modification format the model is prompted for. Defaults to "wf".
+        superseded (callable, optional): Returns True once the request has been replaced by a newer one.
+            The upstream generation is then aborted and a final `{"superseded": true, "done": true}` event is sent.
+        cache_key (str, optional): If given, the postprocessed file is stored in the suggestion cache under this key.
+        session_id (str, optional): The session of the request, used to route it to the backend caching its history.
+        window (tuple, optional): The start and end lines of the code shown to the model, whose output is spliced back into the file.
+        endpoint (str, optional): The endpoint label of the metrics. Defaults to "tab".
+
+    Yields:
+        str: `{"delta": ..., "done": false}` events with the stable prefix, followed by a final
+        `{"assistant": ..., "done": true}` event containing the postprocessed file. If the request is shed by the
+        scheduler, the final event has the unchanged code and `"shed": true`.
+    """
+    output = ""
+    sent = None
+    usage = {}
+    try:
+        async with admitted(endpoint, session_id):
+            if 'prediction' in data:
+                predictions_sent.inc(endpoint=endpoint)
+            start = time.perf_counter()
+            async for delta in upstream.stream_chat_completions(data, session_id, usage):
+                if superseded is not None and superseded():
+                    yield sse_event({"superseded": True, "done": True})
+                    return
+                if not output:
+                    stage_seconds.observe(time.perf_counter() - start, endpoint=endpoint, stage="upstream_first_token")
+                output += delta
+                # The stable prefix can only change when a line is completed
+                if output_format != "wf" or "\n" not in delta:
+                    continue
+                prefix = postprocess_stream_wf(output)
+                if prefix is not None and window is not None:
+                    prefix = splice_stream_prefix(code, prefix, window)
+                if prefix is not None and (sent is None or len(prefix) > len(sent)):
+                    yield sse_event({"delta": prefix[len(sent or ""):], "done": False})
+                    sent = prefix
+            stage_seconds.observe(time.perf_counter() - start, endpoint=endpoint, stage="upstream")
+        count_usage(endpoint, usage)
+        observe_prediction(endpoint, data, output)
+        assistant = apply_output(endpoint, code, output, window)
+        if cache_key is not None:
+            suggestion_cache.put(cache_key, assistant)
+    except (httpx.HTTPError, EngineError) as e:
+        print(e)
+        upstream_errors.inc(endpoint=endpoint)
+        fallbacks.inc(endpoint=endpoint)
+        assistant = code
+    except Shed:
+        yield sse_event({"assistant": code.rstrip(), "done": True, "shed": True})
+        return
+
+    yield sse_event({"assistant": assistant.rstrip(), "done": True})
+
+@routes.post("/api/chat")
 async def chat(message: ChatMessage):    
     """
-    Handles the chat conversation by appending the user's message to the chat history,
+    Handles the chat conversation by appending the user's message to the chat history of its session,
     sending the conversation to an external API for processing, and appending the 
     assistant's response to the chat history.
+    With `args.chat_tokens`, only the latest turns are sent and older ones are replaced by a summary, see `ChatContext`.
     Args:
-        message (ChatMessage): The message object containing the user's input text.
+        message (ChatMessage): The message object containing the user's input text and session ID.
     Returns:
-        dict: A dictionary containing the assistant's response text.
-    Raises:
-        requests.exceptions.RequestException: If there is an issue with the HTTP request.
+        dict: A dictionary containing the assistant's response text, or a stream of server-sent
+        events if `message.stream` is True.
     """
-    global chat_conversation
-
-    chat_conversation.append({'role': 'user', 'content': message.text})
+    requests_total.inc(endpoint="chat")
+    session = sessions.get(message.session_id)
+    session.chat.append({'role': 'user', 'content': message.text})
 
     data = {
         'model': model,
-        'messages': chat_conversation,
+        'messages': chat_context.build(session),
         'temperature': args.temperature,
         'max_tokens': args.max_tokens,
         'top_p': args.top_p,
@@ -89,188 +891,377 @@ async def chat(message: ChatMessage):
         'presence_penalty': args.presence_penalty,
     }
 
-    response = requests.post(url, headers=headers, json=data, verify=False)
+    if message.stream:
+        return StreamingResponse(stream_chat(message.session_id, data), media_type="text/event-stream")
 
-    if response.status_code == 200:
-        result = response.json()
+    result = await timed_completion("chat", data, message.session_id)
+
+    if result is not None:
         assistant = result['choices'][0]['message']['content']
     else:
         assistant = "Sorry, there was an error processing your request."
 
-    chat_conversation.append({'role': 'assistant', 'content': assistant.rstrip()})
+    session.chat.append({'role': 'assistant', 'content': assistant.rstrip()})
+    sessions.update(message.session_id)
     return {"assistant": assistant.rstrip()}
 
-@app.post("/api/tab")
+def prepare_tab(session_id, session, code, area):
+    """
+    Records the code of a tab request in the edit history of its session and builds the upstream request.
+
+    Args:
+        session_id (str): The session ID of the request.
+        session (SessionState): The session of the request.
+        code (str): The code sent by the client.
+        area (list): The start and end offsets of the selection in the code.
+
+    Returns:
+        tuple: The modification format, the JSON body of the upstream request and the window of the code shown
+        to the model (see `context_window`), or None if there is nothing to suggest for an empty file.
+    """
+    history_current = session.history
+
+    if not history_current and code == "":
+        return None
+    with stage_seconds.time(endpoint="tab", stage="history"):
+        record_code(session_id, session, code)
+
+    with stage_seconds.time(endpoint="tab", stage="prompt"):
+        current = mark_target_area(history_current[-1], area)
+        output_format = resolve_format(history_current[-1])
+
+        window = context_window(history_current[-1], area)
+        messages = build_edit_messages(select_history(session), current, output_format, window)
+        data = build_edit_data(messages, build_prediction(history_current[-1], output_format, window))
+
+    return output_format, data, window
+
+def queue_hunks(session, code, assistant):
+    """
+    Splits a suggestion into line hunks and queues it in the session, so that accepting its first hunk
+    can be answered with the remaining ones. Once the last hunk is accepted, the next request asks the model again.
+
+    Args:
+        session (SessionState): The session of the request.
+        code (str): The code the suggestion was made for.
+        assistant (str): The suggested whole file.
+
+    Returns:
+        list: The hunks turning `code` into `assistant`, ignoring the trailing whitespace stripped from suggestions.
+    """
+    # Suggestions are sent without trailing whitespace, which must not become a hunk deleting the final newline
+    hunks = generate_hunks(code, assistant.rstrip() + code[len(code.rstrip()):])
+    if len(hunks) > 1:
+        session.hunk_queue = {'expected': apply_hunks(code, hunks[:1]), 'final': assistant}
+    else:
+        session.hunk_queue = None
+    return hunks
+
+def queued_suggestion(session, code):
+    """
+    Returns the queued suggestion of a session if the code is the result of accepting its first hunk.
+
+    Args:
+        session (SessionState): The session of the request.
+        code (str): The code sent by the client.
+
+    Returns:
+        str: The queued whole file, or None if the code does not follow the queued suggestion.
+    """
+    queue = session.hunk_queue
+    if queue is None or queue['expected'] != code:
+        return None
+    return queue['final']
+
+async def complete_tab(session, seq, code, data, window=None, area=None):
+    """
+    Generates the suggestion of a tab request, through the suggestion cache if it is enabled.
+
+    With `args.tab_candidates`, several suggestions are generated in one upstream call, which prefills the prompt once.
+    They are deduplicated, ranked (see `rank_candidates`) and kept in the session for `cycle_candidates`.
+
+    Args:
+        session (SessionState): The session of the request.
+        seq (int): The sequence number returned by `supersede_tab`.
+        code (str): The code sent by the client, to which the model output is applied.
+        data (dict): The JSON body of the upstream request.
+        window (tuple, optional): The start and end lines of the code shown to the model. Defaults to None.
+        area (list, optional): The start and end offsets of the selection in the code, used to rank candidates. Defaults to None.
+
+    Returns:
+        dict: A dictionary containing the assistant's response, its line hunks and the number of candidates if
+        there are several, or `{"superseded": True}` if a newer tab request of the session arrived meanwhile.
+        If the request was shed by the scheduler, the unchanged code with `{"shed": True}`.
+    """
+    # The client accepted the first hunk of the previous suggestion, the rest of it needs no new model call
+    queued = queued_suggestion(session, code)
+    if queued is not None:
+        queue_hits.inc()
+        return {"assistant": queued, "hunks": queue_hunks(session, code, queued)}
+
+    if args.tab_candidates > 1:
+        # Predicted outputs cannot be combined with several choices
+        data = {key: value for key, value in data.items() if key != 'prediction'}
+        data['n'] = args.tab_candidates
+
+    async def generate():
+        result = await timed_completion("tab", data, session.session_id)
+        if result is None:
+            return None
+        if 'n' in data:
+            return apply_candidates("tab", code, [choice['message']['content'] for choice in result['choices']], window)
+        return apply_output("tab", code, result['choices'][0]['message']['content'], window)
+
+    if suggestion_cache is not None:
+        coroutine = suggestion_cache.get_or_compute(SuggestionCache.make_key(data, code, window), generate)
+    else:
+        coroutine = generate()
+
+    try:
+        assistant = await run_tab(session, seq, coroutine)
+    except Superseded:
+        return {"assistant": code, "superseded": True}
+    except Shed:
+        return {"assistant": code, "hunks": [], "shed": True}
+
+    candidates = None
+    if isinstance(assistant, list):
+        candidates = rank_candidates(code, assistant, area or [0, 0])
+        session.tab_candidates = {'code': code, 'candidates': candidates, 'index': 0} if candidates else None
+        assistant = candidates[0] if candidates else code
+    if assistant is None:
+        fallbacks.inc(endpoint="tab")
+        assistant = code
+    assistant = assistant.rstrip()
+
+    # In the current implementation, regardless of the modification format types (WF, LC, SR) of the model, the changes are eventually converted into the whole file format and passed to the front end.
+    # The front end then chooses different display methods according to the specific requirements of the application.
+    # To achieve an effect similar to "Tab Tab Tab", the changes are also split into line hunks, and the suggestion is queued in the session.
+    # Once the client accepts the first hunk, the next request gets the remaining hunks without a new model call.
+    if candidates is not None:
+        return {"assistant": assistant, "hunks": queue_hunks(session, code, assistant), "candidates": len(candidates)}
+    return {"assistant": assistant, "hunks": queue_hunks(session, code, assistant)}
+
+def cycle_candidates(session, code, direction=1):
+    """
+    Switches to another candidate of the last tab suggestion of a session, without a model call.
+
+    Args:
+        session (SessionState): The session.
+        code (str): The code sent by the client, which must be the code the candidates were generated for.
+        direction (int, optional): How many candidates to move forward, negative to move back. Defaults to 1.
+
+    Returns:
+        dict: The candidate with its line hunks, its index and the number of candidates. If the code changed since
+        the suggestion, the unchanged code with no candidates.
+    """
+    entry = session.tab_candidates
+    if entry is None or entry['code'] != code:
+        return {"assistant": code.rstrip(), "hunks": [], "index": 0, "candidates": 0}
+    entry['index'] = (entry['index'] + direction) % len(entry['candidates'])
+    assistant = entry['candidates'][entry['index']]
+    return {"assistant": assistant, "hunks": queue_hunks(session, code, assistant), "index": entry['index'], "candidates": len(entry['candidates'])}
+
+@routes.post("/api/tab")
 async def tab(request: CodeRequest):
     """
     Handles the tab completion request by updating the history of code inputs and generating a response from an assistant model.
     Args:
         request (CodeRequest): The request object containing the code and area information.
     Returns:
-        dict: A dictionary containing the assistant's response.
+        dict: A dictionary containing the assistant's response and its line hunks, or a stream of server-sent events
+        if `request.stream` is True.
     The function performs the following steps:
-    1. Updates the global `history_current` list with the new code from the request.
+    1. Updates the edit history of the request's session with the new code from the request.
     2. If `args.use_target_area` is True, it modifies the current code based on the specified area.
     3. Prepares the messages for the assistant model by decorating the code history.
-    4. Sends a POST request to the assistant model with the prepared data.
+    4. Sends the prepared data to the assistant model through the shared upstream client.
     5. Processes the response from the assistant model and extracts the assistant's message.
-    6. Returns the assistant's response in a dictionary.
+    6. Returns the assistant's response in a dictionary, or streams it when requested.
+    A newer tab request of the same session aborts the upstream generation of this one, in which case
+    `{"superseded": True}` is returned.
     """
-    global history_current
-    
-    # The model does not enforce a specific granularity for historical snippets during training.
-    # It can record changes ranging from single characters to large code blocks.
-    # For deployment, we use a heuristic to decide how to record historical snippets.
-    # This decision is based on whether the change blocks are continuous and if the edit distance is continuous.
-    # Other heuristic is also ok, such as just using edit distance
-    if not history_current:
-        if request.code == "":
-            return {"assistant": ""}
-        history_current.append(request.code)
-    else:
-        if len(history_current) == 1:
-            if blockwise_if_continuous_modify("", history_current[-1], request.code):
-                history_current[-1] = request.code
-            else:
-                history_current.append(request.code)
-        elif blockwise_if_continuous_modify(history_current[-2], history_current[-1], request.code):
-            history_current[-1] = request.code
-        else:
-            history_current.append(request.code)
+    requests_total.inc(endpoint="tab")
+    session = sessions.get(request.session_id)
+    seq = supersede_tab(session)
 
-    if args.use_target_area:
-        try:
-            if request.area[0] == request.area[1]:
-                current = history_current[-1][:request.area[0]] + TARGET + history_current[-1][request.area[1]:]
-            else:
-                current = history_current[-1][:request.area[0]] + TARGET_START + history_current[-1][request.area[0]:request.area[1]] + TARGET_END + history_current[-1][request.area[1]:]
-        except:
-            current = history_current[-1]
-    else:
-        current = history_current[-1]
+    prepared = prepare_tab(request.session_id, session, request.code, request.area)
+    if prepared is None:
+        if request.stream:
+            return StreamingResponse(stream_cached(""), media_type="text/event-stream")
+        return {"assistant": ""}
+    output_format, data, window = prepared
 
-    # TODO: support others modification types like Location-and-Change and Search-and-Replace
-    if args.sliding_window > 0:
-        history = history_current[-args.sliding_window-1:-1]
-    else:
-        history = history_current[:-1]
-    messages = [{'role': 'history', 'content': decorate_code(code)} for code in history] + [{'role': 'current', 'content': decorate_code(current)}]
+    if request.stream:
+        queued = queued_suggestion(session, request.code)
+        if queued is not None:
+            queue_hits.inc()
+            queue_hunks(session, request.code, queued)
+            return StreamingResponse(stream_cached(queued), media_type="text/event-stream")
+        cache_key = None
+        if suggestion_cache is not None:
+            cache_key = SuggestionCache.make_key(data, request.code, window)
+            cached = suggestion_cache.get(cache_key)
+            if cached is not None:
+                suggestion_cache.hits += 1
+                return StreamingResponse(stream_cached(cached), media_type="text/event-stream")
+            suggestion_cache.misses += 1
+        superseded = lambda: session.tab_seq != seq
+        return StreamingResponse(stream_whole_file(request.code, data, output_format, superseded, cache_key, request.session_id, window), media_type="text/event-stream")
 
-    # TODO: Implement streaming return
-    data = {
-        'model': model,
-        'messages': messages,
-        'temperature': args.temperature,
-        'max_tokens': args.max_tokens,
-        'top_p': args.top_p,
-        'frequency_penalty': args.frequency_penalty,
-        'presence_penalty': args.presence_penalty,
-        'chat_template': 'assistant-conversation',
-        'stop': [NEXT_END],
-        "skip_special_tokens": False,
-    }
+    return await complete_tab(session, seq, request.code, data, window, request.area)
+
+@routes.post("/api/tab/cycle")
+async def cycle_tab(request: CycleRequest):
+    """
+    Cycles through the candidates of the last tab suggestion of a session, see `cycle_candidates`.
+    Args:
+        request (CycleRequest): The request containing the code, the direction and the session ID.
+    Returns:
+        dict: The next candidate with its line hunks, its index and the number of candidates.
+    """
+    requests_total.inc(endpoint="cycle")
+    return cycle_candidates(sessions.get(request.session_id), request.code, request.direction)
+
+async def push_tab_suggestion(websocket, session_id, code, version, area):
+    """
+    Generates a tab suggestion for a version of a synchronized document and pushes it to the client.
 
-    # TODO: Strategy: Pre-Prefill of History
-    # Currently, to handle conversation retrieval/compression, we implement a simple sliding window strategy that discards previous edit history.
-    # When making a request, the model needs to recalculate the input because the initial history has been modified.
-    # In the sliding window strategy, part of the historical segment in the request is determined before the sliding window moves to that position.
-    # We can consider sending a request to have this part prefilled in advance, so that only part of it needs to be prefilled later.
-    # If the model inference backend supports request prioritization, this should be a low-priority request.
-    response = requests.post(url, headers=headers, json=data, verify=False)
-
-    if response.status_code == 200:
-        result = response.json()
-        assistant = postprocess_output_wf(current, result['choices'][0]['message']['content'])
+    Args:
+        websocket (WebSocket): The connection of the client.
+        session_id (str): The session ID of the client.
+        code (str): The text of the document.
+        version (int): The version of the document the suggestion is for.
+        area (list): The start and end offsets of the selection in the document.
+    """
+    requests_total.inc(endpoint="tab")
+    session = sessions.get(session_id)
+    seq = supersede_tab(session)
+
+    prepared = prepare_tab(session_id, session, code, area)
+    if prepared is None:
+        response = {"assistant": ""}
     else:
-        assistant = request.code
+        _, data, window = prepared
+        response = await complete_tab(session, seq, code, data, window, area)
+        if response.get("superseded"):
+            return
+    await websocket.send_json({"type": "suggestion", "version": version, **response})
 
-    # In the current implementation, regardless of the modification format types (WF, LC, SR) of the model, the changes are eventually converted into the whole file format and passed to the front end.
-    # The front end then chooses different display methods according to the specific requirements of the application.
-    # If we want to split a predicted change and return it to the front end multiple times to achieve an effect similar to "Tab Tab Tab", we need to split the changes and add some caching mechanisms. It should be good to implement it on the frontend or the backend.
-    # Currently, for a simple demonstration, we return all changes at once.
-    return {"assistant": assistant.rstrip()}
+@routes.websocket("/ws/tab")
+async def tab_socket(websocket: WebSocket):
+    """
+    Serves tab suggestions over a persistent WebSocket, keeping a server-side copy of the document in sync with edit deltas.
+    The session ID is passed as the `session_id` query parameter.
+    Messages sent by the client:
+    - `{"type": "open", "code": ..., "version": ...}` sets the whole document.
+    - `{"type": "edit", "base_version": ..., "version": ..., "deltas": [{"offset": ..., "delete": ..., "insert": ...}], "length": ...}`
+      applies edit deltas to the document at `base_version`. Offsets, deletions and the optional length of the
+      document after the edit are counted in UTF-16 code units, as in the editor.
+    - `{"type": "tab", "version": ..., "area": [start, end]}` requests a suggestion for the document at `version`,
+      with the offsets of the selection in UTF-16 code units.
+    - `{"type": "cycle", "direction": 1}` switches to another candidate of the last suggestion, see `cycle_candidates`.
+    Messages sent by the server:
+    - `{"type": "suggestion", "version": ..., "assistant": ...}` with the suggestion for a version of the document.
+    - `{"type": "resync"}` when an `open` message has no code or the edits do not apply to the server copy, after which
+      the client sends `open` again.
+    - `{"type": "error", "error": ...}` for other malformed messages, which are ignored. The connection stays open.
+    Args:
+        websocket (WebSocket): The connection of the client.
+    """
+    await websocket.accept()
+    session_id = websocket.query_params.get("session_id", "default")
+    document = TextDocument()
+    tasks = set()
+
+    try:
+        while True:
+            message = await websocket.receive_json()
+            if not isinstance(message, dict):
+                await websocket.send_json({"type": "error", "error": "Messages must be JSON objects"})
+                continue
+            if message.get("type") == "open":
+                if not isinstance(message.get("code"), str):
+                    document.reset("", -1)
+                    await websocket.send_json({"type": "resync"})
+                    continue
+                document.reset(message["code"], message.get("version", 0))
+            elif message.get("type") == "edit":
+                if message.get("base_version") != document.version:
+                    await websocket.send_json({"type": "resync"})
+                    continue
+                try:
+                    document.apply_deltas(message["deltas"], message["version"], message.get("length"))
+                except (KeyError, TypeError, ValueError):
+                    document.reset("", -1)
+                    await websocket.send_json({"type": "resync"})
+            elif message.get("type") == "tab":
+                # The document moved on since the request was sent, a newer request will follow
+                if message.get("version") != document.version:
+                    continue
+                try:
+                    area = [document.index(int(offset)) for offset in message.get("area", [0, 0])]
+                except (TypeError, ValueError):
+                    area = [0, 0]
+                task = asyncio.ensure_future(push_tab_suggestion(websocket, session_id, document.text, document.version, area))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif message.get("type") == "cycle":
+                try:
+                    direction = int(message.get("direction", 1))
+                except (TypeError, ValueError):
+                    await websocket.send_json({"type": "error", "error": "The direction must be an integer"})
+                    continue
+                response = cycle_candidates(sessions.get(session_id), document.text, direction)
+                await websocket.send_json({"type": "suggestion", "version": document.version, **response})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
 
-@app.post("/api/inline")
+@routes.post("/api/inline")
 async def inline(request: InlineRequest):
     """
     Handles inline requests by updating the history of code snippets and generating a response based on the current state.
     Args:
         request (InlineRequest): The incoming request containing code, area, and instruction.
     Returns:
-        dict: A dictionary containing the assistant's response.
+        dict: A dictionary containing the assistant's response, or a stream of server-sent events
+        if `request.stream` is True.
     The function performs the following steps:
-    1. Updates the global `history_current` list with the new code from the request.
+    1. Updates the edit history of the request's session with the new code from the request.
     2. Modifies the current code snippet based on the specified area if `args.use_target_area` is True.
     3. Prepares a list of messages for the model, including the history and the current code snippet.
-    4. Sends a POST request to the specified URL with the prepared data.
+    4. Sends the prepared data to the model service through the shared upstream client.
     5. Extracts the assistant's response from the model's output.
-    6. Returns the assistant's response as a dictionary.
+    6. Returns the assistant's response as a dictionary, or streams it when requested.
     """
-    global history_current
+    requests_total.inc(endpoint="inline")
+    session = sessions.get(request.session_id)
+    history_current = session.history
 
-    # The model does not enforce a specific granularity for historical snippets during training.
-    # It can record changes ranging from single characters to large code blocks.
-    # For deployment, we use a heuristic to decide how to record historical snippets.
-    # This decision is based on whether the change blocks are continuous and if the edit distance is continuous.
-    # Other heuristic is also ok, such as just using edit distance
-    if not history_current:
-        history_current.append(request.code)
-    else:
-        if len(history_current) == 1:
-            if blockwise_if_continuous_modify("", history_current[-1], request.code):
-                history_current[-1] = request.code
-            else:
-                history_current.append(request.code)
-        elif blockwise_if_continuous_modify(history_current[-2], history_current[-1], request.code):
-            history_current[-1] = request.code
-        else:
-            history_current.append(request.code)
+    with stage_seconds.time(endpoint="inline", stage="history"):
+        record_code(request.session_id, session, request.code)
 
-    if args.use_target_area:
-        try:
-            if request.area[0] == request.area[1]:
-                current = history_current[-1][:request.area[0]] + TARGET + history_current[-1][request.area[1]:]
-            else:
-                current = history_current[-1][:request.area[0]] + TARGET_START + history_current[-1][request.area[0]:request.area[1]] + TARGET_END + history_current[-1][request.area[1]:]
-        except:
-            current = history_current[-1]
-    else:
-        current = history_current[-1]
+    with stage_seconds.time(endpoint="inline", stage="prompt"):
+        current = mark_target_area(history_current[-1], request.area)
+        output_format = resolve_format(history_current[-1])
 
-    # TODO: support others modification types like Location-and-Change and Search-and-Replace
-    if args.sliding_window > 0:
-        history = history_current[-args.sliding_window-1:-1]
-    else:
-        history = history_current[:-1]
-    messages = [{'role': 'history', 'content': decorate_code(code)} for code in history] + [{'role': 'current', 'content': decorate_code(current)}] + [{'role': 'user', 'content': request.instruction}]
+        window = context_window(history_current[-1], request.area)
+        messages = build_edit_messages(select_history(session), current, output_format, window) + [{'role': 'user', 'content': request.instruction}]
 
-    
-    # TODO: Implement streaming return
-    data = {
-        'model': model,
-        'messages': messages,
-        'temperature': args.temperature,
-        'max_tokens': args.max_tokens,
-        'top_p': args.top_p,
-        'frequency_penalty': args.frequency_penalty,
-        'presence_penalty': args.presence_penalty,
-        'chat_template': 'assistant-conversation',
-        'stop': [NEXT_END],
-        "skip_special_tokens": False,
-    }
+        data = build_edit_data(messages, build_prediction(history_current[-1], output_format, window))
 
-    # TODO: Strategy: Pre-Prefill of History
-    # Currently, to handle conversation retrieval/compression, we implement a simple sliding window strategy that discards previous edit history.
-    # When making a request, the model needs to recalculate the input because the initial history has been modified.
-    # In the sliding window strategy, part of the historical segment in the request is determined before the sliding window moves to that position.
-    # We can consider sending a request to have this part prefilled in advance, so that only part of it needs to be prefilled later.
-    # If the model inference backend supports request prioritization, this should be a low-priority request.
-    response = requests.post(url, headers=headers, json=data, verify=False)
-
-    if response.status_code == 200:
-        result = response.json()
-        assistant = postprocess_output_wf(current, result['choices'][0]['message']['content'])
+    if request.stream:
+        return StreamingResponse(stream_whole_file(request.code, data, output_format, session_id=request.session_id, window=window, endpoint="inline"), media_type="text/event-stream")
+
+    result = await timed_completion("inline", data, request.session_id)
+
+    if result is not None:
+        assistant = apply_output("inline", request.code, result['choices'][0]['message']['content'], window)
     else:
+        fallbacks.inc(endpoint="inline")
         assistant = request.code
 
     # In the current implementation, regardless of the modification format types (WF, LC, SR) of the model, the changes are eventually converted into the whole file format and passed to the front end.
@@ -279,22 +1270,77 @@ async def inline(request: InlineRequest):
     # Currently, for a simple demonstration, we return all changes at once.
     return {"assistant": assistant.rstrip()}
 
-@app.post("/api/reset")
-async def reset():
+@routes.get("/api/stats")
+async def stats():
+    """
+    Reports statistics of the backend state.
+    Returns:
+        dict: The number of live sessions, the hit/miss statistics of the tab suggestion cache and the state of the model backends.
+    """
+    return {
+        "sessions": len(sessions),
+        "tab_cache": suggestion_cache.stats() if suggestion_cache is not None else None,
+        "backends": upstream.stats(),
+    }
+
+@routes.get("/metrics")
+async def metrics():
+    """
+    Exposes the request metrics in the Prometheus text format.
+    Returns:
+        PlainTextResponse: Per-stage latency histograms, token, error, fallback and cache counters, and current load.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@routes.post("/api/reset")
+async def reset(request: ResetRequest = None):
     """
-    Resets the global chat conversation and history.
-    This function clears the global variables `chat_conversation` and `history_current`,
-    setting them to empty lists. It is intended to reset the state of the chat and history.
+    Resets the chat conversation and edit history of a session.
+    Other sessions served by this backend are left untouched.
+    Args:
+        request (ResetRequest, optional): The request containing the session ID. Defaults to the "default" session.
     Returns:
         dict: A dictionary containing the status of the reset operation.
     """
-    global chat_conversation
-    chat_conversation = []
-    
-    global history_current
-    history_current = []
+    if request is None:
+        request = ResetRequest()
+    sessions.remove(request.session_id)
 
     return {"status": True}
 
+def create_app(argv=None):
+    """
+    Creates the backend application. The engine and the state live in module globals, so there is one application per process.
+
+    Several worker processes are started by `--workers` behind a session affinity proxy (see `affinity.py`). Do not use
+    uvicorn's own `--workers`, which spreads the concurrent requests of a session over its workers: even with
+    `--session_backend sqlite`, only one of their history updates would be kept.
+
+    Args:
+        argv (list, optional): The command line options. Defaults to None, for the options in the `CURSORWEB_ARGS` environment variable.
+
+    Returns:
+        FastAPI: The application.
+    """
+    if argv is None:
+        argv = shlex.split(os.environ.get("CURSORWEB_ARGS", ""))
+    configure(parser.parse_args(argv))
+
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["http://localhost:8080"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.include_router(routes)
+    return app
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    options = parser.parse_args()
+    if options.workers > 1:
+        # Each worker runs this script with the same options, on its own port
+        run_workers([sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--workers", "1"], options.workers, options.host, options.port, options.read_timeout)
+    else:
+        uvicorn.run(create_app(sys.argv[1:]), host=options.host, port=options.port)
@@ -0,0 +1,75 @@
+import time
+import asyncio
+from scheduler import Shed
+
+class PrefillWarmer:
+    """
+    Sends background "pre-prefill" requests that warm the prefix cache of the inference service.
+
+    With a sliding window over the edit history, the start of the prompt changes every time the window moves,
+    and the model has to prefill everything again. The history snapshots that will open the next window are
+    known as soon as a snapshot is committed, so a `max_tokens`-minimal request with that prefix can be sent
+    ahead of time. The next real request then only has to prefill its tail.
+
+    Args:
+        upstream (Router): The client used to send the requests.
+        min_interval (float, optional): Minimum seconds between two warmup requests of one session. Defaults to 2.0.
+        max_load (int, optional): Warmups are skipped while this many upstream requests are in flight. Defaults to 4.
+        priority (int, optional): The `priority` sent with warmup requests, for inference services
+            with priority scheduling. None to not send it. Defaults to None.
+        scheduler (AdmissionScheduler, optional): If given, warmups are only sent when it has a free slot. Defaults to None.
+    """
+    def __init__(self, upstream, min_interval=2.0, max_load=4, priority=None, scheduler=None):
+        self.upstream = upstream
+        self.min_interval = min_interval
+        self.max_load = max_load
+        self.priority = priority
+        self.scheduler = scheduler
+        self.tasks = set()
+        self.sent = 0
+        self.skipped = 0
+
+    def schedule(self, session, data):
+        """
+        Sends a warmup request in the background, unless the session was warmed up recently
+        or the inference service is busy.
+
+        Args:
+            session (SessionState): The session whose history is warmed up.
+            data (dict): The JSON body of a regular request whose messages are the prefix to warm up.
+
+        Returns:
+            bool: Whether a warmup request was sent.
+        """
+        now = time.monotonic()
+        if now - session.last_warmup < self.min_interval or self.upstream.inflight >= self.max_load:
+            self.skipped += 1
+            return False
+        session.last_warmup = now
+
+        data = dict(data, max_tokens=1)
+        if self.priority is not None:
+            data['priority'] = self.priority
+        task = asyncio.ensure_future(self.warm(data, session.session_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.sent += 1
+        return True
+
+    async def warm(self, data, session_id):
+        if self.scheduler is None:
+            return await self.upstream.chat_completions(data, session_id=session_id)
+        try:
+            async with self.scheduler.slot("warmup", session_id):
+                return await self.upstream.chat_completions(data, session_id=session_id)
+        except Shed:
+            self.skipped += 1
+            return None
+
+    async def close(self):
+        """
+        Cancels the pending warmup requests.
+        """
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,275 @@
+import math
+import time
+import asyncio
+import hashlib
+import httpx
+
+def is_backend_failure(error):
+    """
+    Tells whether an upstream error is the fault of the backend rather than of the request.
+
+    Args:
+        error (httpx.HTTPError): The error raised by the client.
+
+    Returns:
+        bool: False for 4xx statuses, which another backend would answer the same way, True otherwise.
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return True
+
+def rendezvous_score(key, name, weight=1.0):
+    """
+    Computes the weighted rendezvous hashing score of a key on a node.
+
+    Every key goes to the node with the highest score. Adding or removing a node only moves the keys of that node.
+
+    Args:
+        key (str): The key, e.g. a session ID.
+        name (str): The name of the node.
+        weight (float, optional): The relative capacity of the node. Defaults to 1.0.
+
+    Returns:
+        float: The score.
+    """
+    digest = hashlib.sha256(f"{key}:{name}".encode("utf-8")).digest()
+    uniform = (int.from_bytes(digest[:8], "big") + 1) / (2 ** 64 + 2)
+    return -weight / math.log(uniform)
+
+class Backend:
+    """
+    One inference service behind the router, with its health and circuit breaker state.
+
+    The circuit opens after `failure_threshold` consecutive failures, and the backend gets no traffic
+    for `cooldown` seconds. After that, requests are let through again, and the first success closes it.
+
+    Args:
+        client (UpstreamClient): The client of the service.
+        weight (float, optional): The relative capacity of the service. Defaults to 1.0.
+        failure_threshold (int, optional): Consecutive failures that open the circuit. Defaults to 3.
+        cooldown (float, optional): Seconds the circuit stays open. Defaults to 10.0.
+
+    Attributes:
+        healthy (bool): The result of the last active health check.
+        failures (int): The number of consecutive failed requests.
+        open_until (float): The monotonic time until which the circuit is open.
+        requests (int): The number of requests sent to the service.
+    """
+    def __init__(self, client, weight=1.0, failure_threshold=3, cooldown=10.0):
+        self.client = client
+        self.weight = weight
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.healthy = True
+        self.failures = 0
+        self.open_until = 0.0
+        self.requests = 0
+
+    @property
+    def name(self):
+        return self.client.base_url
+
+    @property
+    def load(self):
+        """
+        float: The outstanding requests of the service relative to its weight.
+        """
+        return self.client.inflight / self.weight
+
+    def available(self, now):
+        return self.healthy and now >= self.open_until
+
+    def record_success(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.open_until = time.monotonic() + self.cooldown
+
+    def sticky_score(self, session_id):
+        """
+        Computes the weighted rendezvous hashing score of a session on this backend.
+
+        Every session goes to the backend with the highest score. Adding or removing a backend
+        only moves the sessions of that backend, so the prefix caches of the others stay warm.
+
+        Args:
+            session_id (str): The session ID.
+
+        Returns:
+            float: The score.
+        """
+        return rendezvous_score(session_id, self.name, self.weight)
+
+    def stats(self):
+        return {
+            'base': self.name,
+            'weight': self.weight,
+            'inflight': self.client.inflight,
+            'requests': self.requests,
+            'healthy': self.healthy,
+            'circuit_open': time.monotonic() < self.open_until,
+            'failures': self.failures,
+            'accepts_prediction': self.client.accepts_prediction,
+        }
+
+class Router:
+    """
+    Spreads `chat/completions` requests over several inference services of the same model.
+
+    Requests of a session stick to the backend chosen by rendezvous hashing, so the prefix cache holding
+    the edit history of that session is reused. They leave it for the backend with the fewest outstanding
+    requests (relative to its weight) when the sticky backend is down or more than `sticky_slack` requests
+    busier. Failed requests are retried on another backend while nothing has been streamed yet.
+    The router has the same interface as `UpstreamClient`.
+
+    Args:
+        backends (list): The `Backend`s of the model.
+        sticky_slack (float, optional): How much busier than the least loaded backend the sticky backend
+            of a session may be before the session is routed elsewhere. Defaults to 4.
+        retries (int, optional): How many other backends a failed request is retried on. Defaults to 1.
+        health_interval (float, optional): Seconds between two active health checks, 0 to disable them. Defaults to 10.0.
+    """
+    def __init__(self, backends, sticky_slack=4, retries=1, health_interval=10.0):
+        self.backends = backends
+        self.sticky_slack = sticky_slack
+        self.retries = retries
+        self.health_interval = health_interval
+        self.health_task = None
+
+    @property
+    def inflight(self):
+        """
+        int: The number of requests currently waiting for any backend.
+        """
+        return sum(backend.client.inflight for backend in self.backends)
+
+    async def start(self):
+        """
+        Opens the connection pools and starts the health checks. Must be called from the running event loop.
+        """
+        for backend in self.backends:
+            await backend.client.start()
+        if self.health_interval > 0 and self.health_task is None:
+            self.health_task = asyncio.ensure_future(self.check_health_forever())
+
+    async def close(self):
+        """
+        Stops the health checks and closes the connection pools.
+        """
+        if self.health_task is not None:
+            self.health_task.cancel()
+            await asyncio.gather(self.health_task, return_exceptions=True)
+            self.health_task = None
+        for backend in self.backends:
+            await backend.client.close()
+
+    async def check_health(self):
+        """
+        Checks all backends once and updates their health.
+        """
+        results = await asyncio.gather(*(backend.client.check_health() for backend in self.backends))
+        for backend, healthy in zip(self.backends, results):
+            backend.healthy = healthy
+
+    async def check_health_forever(self):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(self.health_interval)
+
+    def select(self, session_id=None, exclude=()):
+        """
+        Chooses the backend of a request.
+
+        Args:
+            session_id (str, optional): The session of the request, None for no stickiness.
+            exclude (tuple, optional): Backends that already failed for this request.
+
+        Returns:
+            Backend: The chosen backend. If every backend is down, the least loaded one is tried anyway.
+        """
+        candidates = [backend for backend in self.backends if backend not in exclude] or self.backends
+        now = time.monotonic()
+        candidates = [backend for backend in candidates if backend.available(now)] or candidates
+        least_loaded = min(candidates, key=lambda backend: backend.load)
+        if session_id is None:
+            return least_loaded
+        sticky = max(candidates, key=lambda backend: backend.sticky_score(session_id))
+        if sticky.load - least_loaded.load <= self.sticky_slack:
+            return sticky
+        return least_loaded
+
+    async def chat_completions(self, data, session_id=None):
+        """
+        Sends a `chat/completions` request to the chosen backend.
+
+        Args:
+            data (dict): The JSON body of the request.
+            session_id (str, optional): The session of the request, used for sticky routing.
+
+        Returns:
+            dict: The decoded JSON response, or None if the request failed or returned a non-200 status.
+        """
+        tried = []
+        while True:
+            backend = self.select(session_id, tried)
+            backend.requests += 1
+            try:
+                response = await backend.client.post_chat_completions(data)
+            except httpx.HTTPError as e:
+                print(e)
+                response = None
+            if response is not None and response.status_code < 500:
+                backend.record_success()
+                return response.json() if response.status_code == 200 else None
+            backend.record_failure()
+            tried.append(backend)
+            if len(tried) > self.retries or len(tried) >= len(self.backends):
+                return None
+
+    async def stream_chat_completions(self, data, session_id=None, usage=None):
+        """
+        Sends a streaming `chat/completions` request to the chosen backend and yields the generated text as it arrives.
+
+        Args:
+            data (dict): The JSON body of the request. `stream` is set to True automatically.
+            session_id (str, optional): The session of the request, used for sticky routing.
+            usage (dict, optional): If given, the token usage reported at the end of the stream is stored in it.
+
+        Yields:
+            str: The content delta of each server-sent event.
+
+        Raises:
+            httpx.HTTPError: If the request fails on every backend tried, or after it started streaming.
+        """
+        tried = []
+        while True:
+            backend = self.select(session_id, tried)
+            backend.requests += 1
+            streamed = False
+            try:
+                async for delta in backend.client.stream_chat_completions(data, usage=usage):
+                    streamed = True
+                    yield delta
+            except httpx.HTTPError as e:
+                if not is_backend_failure(e):
+                    raise
+                backend.record_failure()
+                tried.append(backend)
+                if streamed or len(tried) > self.retries or len(tried) >= len(self.backends):
+                    raise
+                print(e)
+                continue
+            backend.record_success()
+            return
+
+    def stats(self):
+        """
+        Returns the state of every backend.
+
+        Returns:
+            list: The base URL, weight, outstanding and total requests, health, circuit state and predicted output support of each backend.
+        """
+        return [backend.stats() for backend in self.backends]
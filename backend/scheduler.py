@@ -0,0 +1,181 @@
+import time
+import bisect
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+
+# Lower values are served first: explicit user actions, then suggestions, then background requests
+PRIORITIES = {"inline": 0, "chat": 1, "tab": 2, "chat_summary": 3, "warmup": 4}
+
+class Shed(Exception):
+    """
+    Raised when a request is dropped because it would wait in the queue past its deadline.
+    """
+
+class AdmissionScheduler:
+    """
+    Admits upstream requests by priority class, so that background requests cannot starve explicit user actions.
+
+    At most `max_inflight` requests are sent to the model at once, and at most `session_limit` per session.
+    The others wait in one queue ordered by class (inline > chat > tab > chat summaries > warmup) and arrival. A request of a class
+    with a deadline is shed as soon as its expected wait exceeds the deadline, or once it has waited that long.
+    The expected wait is estimated from the requests queued before it and the rate at which slots free up: with every slot
+    busy, one finishes every `service_time / max_inflight` seconds on average, since the slots are held in parallel.
+
+    Args:
+        max_inflight (int): Maximum number of requests sent to the model at once.
+        session_limit (int, optional): Maximum number of requests of one session sent at once, 0 for no limit. Defaults to 0.
+        deadlines (dict, optional): Seconds a request of each class may wait, classes without one wait as long as needed. Defaults to None.
+        priorities (dict, optional): The priority of each class, lower first. Defaults to `PRIORITIES`.
+
+    Attributes:
+        inflight (int): The number of admitted requests.
+        shed (dict): The number of shed requests per class.
+        service_time (float): The exponential moving average of the seconds a request holds its slot.
+    """
+    def __init__(self, max_inflight, session_limit=0, deadlines=None, priorities=PRIORITIES):
+        self.max_inflight = max_inflight
+        self.session_limit = session_limit
+        self.deadlines = deadlines or {}
+        self.priorities = priorities
+        self.inflight = 0
+        self.sessions = {}
+        self.waiters = []
+        self.counter = itertools.count()
+        self.shed = {kind: 0 for kind in priorities}
+        self.service_time = None
+
+    def session_allows(self, session_id):
+        return self.session_limit <= 0 or session_id is None or self.sessions.get(session_id, 0) < self.session_limit
+
+    def queued(self):
+        """
+        Returns:
+            dict: The number of waiting requests per class.
+        """
+        counts = {kind: 0 for kind in self.priorities}
+        for _, _, kind, _, future in self.waiters:
+            if not future.done():
+                counts[kind] += 1
+        return counts
+
+    def expected_wait(self, priority):
+        """
+        Estimates how long a new request of a priority would wait.
+
+        Args:
+            priority (int): The priority of the request.
+
+        Returns:
+            float: The estimated seconds, 0 before any request finished.
+        """
+        if self.service_time is None:
+            return 0.0
+        # The request is admitted after one slot frees up for each waiting request up to it, itself included
+        ahead = sum(1 for waiter in self.waiters if waiter[0] <= priority and not waiter[4].done())
+        return ahead * self.service_time / self.max_inflight
+
+    def grant(self, session_id):
+        self.inflight += 1
+        if session_id is not None:
+            self.sessions[session_id] = self.sessions.get(session_id, 0) + 1
+
+    def dispatch(self):
+        """
+        Admits the waiting requests in priority order while there is capacity, skipping sessions at their limit.
+        """
+        index = 0
+        while index < len(self.waiters) and self.inflight < self.max_inflight:
+            _, _, _, session_id, future = self.waiters[index]
+            if future.done():
+                del self.waiters[index]
+            elif self.session_allows(session_id):
+                del self.waiters[index]
+                self.grant(session_id)
+                future.set_result(None)
+            else:
+                index += 1
+
+    def remove(self, waiter):
+        index = bisect.bisect_left(self.waiters, waiter[:2], key=lambda entry: entry[:2])
+        if index < len(self.waiters) and self.waiters[index] is waiter:
+            del self.waiters[index]
+
+    async def acquire(self, kind, session_id=None):
+        """
+        Waits until a request may be sent to the model.
+
+        Args:
+            kind (str): The class of the request, a key of the priorities.
+            session_id (str, optional): The session of the request. Defaults to None.
+
+        Raises:
+            Shed: If the request would wait past the deadline of its class.
+        """
+        priority = self.priorities[kind]
+        deadline = self.deadlines.get(kind)
+        future = asyncio.get_running_loop().create_future()
+        waiter = (priority, next(self.counter), kind, session_id, future)
+        bisect.insort(self.waiters, waiter, key=lambda entry: entry[:2])
+        self.dispatch()
+        if future.done():
+            return
+        if deadline is not None and self.expected_wait(priority) > deadline:
+            self.remove(waiter)
+            future.cancel()
+            self.shed[kind] += 1
+            raise Shed(kind)
+        try:
+            await asyncio.wait_for(future, deadline)
+        except asyncio.TimeoutError:
+            # wait_for may time out after the request was admitted, it then holds its slot
+            if future.done() and not future.cancelled():
+                return
+            self.remove(waiter)
+            self.shed[kind] += 1
+            raise Shed(kind)
+        except asyncio.CancelledError:
+            # Admitted right before the request was cancelled, the slot is given back
+            if future.done() and not future.cancelled():
+                self.release(session_id)
+            else:
+                self.remove(waiter)
+            raise
+
+    def release(self, session_id=None, held=None):
+        """
+        Frees the slot of a finished request and admits the next ones.
+
+        Args:
+            session_id (str, optional): The session of the request. Defaults to None.
+            held (float, optional): The seconds the request held its slot, to update the service time. Defaults to None.
+        """
+        self.inflight -= 1
+        if session_id is not None:
+            count = self.sessions.get(session_id, 0) - 1
+            if count > 0:
+                self.sessions[session_id] = count
+            else:
+                self.sessions.pop(session_id, None)
+        if held is not None:
+            self.service_time = held if self.service_time is None else 0.8 * self.service_time + 0.2 * held
+        self.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, kind, session_id=None):
+        """
+        Holds a slot for the duration of a block, see `acquire`.
+
+        Args:
+            kind (str): The class of the request.
+            session_id (str, optional): The session of the request. Defaults to None.
+
+        Raises:
+            Shed: If the request would wait past the deadline of its class.
+        """
+        await self.acquire(kind, session_id)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(session_id, time.perf_counter() - start)
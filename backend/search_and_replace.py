@@ -4,8 +4,8 @@ import re
 from dataclasses import dataclass
 from functools import lru_cache
 
-from rapidfuzz import fuzz
-from tqdm import tqdm
+import numpy as np
+from rapidfuzz import fuzz, process
 
 
 @lru_cache()
@@ -41,56 +41,144 @@ def line_cost(line: str) -> float:
     return len(line) / (len(line) + 1) * 100
 
 
-def score_multiline(query: list[str], target: list[str]) -> float:
+def score_multiline(
+    query: list[str], target: list[str], target_values: np.ndarray | None = None
+) -> float:
     # TODO: add weighting on first and last lines
+    # target_values optionally holds the precomputed (100 - line_cost(line)) * 100 of every target line,
+    # so the unmatched tail of a long target is summed in C instead of line by line.
+    # An ellipsis scores the rest of the query against every suffix of the target, and with several
+    # ellipses the same (query suffix, target suffix) pairs come up again and again, so each pair is
+    # scored once. There are at most (ellipses + 1) * len(target) pairs, instead of exponentially many calls.
+    memo: dict[tuple[int, int], float] = {}
+
+    def score_suffix(qs: int, ts: int) -> float:
+        # Scores query[qs:] against target[ts:], q and t are relative to qs and ts
+        if (qs, ts) in memo:
+            return memo[(qs, ts)]
+        query_length, target_length = len(query) - qs, len(target) - ts
+
+        q, t = 0, 0  # indices for query and target
+        scores: list[tuple[float, float]] = []
+        skipped_comments = 0
+
+        def get_weight(q: int) -> float:
+            # Prefers lines at beginning and end of query
+            # Sequence: 1, 2/3, 1/2, 2/5...
+            index = min(q, query_length - q)
+            return 100 / (index / 2 + 1)
+
+        while q < query_length and t < target_length:
+            q_line = query[qs + q]
+            t_line = target[ts + t]
+            weight = get_weight(q)
+
+            if match_without_whitespace(q_line, t_line):
+                # Case 1: lines match
+                scores.append((score_line(q_line, t_line), weight))
+                q += 1
+                t += 1
+            elif q_line.strip().startswith("...") or q_line.strip().endswith("..."):
+                # Case 3: ellipsis wildcard
+                t += 1
+                if q + 1 == query_length:
+                    scores.append((100 - (target_length - t), weight))
+                    q += 1
+                    t = target_length
+                    break
+                max_score = 0
+                # Radix optimization
+                indices = [
+                    t + i
+                    for i, line in enumerate(target[ts + t :])
+                    if match_without_whitespace(line, query[qs + q + 1])
+                ]
+                if not indices:
+                    indices = range(t, target_length)
+                for i in indices:
+                    score, weight = score_suffix(qs + q + 1, ts + i), (
+                        100 - (i - t) / target_length * 10
+                    )
+                    new_scores = scores + [(score, weight)]
+                    total_score = sum(
+                        [value * weight for value, weight in new_scores]
+                    ) / sum([weight for _, weight in new_scores])
+                    max_score = max(max_score, total_score)
+                memo[(qs, ts)] = max_score
+                return max_score
+            elif (
+                t_line.strip() == ""
+                or t_line.strip().startswith("#")
+                or t_line.strip().startswith("//")
+                or t_line.strip().startswith("print")
+                or t_line.strip().startswith("logger")
+                or t_line.strip().startswith("console.")
+            ):
+                # Case 2: skipped comment
+                skipped_comments += 1
+                t += 1
+                scores.append((90, weight))
+            else:
+                break
+
+        if q < query_length:
+            scores.extend(
+                (100 - line_cost(line), get_weight(index))
+                for index, line in enumerate(query[qs + q :])
+            )
+        if t < target_length and target_values is not None:
+            # Same left-to-right summation as below, np.add.accumulate is strictly sequential
+            weighted_sum = np.add.accumulate(
+                np.concatenate(([sum([value * weight for value, weight in scores])], target_values[ts + t :]))
+            )[-1]
+            weight_sum = np.add.accumulate(
+                np.concatenate(([sum([weight for _, weight in scores])], np.full(target_length - t, 100.0)))
+            )[-1]
+            final_score = float(weighted_sum / weight_sum)
+        else:
+            if t < target_length:
+                scores.extend(
+                    (100 - line_cost(line), 100) for line in target[ts + t :]
+                )
+
+            final_score = (
+                sum([value * weight for value, weight in scores])
+                / sum([weight for _, weight in scores])
+                if scores
+                else 0
+            )
+        final_score *= 1 - 0.05 * skipped_comments
+
+        memo[(qs, ts)] = final_score
+        return final_score
 
-    q, t = 0, 0  # indices for query and target
+    return score_suffix(0, 0)
+
+
+def match_prefix(query: list[str], lines: list[str], start: int):
+    # The line-by-line loop of score_multiline(query, lines[start:]), which stops at the first line
+    # it cannot match. Returns (scores, t, skipped_comments), or None if it reaches an ellipsis,
+    # whose score depends on the length of the target.
+    query_length, target_length = len(query), len(lines) - start
+    q, t = 0, 0
     scores: list[tuple[float, float]] = []
     skipped_comments = 0
 
     def get_weight(q: int) -> float:
-        # Prefers lines at beginning and end of query
-        # Sequence: 1, 2/3, 1/2, 2/5...
-        index = min(q, len(query) - q)
+        index = min(q, query_length - q)
         return 100 / (index / 2 + 1)
 
-    while q < len(query) and t < len(target):
+    while q < query_length and t < target_length:
         q_line = query[q]
-        t_line = target[t]
+        t_line = lines[start + t]
         weight = get_weight(q)
 
         if match_without_whitespace(q_line, t_line):
-            # Case 1: lines match
             scores.append((score_line(q_line, t_line), weight))
             q += 1
             t += 1
         elif q_line.strip().startswith("...") or q_line.strip().endswith("..."):
-            # Case 3: ellipsis wildcard
-            t += 1
-            if q + 1 == len(query):
-                scores.append((100 - (len(target) - t), weight))
-                q += 1
-                t = len(target)
-                break
-            max_score = 0
-            # Radix optimization
-            indices = [
-                t + i
-                for i, line in enumerate(target[t:])
-                if match_without_whitespace(line, query[q + 1])
-            ]
-            if not indices:
-                indices = range(t, len(target))
-            for i in indices:
-                score, weight = score_multiline(query[q + 1 :], target[i:]), (
-                    100 - (i - t) / len(target) * 10
-                )
-                new_scores = scores + [(score, weight)]
-                total_score = sum(
-                    [value * weight for value, weight in new_scores]
-                ) / sum([weight for _, weight in new_scores])
-                max_score = max(max_score, total_score)
-            return max_score
+            return None
         elif (
             t_line.strip() == ""
             or t_line.strip().startswith("#")
@@ -99,32 +187,63 @@ def score_multiline(query: list[str], target: list[str]) -> float:
             or t_line.strip().startswith("logger")
             or t_line.strip().startswith("console.")
         ):
-            # Case 2: skipped comment
             skipped_comments += 1
             t += 1
             scores.append((90, weight))
         else:
             break
 
-    if q < len(query):
+    if q < query_length:
         scores.extend(
             (100 - line_cost(line), get_weight(index))
             for index, line in enumerate(query[q:])
         )
-    if t < len(target):
-        scores.extend(
-            (100 - line_cost(line), 100) for index, line in enumerate(target[t:])
+    return scores, t, skipped_comments
+
+
+def score_multiline_ends(
+    query: list[str], index: "LineIndex", start: int, ends: np.ndarray, exact_score: float = 99.99
+) -> np.ndarray:
+    """
+    Computes score_multiline(query, lines[start:end + 1], tail_values[start:end + 1]) for every end at once.
+
+    Until it stops, the loop of score_multiline reads the same lines of every target starting at `start`,
+    so it runs once on the rest of the file. The targets longer than the lines it read only differ in their
+    unmatched tail, and one sequential np.add.accumulate gives the sum of every tail in the same order as
+    score_multiline, so the scores are bit-identical. Shorter targets and queries reaching an ellipsis are
+    scored one by one, and like the search they stop at the first score of at least `exact_score`:
+    the scores returned are those of the ends up to it.
+    """
+    raw_scores = np.empty(len(ends), dtype=np.float64)
+    prefix = match_prefix(query, index.lines, start)
+    if prefix is None:
+        long_ends = np.zeros(len(ends), dtype=bool)
+    else:
+        scores, t, skipped_comments = prefix
+        long_ends = ends - start + 1 > t
+    if long_ends.any():
+        tail_start = start + t
+        tail_end = int(ends[long_ends].max()) + 1
+        weighted_sums = np.add.accumulate(
+            np.concatenate(([sum([value * weight for value, weight in scores])], index.tail_values[tail_start:tail_end]))
         )
-
-    final_score = (
-        sum([value * weight for value, weight in scores])
-        / sum([weight for _, weight in scores])
-        if scores
-        else 0
-    )
-    final_score *= 1 - 0.05 * skipped_comments
-
-    return final_score
+        weight_sums = np.add.accumulate(
+            np.concatenate(([sum([weight for _, weight in scores])], np.full(tail_end - tail_start, 100.0)))
+        )
+        tail_lengths = ends[long_ends] + 1 - tail_start
+        raw_scores[long_ends] = (
+            weighted_sums[tail_lengths] / weight_sums[tail_lengths]
+        ) * (1 - 0.05 * skipped_comments)
+    exact = np.flatnonzero(long_ends & (raw_scores >= exact_score))
+    stop = int(exact[0]) if len(exact) else len(ends)
+    for k in np.flatnonzero(~long_ends[:stop]).tolist():
+        end = int(ends[k])
+        raw_scores[k] = score_multiline(
+            query, index.lines[start : end + 1], index.tail_values[start : end + 1]
+        )
+        if raw_scores[k] >= exact_score:
+            return raw_scores[: k + 1]
+    return raw_scores[: stop + 1]
 
 
 @dataclass
@@ -150,26 +269,108 @@ def get_max_indent(content: str, indent_type: str):
         indent_type
     )
 
-# Bug: raise "not enough values to unpack (expected 2, got 1)" for some inputs
+@dataclass
+class LineIndex:
+    """
+    A per-file index used to score every line of the file against a query line at once.
+
+    lines: the lines of the file.
+    exact, lstripped, stripped: maps from a line, its left-stripped and its stripped form to the line numbers.
+    lengths: the length of every line.
+    tail_values: (100 - line_cost(line)) * 100 for every line, the weighted score of an unmatched target line.
+    indent: the indentation unit of the file, max_indents: its deepest indentation level.
+    """
+
+    lines: list[str]
+    exact: dict[str, list[int]]
+    lstripped: dict[str, list[int]]
+    stripped: dict[str, list[int]]
+    lengths: np.ndarray
+    tail_values: np.ndarray
+    indent: str
+    max_indents: int
+
+
+@lru_cache(maxsize=16)
+def build_line_index(code_file: str) -> LineIndex:
+    lines = code_file.split("\n")
+    exact: dict[str, list[int]] = {}
+    lstripped: dict[str, list[int]] = {}
+    stripped: dict[str, list[int]] = {}
+    for i, line in enumerate(lines):
+        exact.setdefault(line, []).append(i)
+        lstripped.setdefault(line.lstrip(), []).append(i)
+        stripped.setdefault(line.strip(), []).append(i)
+    indent = get_indent_type(code_file)
+    return LineIndex(
+        lines=lines,
+        exact=exact,
+        lstripped=lstripped,
+        stripped=stripped,
+        lengths=np.array([len(line) for line in lines], dtype=np.float64),
+        tail_values=np.array(
+            [(100 - line_cost(line)) * 100 for line in lines], dtype=np.float64
+        ),
+        indent=indent,
+        max_indents=get_max_indent(code_file, indent),
+    )
+
+
+
+def score_lines(index: LineIndex, query_line: str) -> np.ndarray:
+    """
+    Computes score_line(line, query_line) for every line of the file in one batch.
+    The fuzzy ratios come from a single vectorized call, then the lines that only differ
+    in whitespace are overridden from the hash maps, most specific case last.
+    """
+    ratios = process.cdist(
+        [query_line], index.lines, scorer=fuzz.ratio, dtype=np.float64, workers=1
+    )[0]
+    scores = 85 * (ratios / 100)
+    query_length = len(query_line)
+    for lookup, key, base in (
+        (index.stripped, query_line.strip(), 80),
+        (index.lstripped, query_line.lstrip(), 90),
+    ):
+        matches = lookup.get(key)
+        if matches:
+            lengths = index.lengths[matches]
+            # Both lengths are 0 only for an exact match, which is overridden below
+            with np.errstate(divide="ignore", invalid="ignore"):
+                whitespace_ratio = np.abs(lengths - query_length) / (lengths + query_length)
+            scores[matches] = np.maximum(base - whitespace_ratio * 10, 0)
+    matches = index.exact.get(query_line)
+    if matches:
+        scores[matches] = 100
+    return scores
+
+
+def top_indices(scores: np.ndarray, truncate: int) -> np.ndarray:
+    # Same order as a stable sort by descending score
+    return np.argsort(-scores, kind="stable")[:truncate]
+
+
 def find_best_match(query: str, code_file: str):
     best_match = Match(-1, -1, 0)
 
-    code_file_lines = code_file.split("\n")
+    index = build_line_index(code_file)
+    code_file_lines = index.lines
     query_lines = query.split("\n")
     if len(query_lines) > 0 and query_lines[-1].strip() == "...":
         query_lines = query_lines[:-1]
     if len(query_lines) > 0 and query_lines[0].strip() == "...":
         query_lines = query_lines[1:]
-    indent = get_indent_type(code_file)
-    max_indents = get_max_indent(code_file, indent)
+    indent = index.indent
+    max_indents = index.max_indents
 
-    top_matches = []
+    # The first match of the highest score, as the first of the matches sorted by descending score
+    top_match = None
 
     if len(query_lines) == 1:
-        for i, line in enumerate(code_file_lines):
-            score = score_line(line, query_lines[0])
-            if score > best_match.score:
-                best_match = Match(i, i + 1, score)
+        scores = score_lines(index, query_lines[0])
+        i = int(np.argmax(scores))
+        if scores[i] > best_match.score:
+            best_match = Match(i, i + 1, float(scores[i]))
         return best_match
 
     truncate = min(40, len(code_file_lines) // 5)
@@ -182,54 +383,29 @@ def find_best_match(query: str, code_file: str):
     for num_indents in indent_array:
         indented_query_lines = [indent * num_indents + line for line in query_lines]
 
-        start_pairs = [
-            (i, score_line(line, indented_query_lines[0]))
-            for i, line in enumerate(code_file_lines)
-        ]
-        start_pairs.sort(key=lambda x: x[1], reverse=True)
-        start_pairs = start_pairs[:truncate]
-        start_indices = [i for i, _ in start_pairs]
-
-        for i in tqdm(
-            start_indices,
-            position=0,
-            desc=f"Indent {num_indents}/{max_indents}",
-            leave=False,
-        ):
-            end_pairs = [
-                (j, score_line(line, indented_query_lines[-1]))
-                for j, line in enumerate(code_file_lines[i:], start=i)
-            ]
-            end_pairs.sort(key=lambda x: x[1], reverse=True)
-            end_pairs = end_pairs[:truncate]
-            end_indices = [j for j, _ in end_pairs]
-
-            for j in tqdm(
-                end_indices, position=1, leave=False, desc=f"Starting line {i}"
-            ):
-                candidate = code_file_lines[i : j + 1]
-                raw_score = score_multiline(indented_query_lines, candidate)
-
-                score = raw_score * (1 - num_indents * 0.01)
-                current_match = Match(i, j + 1, score, indent * num_indents)
+        start_indices = top_indices(score_lines(index, indented_query_lines[0]), truncate)
+        # A stable order over the whole file, filtered to the lines after a start, is the stable order of those lines
+        end_order = top_indices(score_lines(index, indented_query_lines[-1]), len(code_file_lines))
 
-                if raw_score >= 99.99:  # early exit, 99.99 for floating point error
-                    return current_match
+        for i in start_indices.tolist():
+            end_indices = end_order[end_order >= i][:truncate]
+            if len(end_indices) == 0:
+                continue
 
-                top_matches.append(current_match)
+            # early exit, 99.99 for floating point error
+            raw_scores = score_multiline_ends(indented_query_lines, index, i, end_indices, 99.99)
+            scores = raw_scores * (1 - num_indents * 0.01)
 
-                if score > best_match.score:
-                    best_match = current_match
+            if raw_scores[-1] >= 99.99:
+                k = len(raw_scores) - 1
+                return Match(i, int(end_indices[k]) + 1, float(scores[k]), indent * num_indents)
 
-    unique_top_matches: list[Match] = []
-    unique_spans = set()
-    for top_match in sorted(top_matches, reverse=True):
-        if (top_match.start, top_match.end) not in unique_spans:
-            unique_top_matches.append(top_match)
-            unique_spans.add((top_match.start, top_match.end))
+            k = int(np.argmax(scores))
+            if top_match is None or scores[k] > top_match.score:
+                top_match = Match(i, int(end_indices[k]) + 1, float(scores[k]), indent * num_indents)
 
     # Todo: on_comment file comments able to modify multiple files
-    return unique_top_matches[0] if unique_top_matches else Match(-1, -1, 0)
+    return top_match if top_match is not None else Match(-1, -1, 0)
 
 
 def split_ellipses(query: str) -> list[str]:
@@ -0,0 +1,321 @@
+import time
+import uuid
+import pickle
+import sqlite3
+from collections import OrderedDict
+from utils import ContinuityTracker
+from edit_history import EditHistory
+
+class SessionState:
+    """
+    The per-session state of one editor: its edit history and its chat history.
+
+    Args:
+        session_id (str, optional): The session ID sent by the client. Defaults to None.
+
+    Attributes:
+        session_id (str): The session ID, also used to route the requests of the session to the same backend.
+        history (EditHistory): The recorded code snapshots, the last one being the code currently edited.
+        chat (list): The chat conversation as a list of `{'role', 'content'}` messages.
+        chat_summary (str): The summary of the chat messages removed by `ChatContext`.
+        chat_task (asyncio.Task): The pending summary of the oldest chat messages, if any.
+        size (int): The size of the state in characters, as of the last `SessionStore.update`.
+        last_access (float): The monotonic time of the last access.
+        tab_seq (int): The sequence number of the latest tab request.
+        tab_task (asyncio.Task): The in-flight upstream call of the latest tab request, if any.
+        last_warmup (float): The monotonic time of the last prefix cache warmup request.
+        continuity (ContinuityTracker): The incremental continuity check of the edit history.
+        hunk_queue (dict): The last tab suggestion (`final`) and the code expected once its first hunk is accepted (`expected`).
+        tab_candidates (dict): The ranked candidates of the last tab suggestion (`candidates`), the code they were
+            generated for (`code`) and the index of the one shown (`index`), see `main.complete_tab`.
+        history_start (int): The index of the first history snapshot in the prompt, see `HistoryCompactor`.
+        history_renders (dict): The cached renderings of history snapshots, keyed by the IDs of the previous and the rendered snapshot.
+    """
+    # The recorded state, shared between worker processes by `SQLiteSessionStore`
+    PERSISTENT = ("history", "chat", "chat_summary", "hunk_queue", "tab_candidates", "history_start")
+
+    def __init__(self, session_id=None):
+        self.session_id = session_id
+        self.history = EditHistory()
+        self.chat = []
+        self.chat_summary = ""
+        self.chat_task = None
+        self.size = 0
+        self.last_access = time.monotonic()
+        self.tab_seq = 0
+        self.tab_task = None
+        self.last_warmup = float('-inf')
+        self.continuity = ContinuityTracker()
+        self.hunk_queue = None
+        self.tab_candidates = None
+        self.history_start = 0
+        self.history_renders = {}
+
+    def compute_size(self):
+        """
+        Computes the size of the state in characters.
+
+        Returns:
+            int: The stored length of the code snapshots, and the total length of the chat messages and the chat summary.
+        """
+        return self.history.size + sum(len(message['content']) for message in self.chat) + len(self.chat_summary)
+
+    def dump(self):
+        """
+        Serializes the recorded state of the session. The requests in flight and the caches are left out.
+
+        Returns:
+            bytes: The serialized state.
+        """
+        return pickle.dumps({name: getattr(self, name) for name in self.PERSISTENT}, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, data):
+        """
+        Replaces the recorded state of the session by a serialized one, see `dump`.
+
+        Args:
+            data (bytes): The serialized state.
+        """
+        for name, value in pickle.loads(data).items():
+            setattr(self, name, value)
+        # Both refer to the replaced history
+        self.continuity = ContinuityTracker()
+        self.history_renders = {}
+
+class SessionStore:
+    """
+    A session-keyed store with bounded memory, idle expiry and LRU eviction.
+
+    This is the session backend of a single process, `SQLiteSessionStore` shares the sessions between worker processes.
+    A session backend provides `get`, `update` after every change of a session, `remove`, `close` and `len`.
+
+    Args:
+        session_max_chars (int, optional): Per-session cap in characters. When exceeded, the oldest edit
+            history snapshots and then the oldest chat messages are dropped. 0 disables the cap. Defaults to 0.
+        total_max_chars (int, optional): Cap in characters over all sessions. When exceeded, the least
+            recently used sessions are evicted. 0 disables the cap. Defaults to 0.
+        ttl (float, optional): Seconds after which an idle session is evicted. 0 disables expiry. Defaults to 0.
+    """
+    def __init__(self, session_max_chars=0, total_max_chars=0, ttl=0):
+        self.session_max_chars = session_max_chars
+        self.total_max_chars = total_max_chars
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.total_size = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, session_id):
+        """
+        Returns the state of a session, creating it if needed, and marks it as most recently used.
+
+        Args:
+            session_id (str): The session ID sent by the client.
+
+        Returns:
+            SessionState: The state of the session.
+        """
+        self.expire()
+        state = self.sessions.get(session_id)
+        if state is None:
+            state = SessionState(session_id)
+            self.sessions[session_id] = state
+        else:
+            self.sessions.move_to_end(session_id)
+        state.last_access = time.monotonic()
+        return state
+
+    def update(self, session_id):
+        """
+        Re-measures a session after it has been modified and enforces the memory caps.
+
+        Args:
+            session_id (str): The session ID sent by the client.
+        """
+        state = self.sessions.get(session_id)
+        if state is None:
+            return
+        size = state.compute_size()
+        if self.session_max_chars > 0 and size > self.session_max_chars:
+            # Keep the last two snapshots, they are needed for the continuity check
+            while size > self.session_max_chars and len(state.history) > 2:
+                stored = state.history.size
+                state.history.pop(0)
+                size -= stored - state.history.size
+                state.history_start = max(state.history_start - 1, 0)
+            while size > self.session_max_chars and len(state.chat) > 2:
+                size -= len(state.chat.pop(0)['content'])
+        self.total_size += size - state.size
+        state.size = size
+        if self.total_max_chars > 0:
+            while self.total_size > self.total_max_chars and len(self.sessions) > 1:
+                oldest = next(iter(self.sessions))
+                if oldest == session_id:
+                    break
+                self.evict(oldest)
+
+    def evict(self, session_id):
+        """
+        Drops a session from memory.
+
+        Args:
+            session_id (str): The session ID sent by the client.
+        """
+        state = self.sessions.pop(session_id, None)
+        if state is not None:
+            self.total_size -= state.size
+
+    def remove(self, session_id):
+        """
+        Removes a session from the store.
+
+        Args:
+            session_id (str): The session ID sent by the client.
+        """
+        self.evict(session_id)
+
+    def close(self):
+        """
+        Releases the resources of the store.
+        """
+
+    def expire(self):
+        """
+        Evicts the sessions that have been idle for longer than the TTL.
+        """
+        if self.ttl <= 0:
+            return
+        deadline = time.monotonic() - self.ttl
+        while self.sessions:
+            oldest = next(iter(self.sessions))
+            if self.sessions[oldest].last_access > deadline:
+                break
+            self.evict(oldest)
+
+class SQLiteSessionStore(SessionStore):
+    """
+    A session store shared by the worker processes of one host through a SQLite database.
+
+    Each worker holds the sessions it serves in memory like `SessionStore`, and writes a session through to the database
+    on every `update`. `get` compares the version of the session in the database with the one the worker last saw, and
+    reloads the session if another worker has written, reset or expired it since. With session affinity this is a single
+    indexed lookup per request, and a session is only reloaded when it moves to another worker, e.g. after a restart.
+    Only the recorded state is shared (see `SessionState.dump`), the requests in flight stay in their worker.
+
+    A write only replaces the version the worker last saw. If another worker has written the session since, the write
+    is rejected and counted in `conflicts`, and the worker reloads the session from the database. Nothing is merged,
+    so concurrent requests of one session on several workers lose the updates of all but one of them. The sessions
+    should therefore stay on one worker, as with `--workers`.
+
+    The calls to the database are synchronous and run on the event loop. A write waits at most `busy_timeout` for the
+    lock of another worker, and is skipped if it cannot get it: the session stays in memory and the next write retries.
+
+    The memory caps apply to the sessions held by the worker. A session evicted from memory stays in the database,
+    until it has been idle for the TTL.
+
+    Args:
+        path (str): The path of the database file, created if needed.
+        session_max_chars (int, optional): See `SessionStore`. Defaults to 0.
+        total_max_chars (int, optional): See `SessionStore`. Defaults to 0.
+        ttl (float, optional): See `SessionStore`. Defaults to 0.
+        busy_timeout (float, optional): Seconds a query waits for the database lock. Defaults to 0.05.
+
+    Attributes:
+        conflicts (int): The number of writes rejected because another worker had written the session.
+    """
+    def __init__(self, path, session_max_chars=0, total_max_chars=0, ttl=0, busy_timeout=0.05):
+        super().__init__(session_max_chars=session_max_chars, total_max_chars=total_max_chars, ttl=ttl)
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=busy_timeout)
+        # Readers do not block the writer, and commits are only synced at checkpoints
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, version TEXT NOT NULL, updated REAL NOT NULL, state BLOB NOT NULL)")
+        self.versions = {}
+        self.conflicts = 0
+        self.last_sweep = 0.0
+
+    def get(self, session_id):
+        try:
+            row = self.db.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            version = row[0] if row is not None else None
+            if version == self.versions.get(session_id):
+                return super().get(session_id)
+            return self.reload(session_id)
+        except sqlite3.OperationalError as e:
+            # The database is busy, the session is served from memory
+            print(e)
+            return super().get(session_id)
+
+    def reload(self, session_id):
+        """
+        Replaces the session held in memory with the one in the database.
+
+        Args:
+            session_id (str): The session ID sent by the client.
+
+        Returns:
+            SessionState: The state of the session, reset if it is no longer in the database.
+        """
+        row = self.db.execute("SELECT version, state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            # Reset or expired by another worker
+            self.evict(session_id)
+            return super().get(session_id)
+        # Loaded into the state held in memory, if any, so that its requests in flight keep working
+        state = super().get(session_id)
+        state.load(row[1])
+        self.versions[session_id] = row[0]
+        super().update(session_id)
+        return state
+
+    def update(self, session_id):
+        super().update(session_id)
+        state = self.sessions.get(session_id)
+        if state is None:
+            return
+        seen = self.versions.get(session_id)
+        version = uuid.uuid4().hex
+        try:
+            if seen is None:
+                cursor = self.db.execute(
+                    "INSERT OR IGNORE INTO sessions (session_id, version, updated, state) VALUES (?, ?, ?, ?)",
+                    (session_id, version, time.time(), state.dump()),
+                )
+            else:
+                cursor = self.db.execute(
+                    "UPDATE sessions SET version = ?, updated = ?, state = ? WHERE session_id = ? AND version = ?",
+                    (version, time.time(), state.dump(), session_id, seen),
+                )
+            if cursor.rowcount == 1:
+                self.versions[session_id] = version
+                return
+            # Written, reset or expired by another worker since this one read it
+            self.conflicts += 1
+            self.reload(session_id)
+        except sqlite3.OperationalError as e:
+            print(e)
+
+    def evict(self, session_id):
+        super().evict(session_id)
+        self.versions.pop(session_id, None)
+
+    def remove(self, session_id):
+        super().remove(session_id)
+        try:
+            self.db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        except sqlite3.OperationalError as e:
+            print(e)
+
+    def expire(self):
+        super().expire()
+        now = time.time()
+        if self.ttl > 0 and now - self.last_sweep > min(self.ttl, 60):
+            self.last_sweep = now
+            try:
+                self.db.execute("DELETE FROM sessions WHERE updated < ?", (now - self.ttl,))
+            except sqlite3.OperationalError as e:
+                print(e)
+
+    def close(self):
+        self.db.close()
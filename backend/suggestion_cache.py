@@ -0,0 +1,140 @@
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+class SuggestionCache:
+    """
+    An LRU and TTL cache of postprocessed suggestions with single-flight deduplication.
+
+    Requests whose upstream body (model, sampling parameters and constructed messages), code and window are
+    identical to a recent one get the stored suggestion back. The suggestion is the whole file the output was
+    applied to, which the messages only partly show with `--context_budget`, so the code and window are part
+    of the key. Identical requests that arrive while the first one is still generating share its upstream
+    call instead of starting another.
+
+    Args:
+        max_entries (int, optional): Maximum number of cached suggestions. Defaults to 1024.
+        ttl (float, optional): Seconds a suggestion stays valid. 0 means forever. Defaults to 300.
+    """
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    @staticmethod
+    def make_key(data, code, window=None):
+        """
+        Computes the cache key of an upstream request.
+
+        Args:
+            data (dict): The JSON body of the upstream request.
+            code (str): The code the model output is applied to.
+            window (tuple, optional): The start and end lines of the code shown to the model. Defaults to None.
+
+        Returns:
+            str: The SHA-256 hex digest of the canonical JSON encoding of the body, the code and the window.
+        """
+        encoded = json.dumps([data, code, window], sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get(self, key):
+        """
+        Looks up a suggestion and marks it as most recently used.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            str: The cached suggestion, or None if it is missing or expired.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if self.ttl > 0 and expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """
+        Stores a suggestion, evicting the least recently used ones beyond `max_entries`.
+
+        Args:
+            key (str): The cache key.
+            value (str): The postprocessed suggestion.
+        """
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get_or_compute(self, key, compute):
+        """
+        Returns the cached suggestion for a key, or computes it once for all concurrent callers.
+
+        The shared computation keeps running as long as one caller waits for it. It is cancelled when
+        the last waiting caller is cancelled, e.g. because its tab request was superseded.
+
+        Args:
+            key (str): The cache key.
+            compute (callable): Returns a coroutine producing the suggestion, or None if it failed.
+                Failed results are not cached.
+
+        Returns:
+            str: The suggestion, or None if the computation failed.
+        """
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        flight = self.inflight.get(key)
+        if flight is None:
+            self.misses += 1
+            task = asyncio.ensure_future(compute())
+            flight = self.inflight[key] = {'task': task, 'waiters': 0}
+            task.add_done_callback(lambda task: self._finish(key, task))
+        else:
+            self.shared += 1
+
+        flight['waiters'] += 1
+        try:
+            return await asyncio.shield(flight['task'])
+        except asyncio.CancelledError:
+            if flight['waiters'] == 1:
+                flight['task'].cancel()
+            raise
+        finally:
+            flight['waiters'] -= 1
+
+    def _finish(self, key, task):
+        if self.inflight.get(key, {}).get('task') is task:
+            del self.inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        if task.result() is not None:
+            self.put(key, task.result())
+
+    def stats(self):
+        """
+        Returns the hit/miss statistics of the cache.
+
+        Returns:
+            dict: The number of hits, misses, shared in-flight calls, cached entries and the hit rate.
+        """
+        lookups = self.hits + self.misses + self.shared
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared': self.shared,
+            'entries': len(self.entries),
+            'hit_rate': (self.hits + self.shared) / lookups if lookups else 0.0,
+        }
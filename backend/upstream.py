@@ -0,0 +1,225 @@
+import json
+import httpx
+
+class UpstreamClient:
+    """
+    A shared asynchronous client for an OpenAI-compatible `chat/completions` service.
+
+    All handlers reuse one connection pool, so concurrent requests overlap on the event loop
+    and keep-alive connections are reused instead of opening a new TCP/TLS connection per call.
+
+    Args:
+        base_url (str): The base URL of the service, e.g. "http://127.0.0.1:10086/v1".
+        api_key (str): The API key sent as a bearer token.
+        pool_size (int, optional): Maximum number of concurrent connections. Defaults to 100.
+        keepalive (int, optional): Maximum number of idle keep-alive connections. Defaults to 20.
+        keepalive_expiry (float, optional): Seconds an idle connection is kept open. Defaults to 30.0.
+        connect_timeout (float, optional): Timeout in seconds for establishing a connection. Defaults to 5.0.
+        read_timeout (float, optional): Timeout in seconds for reading the response. Defaults to 300.0.
+
+    Attributes:
+        inflight (int): The number of requests currently waiting for the service.
+        accepts_prediction (bool): Whether the service takes the `prediction` field of predicted outputs.
+            Cleared the first time the service rejects a request that then succeeds without it.
+        prediction_rejections (int): The number of requests the service rejected because of their `prediction`.
+    """
+    def __init__(self, base_url, api_key, pool_size=100, keepalive=20, keepalive_expiry=30.0, connect_timeout=5.0, read_timeout=300.0):
+        if not base_url.endswith('/'):
+            base_url += '/'
+        self.base_url = base_url
+        self.url = f"{base_url}chat/completions"
+        self.headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {api_key}',
+        }
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout, pool=read_timeout)
+        self.client = None
+        self.inflight = 0
+        self.accepts_prediction = True
+        self.prediction_rejections = 0
+
+    async def start(self):
+        """
+        Opens the underlying connection pool. Must be called from the running event loop.
+        """
+        if self.client is None:
+            self.client = httpx.AsyncClient(headers=self.headers, limits=self.limits, timeout=self.timeout, verify=False)
+
+    async def close(self):
+        """
+        Closes the underlying connection pool.
+        """
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def strip_prediction(self, data):
+        """
+        Removes the `prediction` field of a request if the service does not take it.
+
+        Args:
+            data (dict): The JSON body of the request.
+
+        Returns:
+            dict: The body to send.
+        """
+        if 'prediction' in data and not self.accepts_prediction:
+            return {key: value for key, value in data.items() if key != 'prediction'}
+        return data
+
+    def retry_without_prediction(self, data, response):
+        """
+        Tells whether a failed request should be sent again without its `prediction` field.
+
+        Servers without predicted outputs either ignore the field or answer 400/422.
+
+        Args:
+            data (dict): The JSON body of the failed request.
+            response (httpx.Response): Its response.
+
+        Returns:
+            dict: The body without `prediction`, or None if the failure is not caused by it.
+        """
+        if 'prediction' not in data or response.status_code not in (400, 422):
+            return None
+        print(f"{self.base_url} rejected the predicted output: {response.text[:200]}")
+        return {key: value for key, value in data.items() if key != 'prediction'}
+
+    def record_prediction_rejection(self):
+        # Only called once the request succeeded without the prediction, so an unrelated 400 does not turn it off
+        self.accepts_prediction = False
+        self.prediction_rejections += 1
+
+    async def post_chat_completions(self, data):
+        """
+        Sends a `chat/completions` request and returns the raw response.
+        If the service rejects the `prediction` field, the request is sent again without it.
+
+        Args:
+            data (dict): The JSON body of the request.
+
+        Returns:
+            httpx.Response: The response, whatever its status.
+
+        Raises:
+            httpx.HTTPError: If the request could not be sent or answered.
+        """
+        await self.start()
+        data = self.strip_prediction(data)
+        self.inflight += 1
+        try:
+            response = await self.client.post(self.url, json=data)
+            retry = self.retry_without_prediction(data, response)
+            if retry is not None:
+                response = await self.client.post(self.url, json=retry)
+                if response.status_code == 200:
+                    self.record_prediction_rejection()
+            return response
+        finally:
+            self.inflight -= 1
+
+    async def chat_completions(self, data, session_id=None):
+        """
+        Sends a `chat/completions` request.
+
+        Args:
+            data (dict): The JSON body of the request.
+            session_id (str, optional): The session the request belongs to. Unused by a single client,
+                accepted so that it can be swapped with a `Router`.
+
+        Returns:
+            dict: The decoded JSON response, or None if the request failed or returned a non-200 status.
+        """
+        try:
+            response = await self.post_chat_completions(data)
+        except httpx.HTTPError as e:
+            print(e)
+            return None
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+    async def check_health(self):
+        """
+        Checks whether the service answers, by listing its models.
+
+        Returns:
+            bool: Whether the service returned a 200 status.
+        """
+        await self.start()
+        try:
+            response = await self.client.get(f"{self.base_url}models", timeout=self.timeout.connect)
+        except httpx.HTTPError:
+            return False
+        return response.status_code == 200
+
+    async def stream_chat_completions(self, data, session_id=None, usage=None):
+        """
+        Sends a streaming `chat/completions` request and yields the generated text as it arrives.
+
+        Args:
+            data (dict): The JSON body of the request. `stream` is set to True automatically.
+            session_id (str, optional): The session the request belongs to. Unused by a single client.
+            usage (dict, optional): If given, the token usage reported at the end of the stream is stored in it.
+
+        Yields:
+            str: The content delta of each server-sent event.
+
+        Raises:
+            httpx.HTTPError: If the request fails or returns a non-200 status.
+        """
+        await self.start()
+        data = self.strip_prediction(dict(data, stream=True))
+        if usage is not None:
+            data['stream_options'] = {'include_usage': True}
+        self.inflight += 1
+        try:
+            async with self.client.stream("POST", self.url, json=data) as response:
+                if response.status_code == 200:
+                    async for delta in self.read_events(response, usage):
+                        yield delta
+                    return
+                await response.aread()
+                retry = self.retry_without_prediction(data, response)
+                if retry is None:
+                    response.raise_for_status()
+            async with self.client.stream("POST", self.url, json=retry) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    response.raise_for_status()
+                self.record_prediction_rejection()
+                async for delta in self.read_events(response, usage):
+                    yield delta
+        finally:
+            self.inflight -= 1
+
+    async def read_events(self, response, usage):
+        """
+        Parses the server-sent events of a streaming response.
+
+        Args:
+            response (httpx.Response): The open response.
+            usage (dict): If not None, the token usage reported at the end of the stream is stored in it.
+
+        Yields:
+            str: The content delta of each event.
+        """
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+            chunk = json.loads(payload)
+            if usage is not None and chunk.get('usage'):
+                usage.update(chunk['usage'])
+            if not chunk.get('choices'):
+                continue
+            delta = chunk['choices'][0].get('delta', {}).get('content')
+            if delta:
+                yield delta
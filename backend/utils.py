@@ -65,6 +65,30 @@ def postprocess_output_wf(current, output):
         print(e)
         return current
 
+def postprocess_stream_wf(output):
+    """
+    Extracts the stable prefix of a partially generated whole-file output.
+
+    Args:
+        output (str): The output generated so far.
+
+    Returns:
+        str: The part of the file that can no longer change, i.e. all complete lines after
+        the code fence following `NEXT_START`. Returns None if the code fence has not opened yet.
+    """
+    if NEXT_START not in output:
+        return None
+    output = output.split(NEXT_START)[-1].split(NEXT_END)[0]
+    fence = re.search(r"```(.*?)\n", output)
+    if fence is None:
+        return None
+    body = output[fence.end():]
+    end = body.find("\n```")
+    if end != -1:
+        return body[:end]
+    # The last line may still grow or turn out to be the closing fence
+    return body[:max(body.rfind("\n"), 0)]
+
 def postprocess_output_lc(current, output):
     """
     Post-processes the output by extracting and applying code modifications to the current code.
@@ -132,6 +156,50 @@ def postprocess_output_sr(current, output):
         print(e)
         return current
 
+def detect_output_format(output):
+    """
+    Detects the modification format of a model output.
+
+    Args:
+        output (str): The output of the model.
+
+    Returns:
+        str: "lc" for Location-and-Change, "sr" for Search-and-Replace, otherwise "wf" for Whole-File.
+    """
+    output = output.split(NEXT_START)[-1].split(NEXT_END)[0].strip()
+    if re.match(r"\d+,\d+\n```", output):
+        return "lc"
+    if SEARCH_AND_REPLACE in output:
+        return "sr"
+    return "wf"
+
+def postprocess_output(current, output, window=None):
+    """
+    Applies a model output in any modification format to the current code.
+
+    The format is detected from the output itself, so an output in another format than the one
+    requested by the prompt is still applied correctly.
+
+    Args:
+        current (str): The current code, without target area markers.
+        output (str): The output of the model.
+        window (tuple, optional): The start and end lines of the part of the file shown to the model.
+            A Whole-File output then only covers these lines and is spliced back into the file.
+            Location-and-Change line numbers and Search-and-Replace blocks already refer to the whole file. Defaults to None.
+
+    Returns:
+        str: The whole modified file, or the current code if the output cannot be applied.
+    """
+    output_format = detect_output_format(output)
+    if output_format == "lc":
+        return postprocess_output_lc(current, output)
+    if output_format == "sr":
+        return postprocess_output_sr(current, output)
+    if window is not None:
+        body = postprocess_output_wf(None, output)
+        return current if body is None else splice_window(current, body, window)
+    return postprocess_output_wf(current, output)
+
 def markdown_codeblock_extract(response):
     """
     Extracts the first code block from a markdown-formatted string.
@@ -219,9 +287,22 @@ def generate_diff_blocks(original, modified):
     Returns:
         list: A list of tuples, where each tuple contains a block of modified lines and the line number in the original string where the block starts.
     """
+    return generate_diff_blocks_from_lines(original.split('\n'), modified.split('\n'))
+
+def generate_diff_blocks_from_lines(original_lines, modified_lines):
+    """
+    Generate diff blocks between two lists of lines.
+
+    Args:
+        original_lines (list): The lines of the original string.
+        modified_lines (list): The lines of the modified string.
+
+    Returns:
+        list: A list of tuples, where each tuple contains a block of modified lines and the line number in the original lines where the block starts.
+    """
     # Use difflib's ndiff to find differences
     differ = difflib.Differ()
-    diff = list(differ.compare(original.split('\n'), modified.split('\n')))
+    diff = list(differ.compare(original_lines, modified_lines))
     
     # store all modified blocks
     blocks = []
@@ -252,3 +333,317 @@ def generate_diff_blocks(original, modified):
         blocks.append((current_block, orig_line_no - block_line_len))
     
     return blocks
+
+def common_affix_lengths(a, b):
+    """
+    Compute the lengths of the common prefix and the common suffix of two sequences.
+
+    The comparisons are done on slices with a binary search, so long unchanged regions are compared at C speed.
+
+    Args:
+        a (str or list): The first sequence.
+        b (str or list): The second sequence.
+
+    Returns:
+        tuple: The length of the common prefix and the length of the common suffix. The suffix never overlaps the prefix.
+    """
+    n = min(len(a), len(b))
+    low, high = 0, n
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    prefix = low
+
+    low, high = 0, n - prefix
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            low = mid
+        else:
+            high = mid - 1
+    return prefix, low
+
+def generate_trimmed_diff_blocks(original, modified):
+    """
+    Generate diff blocks between two strings, diffing only the window between their common prefix and suffix lines.
+
+    Differ is quadratic in the number of lines it compares, so restricting it to the changed window makes the cost
+    depend on the size of the edit instead of the size of the file.
+
+    Args:
+        original (str): The original string.
+        modified (str): The modified string.
+
+    Returns:
+        list: The same blocks as `generate_diff_blocks`, with line numbers relative to the original string.
+    """
+    original_lines = original.split('\n')
+    modified_lines = modified.split('\n')
+    prefix, suffix = common_affix_lengths(original_lines, modified_lines)
+    if prefix == len(original_lines) == len(modified_lines):
+        return []
+    blocks = generate_diff_blocks_from_lines(
+        original_lines[prefix:len(original_lines) - suffix],
+        modified_lines[prefix:len(modified_lines) - suffix],
+    )
+    return [(block, line_no + prefix) for block, line_no in blocks]
+
+def count_trimmed_diff_blocks(original, modified, exact_lines=200):
+    """
+    Count the diff blocks between two strings, like `len(generate_diff_blocks(original, modified))`.
+
+    Files shorter than `exact_lines` are diffed whole, so the count is exact. Longer files are only diffed on the
+    window between their common prefix and suffix lines, which is an approximation: the alignment of SequenceMatcher
+    and its autojunk heuristic (used from 200 lines on) depend on the lines outside the window, so the count of
+    the whole files can differ, mostly for edits spanning several lines.
+
+    Args:
+        original (str): The original string.
+        modified (str): The modified string.
+        exact_lines (int, optional): Files with fewer lines than this are diffed whole. Defaults to 200.
+
+    Returns:
+        int: The number of diff blocks.
+    """
+    if max(original.count('\n'), modified.count('\n')) + 1 < exact_lines:
+        return len(generate_diff_blocks(original, modified))
+    if original == "":
+        # Differ only synchronizes the single empty original line with the first empty modified line,
+        # which splits the inserted file into the blocks before and after it
+        modified_lines = modified.split('\n')
+        try:
+            first_empty = modified_lines.index('')
+        except ValueError:
+            return 1
+        return int(first_empty > 0) + int(first_empty < len(modified_lines) - 1)
+    return len(generate_trimmed_diff_blocks(original, modified))
+
+class ContinuityTracker:
+    """
+    Incremental version of `blockwise_if_continuous_modify` for the stream of edits of one session.
+
+    The distance and the number of diff blocks between the first two snapshots are kept from the previous call,
+    since they are the result of that call when it was continuous and the new pair otherwise.
+    Each call then only computes:
+    - the distance between the last two codes, which only differ around the latest keystroke,
+    - the distance between the first and the last code, bounded by the sum of the other two distances,
+    - the diff blocks between the first and the last code, on the window between their common prefix and suffix lines,
+      and only if the distances are continuous.
+
+    The distances are exact. The diff blocks are exact for files below 200 lines and approximated on the window for
+    longer ones (see `count_trimmed_diff_blocks`), so on long files a multi-line edit can occasionally be recorded as
+    a new snapshot where `blockwise_if_continuous_modify` would merge it, or the other way around.
+    """
+    def __init__(self):
+        self.code1 = None
+        self.code2 = None
+        self.dist12 = None
+        self.blocks12 = None
+
+    def check(self, code1, code2, code3):
+        """
+        Check if code3 is a continuous modification of code1 and code2.
+
+        Args:
+            code1 (str): The first code string.
+            code2 (str): The second code string.
+            code3 (str): The third code string.
+
+        Returns:
+            bool: True if code3 is a continuous modification of code1 and code2, False otherwise.
+        """
+        if self.code1 is None or self.code1 != code1 or self.code2 != code2:
+            self.code1 = code1
+            self.code2 = code2
+            self.dist12 = Levenshtein.distance(code1, code2)
+            self.blocks12 = None
+
+        dist23 = Levenshtein.distance(code2, code3)
+        # By the triangle inequality dist13 <= dist12 + dist23, so the bounded computation is exact
+        dist13 = Levenshtein.distance(code1, code3, score_cutoff=self.dist12 + dist23)
+
+        if dist13 == self.dist12 + dist23:
+            if self.blocks12 is None:
+                self.blocks12 = count_trimmed_diff_blocks(code1, code2)
+            blocks13 = count_trimmed_diff_blocks(code1, code3)
+            if blocks13 == self.blocks12:
+                self.code2 = code3
+                self.dist12 = dist13
+                self.blocks12 = blocks13
+                return True
+
+        # code3 starts a new snapshot, the pair to compare with next is (code2, code3)
+        self.code1 = code2
+        self.code2 = code3
+        self.dist12 = dist23
+        self.blocks12 = None
+        return False
+
+def generate_hunks(original, modified):
+    """
+    Split the changes between two strings into line hunks.
+
+    Args:
+        original (str): The original string.
+        modified (str): The modified string.
+
+    Returns:
+        list: A list of dictionaries, each with the `start` and `end` line numbers (0-based, end exclusive)
+        of a range of the original lines and the `lines` replacing it, in order.
+    """
+    original_lines = original.split('\n')
+    modified_lines = modified.split('\n')
+    prefix, suffix = common_affix_lengths(original_lines, modified_lines)
+    matcher = difflib.SequenceMatcher(
+        None,
+        original_lines[prefix:len(original_lines) - suffix],
+        modified_lines[prefix:len(modified_lines) - suffix],
+        autojunk=False,
+    )
+    hunks = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        hunks.append({
+            'start': i1 + prefix,
+            'end': i2 + prefix,
+            'lines': modified_lines[j1 + prefix:j2 + prefix],
+        })
+    return hunks
+
+def apply_hunks(original, hunks):
+    """
+    Apply line hunks produced by `generate_hunks` to a string.
+
+    Args:
+        original (str): The original string.
+        hunks (list): The hunks, with line numbers relative to the original string.
+
+    Returns:
+        str: The modified string.
+    """
+    lines = original.split('\n')
+    for hunk in sorted(hunks, key=lambda hunk: hunk['start'], reverse=True):
+        lines[hunk['start']:hunk['end']] = hunk['lines']
+    return '\n'.join(lines)
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens of a text, at about four characters per token.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return (len(text) + 3) // 4
+
+def window_around(code, offset, budget):
+    """
+    Chooses the lines of a file shown to the model, centered on the cursor and sized by a token budget.
+
+    Args:
+        code (str): The code.
+        offset (int): The offset of the cursor in the code.
+        budget (int): The token budget of the window.
+
+    Returns:
+        tuple: The start and end lines of the window. The whole file if it fits in the budget.
+    """
+    lines = code.split("\n")
+    if estimate_tokens(code) <= budget:
+        return 0, len(lines)
+    cursor = min(code.count("\n", 0, max(offset, 0)), len(lines) - 1)
+    start, end = cursor, cursor + 1
+    used = (len(lines[cursor]) + 1) / 4
+    # Grow the window one line at a time on alternate sides, and on one side once the other is exhausted
+    below = True
+    while start > 0 or end < len(lines):
+        if below and end < len(lines) or start == 0:
+            cost = (len(lines[end]) + 1) / 4
+            if used + cost > budget:
+                break
+            end += 1
+        else:
+            cost = (len(lines[start - 1]) + 1) / 4
+            if used + cost > budget:
+                break
+            start -= 1
+        used += cost
+        below = not below
+    return start, end
+
+def changed_line_range(code, following, margin=0, budget=None):
+    """
+    Finds the lines of a history snapshot that were changed by the next snapshot.
+
+    Args:
+        code (str): The history snapshot.
+        following (str): The next snapshot.
+        margin (int, optional): Unchanged lines kept around the change. Defaults to 0.
+        budget (int, optional): The token budget of the range. Lines at the end of the range are dropped beyond it. Defaults to None.
+
+    Returns:
+        tuple: The start and end lines of the changed region of `code`, with at least one line.
+    """
+    lines = code.split("\n")
+    prefix, suffix = common_affix_lengths(lines, following.split("\n"))
+    start = max(min(prefix, len(lines) - 1) - margin, 0)
+    end = min(max(len(lines) - suffix, start + 1) + margin, len(lines))
+    if budget is not None:
+        used = 0
+        for i in range(start, end):
+            used += (len(lines[i]) + 1) / 4
+            if used > budget and i > start:
+                end = i
+                break
+    return start, end
+
+def splice_window(current, body, window):
+    """
+    Puts the predicted content of a window back into the whole file.
+
+    Args:
+        current (str): The whole current file.
+        body (str): The predicted content of the window, with or without the `...` elision lines.
+        window (tuple): The start and end lines of the window in `current`.
+
+    Returns:
+        str: The whole predicted file.
+    """
+    start, end = window
+    lines = current.split("\n")
+    body_lines = body.split("\n")
+    if start > 0 and body_lines and body_lines[0].strip() == "...":
+        body_lines = body_lines[1:]
+    if end < len(lines) and body_lines and body_lines[-1].strip() == "...":
+        body_lines = body_lines[:-1]
+    return "\n".join(lines[:start] + body_lines + lines[end:])
+
+def splice_stream_prefix(current, prefix, window):
+    """
+    Turns the stable prefix of a partially generated window into a stable prefix of the whole predicted file.
+
+    Args:
+        current (str): The whole current file.
+        prefix (str): The stable prefix of the window, see `postprocess_stream_wf`.
+        window (tuple): The start and end lines of the window in `current`.
+
+    Returns:
+        str: The stable prefix of the whole file, or None if no line of the window is stable yet.
+    """
+    start, end = window
+    lines = current.split("\n")
+    body_lines = prefix.split("\n")
+    if start > 0 and body_lines[0].strip() == "...":
+        body_lines = body_lines[1:]
+    # A trailing `...` line may be the elision marker of the end of the window, it is only stable once followed by another line
+    if end < len(lines) and body_lines and body_lines[-1].strip() == "...":
+        body_lines = body_lines[:-1]
+    if not body_lines:
+        return None
+    return "\n".join(lines[:start] + body_lines)
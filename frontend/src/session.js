@@ -0,0 +1,18 @@
+// Each browser tab gets its own session, so several editors can share one backend without mixing their histories.
+const sessionStorageKey = 'sessionId';
+
+function createSessionId() {
+  if (window.crypto && window.crypto.randomUUID) {
+    return window.crypto.randomUUID();
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+export function getSessionId() {
+  let sessionId = sessionStorage.getItem(sessionStorageKey);
+  if (!sessionId) {
+    sessionId = createSessionId();
+    sessionStorage.setItem(sessionStorageKey, sessionId);
+  }
+  return sessionId;
+}
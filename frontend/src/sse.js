@@ -0,0 +1,23 @@
+// Reads a server-sent event stream from a fetch response and calls onEvent with each decoded JSON payload.
+export async function readEventStream(response, onEvent) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const event = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      if (event.startsWith('data: ')) {
+        onEvent(JSON.parse(event.slice(6)));
+      }
+    }
+  }
+}